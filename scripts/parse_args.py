@@ -35,7 +35,7 @@ def add_io_parameters(parser) -> None:
 def add_keypoint_parameters(parser) -> None:
     parser.add_argument(
         "--keypoint_selection",
-        choices=["random", "iterative", "subsampling"],
+        choices=["random", "iterative", "subsampling", "iss", "farthest_point"],
         type=str,
         default="subsampling",
         help="Choice of the algorithm to select keypoints to compute descriptors on.",
@@ -46,6 +46,12 @@ def add_keypoint_parameters(parser) -> None:
         default=0.005,
         help="Size of the voxels in the subsampling-based keypoint selection.",
     )
+    parser.add_argument(
+        "--n_keypoints",
+        type=int,
+        default=5000,
+        help="Number of keypoints in the farthest point sampling.",
+    )
     parser.add_argument(
         "--keypoint_density_threshold",
         type=int,
@@ -100,6 +106,20 @@ def add_descriptor_parameters(parser) -> None:
         default=5,
         help="Parameter that controls the subsampling size of the support point cloud in the multiscale part",
     )
+    parser.add_argument(
+        "--backend",
+        choices=["numpy", "numba"],
+        type=str,
+        default="numpy",
+        help="Backend of the descriptor kernels. The numba backend requires the optional numba dependency.",
+    )
+    parser.add_argument(
+        "--spatial_index_backend",
+        choices=["sklearn", "scipy", "brute_force", "voxel_hash"],
+        type=str,
+        default="sklearn",
+        help="Spatial index used by every neighborhood search. The scipy one runs its queries on all the CPUs.",
+    )
 
 
 def add_matching_parameters(parser) -> None:
@@ -13,6 +13,7 @@ from shot_fpfh import (
     RegistrationPipeline,
     compute_normals,
 )
+from shot_fpfh.base_computation import set_default_spatial_index_backend
 
 warnings.filterwarnings("ignore")
 
@@ -25,6 +26,7 @@ def main(args: argparse.Namespace = parse_args()) -> None:
     Args:
         args: Arguments parsed from command-line using argparse.
     """
+    set_default_spatial_index_backend(args.spatial_index_backend)
     global_timer = checkpoint()
     timer = checkpoint()
     scan, scan_normals = get_data(
@@ -54,25 +56,29 @@ def main(args: argparse.Namespace = parse_args()) -> None:
 
     timer("Time spent retrieving the data")
 
-    pipeline = RegistrationPipeline(
+    # the worker processes and shared memory of the pipeline are released on exiting the context, even on failure, as
+    # the remaining stages are not parallelized
+    with RegistrationPipeline(
         scan=scan, scan_normals=scan_normals, ref=ref, ref_normals=ref_normals
-    )
-    pipeline.select_keypoints(
-        args.keypoint_selection,
-        neighborhood_size=args.keypoint_voxel_size,
-        min_n_neighbors=args.keypoint_density_threshold,
-    )
-    timer("Time spent selecting the key points")
-
-    pipeline.compute_descriptors(
-        descriptor_choice=args.descriptor_choice,
-        radius=args.radius,
-        fpfh_n_bins=args.fpfh_n_bins,
-        disable_progress_bars=args.disable_progress_bars,
-    )
-    timer(
-        f"Time spent computing the descriptors on the reference point cloud ({ref.shape[0]} points)"
-    )
+    ) as pipeline:
+        pipeline.select_keypoints(
+            args.keypoint_selection,
+            neighborhood_size=args.keypoint_voxel_size,
+            min_n_neighbors=args.keypoint_density_threshold,
+            n_keypoints=args.n_keypoints,
+        )
+        timer("Time spent selecting the key points")
+
+        pipeline.compute_descriptors(
+            descriptor_choice=args.descriptor_choice,
+            radius=args.radius,
+            fpfh_n_bins=args.fpfh_n_bins,
+            backend=args.backend,
+            disable_progress_bars=args.disable_progress_bars,
+        )
+        timer(
+            f"Time spent computing the descriptors on the reference point cloud ({ref.shape[0]} points)"
+        )
     gc.collect()
 
     pipeline.find_descriptors_matches(
@@ -1,7 +1,28 @@
+from .neighborhoods import (
+    MultiRadiusNeighborhoods,
+    NeighborhoodGraph,
+    as_neighborhood_graph,
+    flatten_neighborhoods,
+    get_offsets,
+    get_segment_ids,
+)
 from .rigid_transform import (
     solver_point_to_point,
     compute_point_to_point_error,
     solver_point_to_plane,
 )
-from .subsampling import grid_subsampling
+from .spatial_index import (
+    BruteForceSpatialIndex,
+    ScipySpatialIndex,
+    SklearnSpatialIndex,
+    SpatialIndex,
+    SpatialIndexBackend,
+    VoxelHashSpatialIndex,
+    create_spatial_index,
+    query_radius_csr,
+    set_default_spatial_index_backend,
+)
+from .spatial_index_cache import SpatialIndexCache
+from .subsampling import VoxelPyramid, get_voxel_keys, grid_subsampling
 from .transformation import Transformation
+from .voxel_moments import VoxelMomentGrid
@@ -0,0 +1,324 @@
+"""
+Helpers to manipulate neighborhoods as returned by radius searches.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from .spatial_index import SpatialIndex, create_spatial_index, query_radius_csr
+
+
+def flatten_neighborhoods(
+    neighborhoods: np.ndarray[np.object_] | list[np.ndarray[np.int64]],
+) -> tuple[np.ndarray[np.int64], np.ndarray[np.int64]]:
+    """
+    Concatenates an object array of neighborhoods (as returned by KDTree.query_radius) into a flat (CSR) layout.
+
+    Args:
+        neighborhoods: The neighborhoods associated with each query point. neighborhoods[i] should be an array of ints.
+
+    Returns:
+        indices: The concatenation of all the neighborhoods.
+        offsets: (n_neighborhoods + 1,) array such that neighborhood i is indices[offsets[i]:offsets[i + 1]].
+    """
+    offsets = get_offsets(
+        np.fromiter(
+            (neighborhood.shape[0] for neighborhood in neighborhoods),
+            dtype=np.int64,
+            count=len(neighborhoods),
+        )
+    )
+    indices = (
+        np.concatenate(neighborhoods).astype(np.int64, copy=False)
+        if offsets[-1] > 0
+        else np.zeros(0, dtype=np.int64)
+    )
+    return indices, offsets
+
+
+def get_segment_ids(offsets: np.ndarray[np.int64]) -> np.ndarray[np.int64]:
+    """
+    Retrieves the index of the neighborhood each element of a flat (CSR) layout belongs to.
+
+    Args:
+        offsets: (n_neighborhoods + 1,) array of offsets of the flat layout.
+
+    Returns:
+        (offsets[-1],) array whose i-th value is the index of the neighborhood element i belongs to.
+    """
+    return np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+
+
+def get_offsets(neighborhood_sizes: np.ndarray[np.int64]) -> np.ndarray[np.int64]:
+    """
+    Computes the offsets of a flat (CSR) layout from the sizes of the neighborhoods.
+
+    Args:
+        neighborhood_sizes: (n_neighborhoods,) array of sizes.
+
+    Returns:
+        (n_neighborhoods + 1,) array of offsets.
+    """
+    offsets = np.zeros(neighborhood_sizes.shape[0] + 1, dtype=np.int64)
+    np.cumsum(neighborhood_sizes, out=offsets[1:])
+    return offsets
+
+
+@dataclass
+class NeighborhoodGraph:
+    """
+    Neighborhoods of a set of query points in a flat (CSR) layout: the neighbors of query point i are
+    indices[offsets[i]:offsets[i + 1]], at the distances distances[offsets[i]:offsets[i + 1]] if they were kept.
+    The indices are stored on 32 bits and the distances in single precision, which takes half the memory of the object
+    arrays returned by KDTree.query_radius. Being made of three contiguous arrays, a graph can be published in shared
+    memory by an executor, or saved once and memory-mapped with load.
+    """
+
+    indices: np.ndarray[np.int32]
+    offsets: np.ndarray[np.int64]
+    distances: np.ndarray[np.float32] | None = None
+
+    def __post_init__(self):
+        if self.indices.dtype.itemsize > 4 and self.indices.shape[0] > 0:
+            if self.indices.max() > np.iinfo(np.int32).max:
+                raise ValueError(
+                    "The indices of the neighbors do not fit on 32 bits, the point cloud is too large."
+                )
+        self.indices = self.indices.astype(np.int32, copy=False)
+        self.offsets = self.offsets.astype(np.int64, copy=False)
+        if self.distances is not None:
+            self.distances = self.distances.astype(np.float32, copy=False)
+
+    @classmethod
+    def from_query_radius(
+        cls,
+        neighborhoods: np.ndarray[np.object_] | list[np.ndarray[np.int64]],
+        distances: np.ndarray[np.object_] | list[np.ndarray[np.float64]] | None = None,
+    ) -> "NeighborhoodGraph":
+        """
+        Converts the output of KDTree.query_radius.
+
+        Args:
+            neighborhoods: The neighborhoods associated with each query point. neighborhoods[i] should be an array of ints.
+            distances: The distances to the neighbors, as returned with return_distance=True. Leave empty to drop them.
+
+        Returns:
+            The neighborhoods as a graph.
+        """
+        indices, offsets = flatten_neighborhoods(neighborhoods)
+        if distances is None:
+            return cls(indices, offsets)
+        return cls(
+            indices,
+            offsets,
+            np.concatenate(distances) if offsets[-1] > 0 else np.zeros(0),
+        )
+
+    @classmethod
+    def search(
+        cls,
+        spatial_index: SpatialIndex,
+        query_points: np.ndarray[np.float64],
+        radius: float,
+        return_distance: bool = False,
+        sort_results: bool = False,
+    ) -> "NeighborhoodGraph":
+        """
+        Searches the neighborhoods of the query points, in the flat layout of the spatial index if it has one.
+
+        Args:
+            spatial_index: The spatial index built on the support.
+            query_points: The points whose neighborhoods are searched.
+            radius: The radius of the neighborhoods.
+            return_distance: Whether the distances to the neighbors should be kept.
+            sort_results: Whether the neighbors should be sorted by distance.
+
+        Returns:
+            The neighborhoods as a graph.
+        """
+        return cls(
+            *query_radius_csr(
+                spatial_index,
+                query_points,
+                radius,
+                return_distance=return_distance,
+                sort_results=sort_results,
+            )
+        )
+
+    @classmethod
+    def load(cls, path: str | Path, mmap_mode: str | None = "r") -> "NeighborhoodGraph":
+        """
+        Loads a graph written by save, memory-mapped by default.
+
+        Args:
+            path: The directory the graph was saved to.
+            mmap_mode: The memory-mapping mode, as in np.load. Leave empty to read the arrays in memory.
+
+        Returns:
+            The neighborhoods as a graph.
+        """
+        path = Path(path)
+        return cls(
+            np.load(path / "indices.npy", mmap_mode=mmap_mode),
+            np.load(path / "offsets.npy", mmap_mode=mmap_mode),
+            np.load(path / "distances.npy", mmap_mode=mmap_mode)
+            if (path / "distances.npy").exists()
+            else None,
+        )
+
+    def save(self, path: str | Path) -> None:
+        """
+        Saves the arrays of the graph as .npy files in a directory, which is created if needed.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "indices.npy", self.indices)
+        np.save(path / "offsets.npy", self.offsets)
+        if self.distances is not None:
+            np.save(path / "distances.npy", self.distances)
+
+    @property
+    def n_neighborhoods(self) -> int:
+        return self.offsets.shape[0] - 1
+
+    @property
+    def sizes(self) -> np.ndarray[np.int64]:
+        return np.diff(self.offsets)
+
+    def get_segment_ids(self) -> np.ndarray[np.int64]:
+        """
+        Retrieves the index of the neighborhood each neighbor belongs to.
+        """
+        return get_segment_ids(self.offsets)
+
+    def slice(self, start: int, stop: int) -> "NeighborhoodGraph":
+        """
+        Retrieves the neighborhoods of the query points start to stop, as views on the arrays of the graph.
+        """
+        offsets = self.offsets[start : stop + 1]
+        return NeighborhoodGraph(
+            self.indices[offsets[0] : offsets[-1]],
+            offsets - offsets[0],
+            self.distances[offsets[0] : offsets[-1]]
+            if self.distances is not None
+            else None,
+        )
+
+    def split_in_blocks(self, block_size: int) -> list[tuple[int, int]]:
+        """
+        Splits the query points in contiguous blocks whose neighborhoods hold at most block_size neighbors in total, a
+        single neighborhood larger than that making a block on its own.
+
+        Returns:
+            The (start, stop) bounds of each block.
+        """
+        bounds = [0]
+        while bounds[-1] < self.n_neighborhoods:
+            start = bounds[-1]
+            stop = (
+                np.searchsorted(
+                    self.offsets, self.offsets[start] + block_size, side="right"
+                )
+                - 1
+            )
+            bounds.append(int(min(max(stop, start + 1), self.n_neighborhoods)))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def select(self, rows: np.ndarray[np.int64]) -> "NeighborhoodGraph":
+        """
+        Retrieves the neighborhoods of a subset of the query points, in the order of rows.
+        """
+        sizes = self.sizes[rows]
+        offsets = get_offsets(sizes)
+        # position of each selected neighbor in the arrays of the graph
+        positions = np.repeat(self.offsets[rows] - offsets[:-1], sizes) + np.arange(
+            offsets[-1]
+        )
+        return NeighborhoodGraph(
+            self.indices[positions],
+            offsets,
+            self.distances[positions] if self.distances is not None else None,
+        )
+
+    def restrict(self, radius: float) -> "NeighborhoodGraph":
+        """
+        Retrieves the neighborhoods at a radius smaller than the one of the search. Requires the distances.
+        """
+        mask = self.distances <= radius
+        return NeighborhoodGraph(
+            self.indices[mask],
+            get_offsets(
+                np.bincount(
+                    self.get_segment_ids()[mask], minlength=self.n_neighborhoods
+                )
+            ),
+            self.distances[mask],
+        )
+
+
+def as_neighborhood_graph(
+    neighborhoods: "NeighborhoodGraph | tuple[np.ndarray[np.int64], ...] | np.ndarray[np.object_]",
+) -> NeighborhoodGraph:
+    """
+    Converts neighborhoods given in any of the layouts used in this package into a graph.
+
+    Args:
+        neighborhoods: A NeighborhoodGraph, a tuple (indices, offsets) or (indices, offsets, distances) describing a
+        flat layout, or the neighborhoods associated with each query point as returned by KDTree.query_radius.
+
+    Returns:
+        The neighborhoods as a graph.
+    """
+    if isinstance(neighborhoods, NeighborhoodGraph):
+        return neighborhoods
+    if isinstance(neighborhoods, tuple):
+        return NeighborhoodGraph(*neighborhoods)
+    return NeighborhoodGraph.from_query_radius(neighborhoods)
+
+
+class MultiRadiusNeighborhoods:
+    """
+    Neighborhoods of a set of query points in a support point cloud at several radii.
+    A single radius search is performed at the largest radius, with the neighbors sorted by distance: the neighborhoods
+    at a smaller radius are then prefixes of the ones at the largest radius.
+    """
+
+    def __init__(
+        self,
+        support: np.ndarray[np.float64],
+        query_points: np.ndarray[np.float64],
+        radii: list[float] | np.ndarray[np.float64],
+        kdtree: SpatialIndex | None = None,
+    ) -> None:
+        """
+        Builds the spatial index on the support and performs the radius search.
+
+        Args:
+            support: The supporting point cloud.
+            query_points: The points whose neighborhoods are searched.
+            radii: The radii the neighborhoods will be retrieved at.
+            kdtree: A spatial index already built on the support. Leave empty to build one with the default backend.
+        """
+        self.max_radius = max(radii)
+        if kdtree is None:
+            kdtree = create_spatial_index(support)
+        self.graph = NeighborhoodGraph.search(
+            kdtree, query_points, self.max_radius, return_distance=True, sort_results=True
+        )
+
+    def restrict(self, radius: float) -> NeighborhoodGraph:
+        """
+        Retrieves the neighborhoods at a radius smaller than the one of the search.
+
+        Args:
+            radius: The radius of the neighborhoods.
+
+        Returns:
+            The neighborhoods as a graph.
+        """
+        if radius >= self.max_radius:
+            return self.graph
+        # the neighbors are sorted by distance, which makes each new neighborhood a prefix of the previous one
+        return self.graph.restrict(radius)
@@ -1,7 +1,7 @@
 import numpy as np
 from scipy.spatial.transform import Rotation
-from sklearn.neighbors import KDTree
 
+from .spatial_index import create_spatial_index
 from .transformation import Transformation
 
 
@@ -57,5 +57,5 @@ def compute_point_to_point_error(
     by the rotation and the translation.
     """
     transformed_data = transformation[scan]
-    distances = KDTree(ref).query(transformed_data)[0].squeeze()
+    distances = create_spatial_index(ref).query(transformed_data)[0].squeeze()
     return np.sqrt((distances**2).mean()), transformed_data
@@ -0,0 +1,667 @@
+"""
+Interchangeable spatial indices used by every neighborhood search of the package.
+All of them follow the interface of sklearn.neighbors.KDTree, which is also one of the backends, and add count_radius.
+"""
+from collections import OrderedDict
+from itertools import chain
+from typing import Iterator, Literal, Protocol
+
+import numpy as np
+from scipy.spatial import cKDTree
+from sklearn.neighbors import KDTree
+
+SpatialIndexBackend = Literal["sklearn", "scipy", "brute_force", "voxel_hash"]
+
+default_spatial_index_backend: SpatialIndexBackend = "sklearn"
+
+
+class SpatialIndex(Protocol):
+    """
+    Interface of the spatial indices, whose methods have the semantics of the ones of sklearn.neighbors.KDTree.
+    """
+
+    def query(
+        self,
+        query_points: np.ndarray[np.float64],
+        k: int = 1,
+        return_distance: bool = True,
+    ) -> np.ndarray[np.int64] | tuple[np.ndarray[np.float64], np.ndarray[np.int64]]:
+        ...
+
+    def query_radius(
+        self,
+        query_points: np.ndarray[np.float64],
+        r: float,
+        return_distance: bool = False,
+        sort_results: bool = False,
+    ) -> np.ndarray[np.object_] | tuple[np.ndarray[np.object_], np.ndarray[np.object_]]:
+        ...
+
+    def count_radius(
+        self, query_points: np.ndarray[np.float64], r: float
+    ) -> np.ndarray[np.int64]:
+        ...
+
+
+def split_into_object_array(
+    values: np.ndarray, offsets: np.ndarray[np.int64]
+) -> np.ndarray[np.object_]:
+    """
+    Splits concatenated arrays in an object array like the ones returned by KDTree.query_radius.
+
+    Args:
+        values: The concatenation of the arrays.
+        offsets: (n_arrays + 1,) array such that array i is values[offsets[i]:offsets[i + 1]].
+
+    Returns:
+        The (n_arrays,) object array, even if the arrays have the same size.
+    """
+    object_array = np.empty(offsets.shape[0] - 1, dtype=object)
+    for i, array in enumerate(np.split(values, offsets[1:-1])[: object_array.shape[0]]):
+        object_array[i] = array
+    return object_array
+
+
+def split_neighborhoods(
+    query_points: np.ndarray[np.float64],
+    points: np.ndarray[np.float64],
+    neighborhood_sizes: np.ndarray[np.int64],
+    indices: np.ndarray[np.int64],
+    return_distance: bool,
+    sort_results: bool,
+) -> np.ndarray[np.object_] | tuple[np.ndarray[np.object_], np.ndarray[np.object_]]:
+    """
+    Converts concatenated neighborhoods into the output of KDTree.query_radius.
+
+    Args:
+        query_points: The points whose neighborhoods were searched.
+        points: The indexed point cloud.
+        neighborhood_sizes: (n_query_points,) array of sizes of the neighborhoods.
+        indices: The concatenation of the neighborhoods.
+        return_distance: Whether the distances to the neighbors should be returned.
+        sort_results: Whether the neighbors should be sorted by distance.
+
+    Returns:
+        The object arrays of neighborhoods, and of distances if return_distance is True.
+    """
+    offsets = np.zeros(neighborhood_sizes.shape[0] + 1, dtype=np.int64)
+    np.cumsum(neighborhood_sizes, out=offsets[1:])
+    if not return_distance:
+        return split_into_object_array(indices, offsets)
+
+    segment_ids = np.repeat(np.arange(neighborhood_sizes.shape[0]), neighborhood_sizes)
+    distances = np.linalg.norm(points[indices] - query_points[segment_ids], axis=1)
+    if sort_results:
+        order = np.lexsort((distances, segment_ids))
+        indices, distances = indices[order], distances[order]
+    return split_into_object_array(indices, offsets), split_into_object_array(
+        distances, offsets
+    )
+
+
+class SklearnSpatialIndex:
+    """
+    sklearn.neighbors.KDTree, whose queries run on a single thread.
+    """
+
+    def __init__(self, points: np.ndarray[np.float64]) -> None:
+        self.kdtree = KDTree(points)
+
+    def query(
+        self,
+        query_points: np.ndarray[np.float64],
+        k: int = 1,
+        return_distance: bool = True,
+    ) -> np.ndarray[np.int64] | tuple[np.ndarray[np.float64], np.ndarray[np.int64]]:
+        return self.kdtree.query(query_points, k=k, return_distance=return_distance)
+
+    def query_radius(
+        self,
+        query_points: np.ndarray[np.float64],
+        r: float,
+        return_distance: bool = False,
+        sort_results: bool = False,
+    ) -> np.ndarray[np.object_] | tuple[np.ndarray[np.object_], np.ndarray[np.object_]]:
+        return self.kdtree.query_radius(
+            query_points, r, return_distance=return_distance, sort_results=sort_results
+        )
+
+    def count_radius(
+        self, query_points: np.ndarray[np.float64], r: float
+    ) -> np.ndarray[np.int64]:
+        return self.kdtree.query_radius(query_points, r, count_only=True)
+
+
+class ScipySpatialIndex:
+    """
+    scipy.spatial.cKDTree, whose queries are spread over several threads.
+    """
+
+    def __init__(self, points: np.ndarray[np.float64], workers: int = -1) -> None:
+        """
+        Args:
+            points: The point cloud to index.
+            workers: Number of threads used by the queries, -1 to use all the CPUs.
+        """
+        self.points = np.asarray(points, dtype=np.float64)
+        self.workers = workers
+        self.kdtree = cKDTree(self.points)
+
+    def query(
+        self,
+        query_points: np.ndarray[np.float64],
+        k: int = 1,
+        return_distance: bool = True,
+    ) -> np.ndarray[np.int64] | tuple[np.ndarray[np.float64], np.ndarray[np.int64]]:
+        # a list of k is the only way to get (n_query_points, k) arrays even with k = 1
+        distances, indices = self.kdtree.query(
+            query_points, k=list(range(1, k + 1)), workers=self.workers
+        )
+        indices = indices.astype(np.int64, copy=False)
+        return (distances, indices) if return_distance else indices
+
+    def query_radius(
+        self,
+        query_points: np.ndarray[np.float64],
+        r: float,
+        return_distance: bool = False,
+        sort_results: bool = False,
+    ) -> np.ndarray[np.object_] | tuple[np.ndarray[np.object_], np.ndarray[np.object_]]:
+        neighborhoods = self.kdtree.query_ball_point(
+            query_points, r, workers=self.workers
+        )
+        neighborhood_sizes = np.fromiter(
+            map(len, neighborhoods), dtype=np.int64, count=len(neighborhoods)
+        )
+        indices = np.fromiter(
+            chain.from_iterable(neighborhoods),
+            dtype=np.int64,
+            count=neighborhood_sizes.sum(),
+        )
+        return split_neighborhoods(
+            np.asarray(query_points),
+            self.points,
+            neighborhood_sizes,
+            indices,
+            return_distance,
+            sort_results,
+        )
+
+    def count_radius(
+        self, query_points: np.ndarray[np.float64], r: float
+    ) -> np.ndarray[np.int64]:
+        return np.asarray(
+            self.kdtree.query_ball_point(
+                query_points, r, workers=self.workers, return_length=True
+            ),
+            dtype=np.int64,
+        )
+
+
+class BruteForceSpatialIndex:
+    """
+    Exhaustive search on blocks of query points, faster than the trees on tiny point clouds.
+    """
+
+    def __init__(
+        self, points: np.ndarray[np.float64], block_size: int = 2**22
+    ) -> None:
+        """
+        Args:
+            points: The point cloud to index.
+            block_size: Maximum number of distances computed at once.
+        """
+        self.points = np.asarray(points, dtype=np.float64)
+        self.block_size = block_size
+        # the distances are expanded as |q|² - 2q.p + |p|², which cancels catastrophically far from the origin (e.g.
+        # georeferenced coordinates), hence the expansion is computed on points centered on the point cloud
+        self.center = (
+            self.points.mean(axis=0) if self.points.shape[0] > 0 else np.zeros(3)
+        )
+        self.centered_points = self.points - self.center
+        self.sq_norms = np.einsum(
+            "ij,ij->i", self.centered_points, self.centered_points
+        )
+
+    def iter_distances(
+        self, query_points: np.ndarray[np.float64]
+    ) -> Iterator[tuple[int, np.ndarray[np.float64]]]:
+        """
+        Yields the index of the first query point of each block and the distances between its points and the cloud.
+        """
+        n_queries_per_block = max(1, self.block_size // max(self.points.shape[0], 1))
+        for start in range(0, query_points.shape[0], n_queries_per_block):
+            block = query_points[start : start + n_queries_per_block] - self.center
+            yield start, np.sqrt(
+                np.maximum(
+                    np.einsum("ij,ij->i", block, block)[:, None]
+                    - 2 * block @ self.centered_points.T
+                    + self.sq_norms[None, :],
+                    0,
+                )
+            )
+
+    def iter_neighbors(
+        self, query_points: np.ndarray[np.float64], r: float
+    ) -> Iterator[tuple[np.ndarray[np.int64], np.ndarray[np.int64]]]:
+        """
+        Yields the sizes of the neighborhoods of each block of query points and the concatenation of these
+        neighborhoods. The expanded distances only preselect the candidates, with a margin bounding their rounding
+        errors, and the neighbors are confirmed with the exact distances like in the other backends.
+        """
+        for start, distances in self.iter_distances(query_points):
+            block = query_points[start : start + distances.shape[0]]
+            centered_block = block - self.center
+            tolerance = np.sqrt(
+                8
+                * np.finfo(np.float64).eps
+                * (
+                    self.sq_norms.max(initial=0)
+                    + np.einsum("ij,ij->i", centered_block, centered_block).max(
+                        initial=0
+                    )
+                )
+            )
+            query_ids, candidates = np.nonzero(distances <= r + tolerance)
+            is_neighbor = (
+                np.linalg.norm(self.points[candidates] - block[query_ids], axis=1) <= r
+            )
+            yield np.bincount(
+                query_ids[is_neighbor], minlength=block.shape[0]
+            ), candidates[is_neighbor]
+
+    def query(
+        self,
+        query_points: np.ndarray[np.float64],
+        k: int = 1,
+        return_distance: bool = True,
+    ) -> np.ndarray[np.int64] | tuple[np.ndarray[np.float64], np.ndarray[np.int64]]:
+        query_points = np.atleast_2d(query_points)
+        all_distances = np.zeros((query_points.shape[0], k))
+        all_indices = np.zeros((query_points.shape[0], k), dtype=np.int64)
+        for start, distances in self.iter_distances(query_points):
+            indices = (
+                np.argpartition(distances, k - 1, axis=1)[:, :k]
+                if k < distances.shape[1]
+                else np.broadcast_to(np.arange(k), (distances.shape[0], k))
+            )
+            indices = np.take_along_axis(
+                indices,
+                np.argsort(np.take_along_axis(distances, indices, axis=1), axis=1),
+                axis=1,
+            )
+            all_indices[start : start + indices.shape[0]] = indices
+            # exact distances to the selected neighbors
+            all_distances[start : start + indices.shape[0]] = np.linalg.norm(
+                self.points[indices]
+                - query_points[start : start + indices.shape[0], None, :],
+                axis=2,
+            )
+        return (all_distances, all_indices) if return_distance else all_indices
+
+    def query_radius(
+        self,
+        query_points: np.ndarray[np.float64],
+        r: float,
+        return_distance: bool = False,
+        sort_results: bool = False,
+    ) -> np.ndarray[np.object_] | tuple[np.ndarray[np.object_], np.ndarray[np.object_]]:
+        query_points = np.atleast_2d(query_points)
+        neighborhood_sizes, indices = [np.zeros(0, dtype=np.int64)], [
+            np.zeros(0, dtype=np.int64)
+        ]
+        for block_neighborhood_sizes, block_indices in self.iter_neighbors(
+            query_points, r
+        ):
+            neighborhood_sizes.append(block_neighborhood_sizes)
+            indices.append(block_indices)
+        return split_neighborhoods(
+            query_points,
+            self.points,
+            np.concatenate(neighborhood_sizes),
+            np.concatenate(indices),
+            return_distance,
+            sort_results,
+        )
+
+    def count_radius(
+        self, query_points: np.ndarray[np.float64], r: float
+    ) -> np.ndarray[np.int64]:
+        query_points = np.atleast_2d(query_points)
+        return np.concatenate(
+            [np.zeros(0, dtype=np.int64)]
+            + [
+                neighborhood_sizes
+                for neighborhood_sizes, _ in self.iter_neighbors(query_points, r)
+            ]
+        )
+
+
+class VoxelHashSpatialIndex:
+    """
+    Uniform grid whose cells are as large as the query radius, hashed by the packed integer coordinates of the cells.
+    The neighbors of a query point are searched in the 27 cells around its own with vectorized gathers, which beats the
+    trees on both build and query time on dense and near-uniform point clouds. A grid is built for each radius queried,
+    and the last max_grids ones are kept.
+    The k-nearest neighbors queries, which do not have a fixed radius, are delegated to a cKDTree built on first use.
+    """
+
+    neighbor_cells_offsets = np.stack(
+        np.meshgrid(*[np.arange(-1, 2)] * 3, indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+
+    def __init__(
+        self,
+        points: np.ndarray[np.float64],
+        max_grids: int = 4,
+        block_size: int = 2**22,
+    ) -> None:
+        """
+        Args:
+            points: The point cloud to index.
+            max_grids: Maximum number of grids (one per radius) kept in cache.
+            block_size: Maximum number of candidate neighbors gathered at once. The cells around the query points are
+            looked up for block_size // 256 query points at once.
+        """
+        self.points = np.asarray(points, dtype=np.float64)
+        self.max_grids = max_grids
+        self.block_size = block_size
+        self.grids: OrderedDict[
+            float,
+            tuple[
+                np.ndarray[np.float64],
+                np.ndarray[np.int64],
+                np.ndarray[np.int64],
+                np.ndarray[np.int64],
+                np.ndarray[np.int64],
+            ],
+        ] = OrderedDict()
+        self.kdtree: ScipySpatialIndex | None = None
+
+    def get_grid(
+        self, cell_size: float
+    ) -> tuple[
+        np.ndarray[np.float64],
+        np.ndarray[np.int64],
+        np.ndarray[np.int64],
+        np.ndarray[np.int64],
+        np.ndarray[np.int64],
+    ]:
+        """
+        Retrieves the grid with a given cell size, building it if it is not in cache.
+
+        Args:
+            cell_size: The size of the cells.
+
+        Returns:
+            origin: The origin of the grid.
+            grid_shape: The number of cells along each axis.
+            cell_keys: The sorted keys of the non-empty cells.
+            cell_starts: (n_cells + 1,) array such that the points of cell i are order[cell_starts[i]:cell_starts[i + 1]].
+            order: The indices of the points sorted by cell.
+        """
+        if cell_size in self.grids:
+            self.grids.move_to_end(cell_size)
+            return self.grids[cell_size]
+
+        # a margin of one cell keeps the coordinates of the cells adjacent to the points non-negative
+        origin = np.min(self.points, axis=0) - cell_size
+        cells_coordinates = ((self.points - origin) // cell_size).astype(np.int64)
+        grid_shape = np.max(cells_coordinates, axis=0) + 2
+        if np.prod(grid_shape.astype(np.float64)) >= np.iinfo(np.int64).max:
+            raise ValueError(
+                f"The grid with a cell size of {cell_size} is too large to be hashed, use another backend."
+            )
+        keys = np.ravel_multi_index(cells_coordinates.T, grid_shape)
+        order = np.argsort(keys, kind="stable")
+        cell_keys, cell_starts = np.unique(keys[order], return_index=True)
+        grid = (
+            origin,
+            grid_shape,
+            cell_keys,
+            np.append(cell_starts, self.points.shape[0]),
+            order,
+        )
+
+        self.grids[cell_size] = grid
+        if len(self.grids) > self.max_grids:
+            self.grids.popitem(last=False)
+        return grid
+
+    def query_radius_csr(
+        self,
+        query_points: np.ndarray[np.float64],
+        r: float,
+        return_distance: bool = False,
+        sort_results: bool = False,
+    ) -> tuple[np.ndarray[np.int64], ...]:
+        """
+        Searches the neighborhoods of the query points and returns them in a flat (CSR) layout.
+
+        Args:
+            query_points: The points whose neighborhoods are searched.
+            r: The radius of the neighborhoods.
+            return_distance: Whether the distances to the neighbors should be returned.
+            sort_results: Whether the neighbors should be sorted by distance.
+
+        Returns:
+            indices: The concatenation of all the neighborhoods.
+            offsets: (n_query_points + 1,) array such that neighborhood i is indices[offsets[i]:offsets[i + 1]].
+            distances: The distances associated with indices, if return_distance is True.
+        """
+        query_points = np.atleast_2d(np.asarray(query_points, dtype=np.float64))
+        n_query_points = query_points.shape[0]
+        cell_size = r
+        if r <= 0:
+            # a null radius only retrieves the coincident points, which any grid does: the finest one that can be hashed
+            # keeps the candidates few
+            extent = np.ptp(self.points, axis=0).max() if self.points.shape[0] else 0
+            cell_size = extent / 2**20 if extent > 0 else 1.0
+        origin, grid_shape, cell_keys, cell_starts, order = self.get_grid(cell_size)
+
+        all_indices = [np.zeros(0, dtype=np.int64)]
+        all_query_ids = [np.zeros(0, dtype=np.int64)]
+        all_distances = [np.zeros(0)]
+        # the cells are looked up by blocks of query points, each one needing 27 cells
+        query_block_size = max(self.block_size // 256, 1)
+        for query_start in range(0, n_query_points, query_block_size):
+            block_query_points = query_points[
+                query_start : query_start + query_block_size
+            ]
+            n_block_query_points = block_query_points.shape[0]
+
+            # looking up the 27 cells around each query point
+            neighbor_cells = (
+                ((block_query_points - origin) // cell_size).astype(np.int64)[
+                    :, None, :
+                ]
+                + self.neighbor_cells_offsets[None, :, :]
+            )
+            is_in_grid = ((neighbor_cells >= 0) & (neighbor_cells < grid_shape)).all(
+                axis=2
+            )
+            neighbor_keys = np.where(
+                is_in_grid,
+                neighbor_cells
+                @ np.array([grid_shape[1] * grid_shape[2], grid_shape[2], 1]),
+                -1,
+            )
+            cells = np.minimum(
+                np.searchsorted(cell_keys, neighbor_keys), cell_keys.shape[0] - 1
+            )
+            is_found = is_in_grid & (cell_keys[cells] == neighbor_keys)
+            cells_starts = np.where(is_found, cell_starts[cells], 0)
+            cells_sizes = np.where(
+                is_found, cell_starts[cells + 1] - cell_starts[cells], 0
+            )
+
+            # gathering the candidates by blocks of query points
+            cumulated_sizes = np.cumsum(cells_sizes.sum(axis=1))
+            n_blocks = int(cumulated_sizes[-1] // self.block_size) + 1
+            blocks_bounds = np.unique(
+                np.concatenate(
+                    (
+                        [0],
+                        np.searchsorted(
+                            cumulated_sizes,
+                            np.arange(1, n_blocks) * self.block_size,
+                            side="right",
+                        ),
+                        [n_block_query_points],
+                    )
+                )
+            )
+            for start, stop in zip(blocks_bounds[:-1], blocks_bounds[1:]):
+                pairs_sizes = cells_sizes[start:stop].ravel()
+                pair_ids = np.repeat(np.arange(pairs_sizes.shape[0]), pairs_sizes)
+                positions = (
+                    cells_starts[start:stop].ravel()[pair_ids]
+                    + np.arange(pair_ids.shape[0])
+                    - np.repeat(np.cumsum(pairs_sizes) - pairs_sizes, pairs_sizes)
+                )
+                candidates = order[positions]
+                query_ids = (
+                    query_start
+                    + start
+                    + pair_ids // self.neighbor_cells_offsets.shape[0]
+                )
+                distances = np.linalg.norm(
+                    self.points[candidates] - query_points[query_ids], axis=1
+                )
+                is_neighbor = distances <= r
+                all_indices.append(candidates[is_neighbor])
+                all_query_ids.append(query_ids[is_neighbor])
+                all_distances.append(distances[is_neighbor])
+
+        indices, query_ids, distances = (
+            np.concatenate(all_indices),
+            np.concatenate(all_query_ids),
+            np.concatenate(all_distances),
+        )
+        if sort_results:
+            order_by_distance = np.lexsort((distances, query_ids))
+            indices, distances = (
+                indices[order_by_distance],
+                distances[order_by_distance],
+            )
+        offsets = np.zeros(n_query_points + 1, dtype=np.int64)
+        np.cumsum(np.bincount(query_ids, minlength=n_query_points), out=offsets[1:])
+        return (indices, offsets, distances) if return_distance else (indices, offsets)
+
+    def query(
+        self,
+        query_points: np.ndarray[np.float64],
+        k: int = 1,
+        return_distance: bool = True,
+    ) -> np.ndarray[np.int64] | tuple[np.ndarray[np.float64], np.ndarray[np.int64]]:
+        if self.kdtree is None:
+            self.kdtree = ScipySpatialIndex(self.points)
+        return self.kdtree.query(query_points, k=k, return_distance=return_distance)
+
+    def query_radius(
+        self,
+        query_points: np.ndarray[np.float64],
+        r: float,
+        return_distance: bool = False,
+        sort_results: bool = False,
+    ) -> np.ndarray[np.object_] | tuple[np.ndarray[np.object_], np.ndarray[np.object_]]:
+        indices, offsets, *distances = self.query_radius_csr(
+            query_points, r, return_distance=return_distance, sort_results=sort_results
+        )
+        neighborhoods = split_into_object_array(indices, offsets)
+        if not return_distance:
+            return neighborhoods
+        return neighborhoods, split_into_object_array(distances[0], offsets)
+
+    def count_radius(
+        self, query_points: np.ndarray[np.float64], r: float
+    ) -> np.ndarray[np.int64]:
+        return np.diff(self.query_radius_csr(query_points, r)[1])
+
+
+def query_radius_csr(
+    spatial_index: SpatialIndex,
+    query_points: np.ndarray[np.float64],
+    r: float,
+    return_distance: bool = False,
+    sort_results: bool = False,
+) -> tuple[np.ndarray[np.int64], ...]:
+    """
+    Searches neighborhoods in a flat (CSR) layout, directly if the spatial index supports it (see
+    VoxelHashSpatialIndex.query_radius_csr) or by concatenating the output of query_radius otherwise.
+
+    Args:
+        spatial_index: The spatial index built on the point cloud.
+        query_points: The points whose neighborhoods are searched.
+        r: The radius of the neighborhoods.
+        return_distance: Whether the distances to the neighbors should be returned.
+        sort_results: Whether the neighbors should be sorted by distance.
+
+    Returns:
+        indices: The concatenation of all the neighborhoods.
+        offsets: (n_query_points + 1,) array such that neighborhood i is indices[offsets[i]:offsets[i + 1]].
+        distances: The distances associated with indices, if return_distance is True.
+    """
+    if hasattr(spatial_index, "query_radius_csr"):
+        return spatial_index.query_radius_csr(
+            query_points, r, return_distance=return_distance, sort_results=sort_results
+        )
+    neighborhoods, *distances = (
+        spatial_index.query_radius(
+            query_points, r, return_distance=True, sort_results=sort_results
+        )
+        if return_distance
+        else (spatial_index.query_radius(query_points, r),)
+    )
+    offsets = np.zeros(len(neighborhoods) + 1, dtype=np.int64)
+    np.cumsum(
+        np.fromiter(map(len, neighborhoods), dtype=np.int64, count=len(neighborhoods)),
+        out=offsets[1:],
+    )
+    indices = (
+        np.concatenate(neighborhoods).astype(np.int64, copy=False)
+        if offsets[-1] > 0
+        else np.zeros(0, dtype=np.int64)
+    )
+    if not return_distance:
+        return indices, offsets
+    return (
+        indices,
+        offsets,
+        np.concatenate(distances[0]) if offsets[-1] > 0 else np.zeros(0),
+    )
+
+
+def set_default_spatial_index_backend(backend: SpatialIndexBackend) -> None:
+    """
+    Selects the backend used by the stages that are not given a backend of their own.
+    """
+    global default_spatial_index_backend
+    if backend not in ("sklearn", "scipy", "brute_force", "voxel_hash"):
+        raise ValueError(f"Incorrect spatial index backend: {backend}.")
+    default_spatial_index_backend = backend
+
+
+def create_spatial_index(
+    points: np.ndarray[np.float64], backend: SpatialIndexBackend | None = None
+) -> SpatialIndex:
+    """
+    Builds a spatial index on a point cloud.
+
+    Args:
+        points: The point cloud to index.
+        backend: The implementation to use. Leave empty to use the default backend.
+
+    Returns:
+        The spatial index.
+    """
+    backend = backend if backend is not None else default_spatial_index_backend
+    if backend == "sklearn":
+        return SklearnSpatialIndex(points)
+    if backend == "scipy":
+        return ScipySpatialIndex(points)
+    if backend == "brute_force":
+        return BruteForceSpatialIndex(points)
+    if backend == "voxel_hash":
+        return VoxelHashSpatialIndex(points)
+    raise ValueError(f"Incorrect spatial index backend: {backend}.")
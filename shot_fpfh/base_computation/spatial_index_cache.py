@@ -0,0 +1,58 @@
+from typing import Hashable
+
+import numpy as np
+
+from .spatial_index import SpatialIndex, SpatialIndexBackend, create_spatial_index
+
+
+class SpatialIndexCache:
+    """
+    Spatial indices built on point clouds and on subsets of them, memoized per point cloud, per subsampling and per
+    backend so that every stage working on the same points reuses the same index.
+    A point cloud is identified by the array object itself, a subset by a hashable name (for instance the voxel size of
+    a grid subsampling) along with the array of its indices, the index being rebuilt if another array is given.
+    """
+
+    def __init__(self) -> None:
+        self.entries: dict[
+            tuple[int, Hashable, SpatialIndexBackend | None],
+            tuple[np.ndarray[np.float64], np.ndarray[np.int64] | None, SpatialIndex],
+        ] = {}
+
+    def get(
+        self,
+        points: np.ndarray[np.float64],
+        subsampling: Hashable = None,
+        indices: np.ndarray[np.int64] | None = None,
+        backend: SpatialIndexBackend | None = None,
+    ) -> SpatialIndex:
+        """
+        Retrieves the spatial index built on a point cloud or on a subset of it, building it if it is not in cache.
+
+        Args:
+            points: The whole point cloud.
+            subsampling: The name of the subset. Leave empty for the whole point cloud.
+            indices: The indices of the points of the subset in the point cloud. Leave empty for the whole point cloud.
+            backend: The implementation of the spatial index. Leave empty to use the default backend.
+
+        Returns:
+            The spatial index built on points[indices].
+        """
+        key = (id(points), subsampling, backend)
+        # the cached arrays are kept alive by the entry, hence their ids cannot be reused by other arrays
+        if key in self.entries:
+            cached_points, cached_indices, spatial_index = self.entries[key]
+            if cached_points is points and cached_indices is indices:
+                return spatial_index
+
+        spatial_index = create_spatial_index(
+            points if indices is None else points[indices], backend
+        )
+        self.entries[key] = (points, indices, spatial_index)
+        return spatial_index
+
+    def clear(self) -> None:
+        """
+        Releases all the spatial indices.
+        """
+        self.entries.clear()
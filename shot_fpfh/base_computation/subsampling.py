@@ -1,38 +1,174 @@
+from collections import OrderedDict
+
 import numpy as np
 
 
+def get_voxel_keys(
+    points: np.ndarray[np.float64],
+    voxel_size: float,
+    origin: np.ndarray[np.float64] | None = None,
+) -> np.ndarray[np.int64]:
+    """
+    Packs the integer coordinates of the voxel containing each point in a single 64-bit key.
+    The keys are ordered like the lexicographic order of the voxel coordinates.
+    If the grid is too large to be packed in 64 bits, the keys are the ranks of the voxels in this order instead.
+
+    Args:
+        points: The point cloud.
+        voxel_size: The size of the voxels.
+        origin: The origin of the grid. Leave empty to use the minimum coordinates of the points.
+
+    Returns:
+        The key of the voxel of each point.
+    """
+    if origin is None:
+        origin = np.min(points, axis=0)
+    voxel_coordinates = ((points - origin) // voxel_size).astype(np.int64)
+    voxel_coordinates -= np.min(voxel_coordinates, axis=0)
+    grid_shape = np.max(voxel_coordinates, axis=0) + 1
+    if np.prod(grid_shape.astype(np.float64)) >= np.iinfo(np.int64).max:
+        return np.unique(voxel_coordinates, axis=0, return_inverse=True)[1].reshape(
+            -1
+        )
+    return np.ravel_multi_index(voxel_coordinates.T, grid_shape)
+
+
+def sum_over_voxels(
+    sorted_points: np.ndarray[np.float64],
+    voxel_starts: np.ndarray[np.int64],
+    nb_pts_per_voxel: np.ndarray[np.int64],
+    min_batch_size: int = 64,
+) -> np.ndarray[np.float64]:
+    """
+    Sums the points of each voxel one point after the other, in the same order and hence with the same rounding as
+    points[indexes_in_voxel].sum(axis=0) (np.add.reduceat rounds differently).
+    The j-th points of all the voxels with more than j points are added at once, and the few voxels left when fewer
+    than min_batch_size voxels remain are summed one by one.
+
+    Args:
+        sorted_points: The points sorted by voxel.
+        voxel_starts: The index of the first point of each voxel in sorted_points.
+        nb_pts_per_voxel: The number of points of each voxel.
+        min_batch_size: The minimum number of voxels whose points are added at once.
+
+    Returns:
+        The sum of the points of each voxel.
+    """
+    sums = np.zeros((voxel_starts.shape[0], sorted_points.shape[1]))
+    by_size = np.argsort(-nb_pts_per_voxel, kind="stable")
+    sizes = nb_pts_per_voxel[by_size]
+    starts = voxel_starts[by_size]
+    n_added = 0
+    # number of voxels with more than j points, for each j
+    n_active = np.searchsorted(-sizes, -np.arange(sizes[0] if sizes.shape[0] else 0))
+    while n_added < n_active.shape[0] and n_active[n_added] >= min_batch_size:
+        sums[by_size[: n_active[n_added]]] += sorted_points[
+            starts[: n_active[n_added]] + n_added
+        ]
+        n_added += 1
+    for voxel in by_size[: n_active[n_added] if n_added < n_active.shape[0] else 0]:
+        sums[voxel] = sorted_points[
+            voxel_starts[voxel] : voxel_starts[voxel] + nb_pts_per_voxel[voxel]
+        ].sum(axis=0)
+    return sums
+
+
 def grid_subsampling(
-    points: np.ndarray[np.float64], voxel_size: float
-) -> np.ndarray[np.int32]:
+    points: np.ndarray[np.float64],
+    voxel_size: float,
+    origin: np.ndarray[np.float64] | None = None,
+) -> np.ndarray[np.int64]:
     """
     Performs a voxel subsampling on the point cloud.
     Keeps the point closest to the barycenter of the points in each voxel.
+    The grid starts at the minimum coordinates of the points unless an origin is given.
+    The voxels are returned in the lexicographic order of their coordinates, and the points kept are the same as the
+    ones of the per-voxel loop: the points are ordered by voxel with the same sort, and the first point reaching the
+    minimum distance to the barycenter in this order is kept.
     """
-    non_empty_voxel_keys, inverse, nb_pts_per_voxel = np.unique(
-        ((points - np.min(points, axis=0)) // voxel_size).astype(int),
-        axis=0,
-        return_inverse=True,
-        return_counts=True,
+    # dense ranks of the voxels, sorted by the default sort like the per-voxel loop to break the ties alike
+    voxel_ranks = np.unique(
+        get_voxel_keys(points, voxel_size, origin), return_inverse=True
+    )[1].reshape(-1)
+    order = np.argsort(voxel_ranks)
+    sorted_ranks = voxel_ranks[order]
+    voxel_starts = np.flatnonzero(
+        np.concatenate(([True], sorted_ranks[1:] != sorted_ranks[:-1]))
     )
+    nb_pts_per_voxel = np.diff(np.append(voxel_starts, points.shape[0]))
+    voxel_ids = np.repeat(np.arange(voxel_starts.shape[0]), nb_pts_per_voxel)
 
-    idx_pts_vox_sorted = np.argsort(inverse)
-    sub_sampled_points_idx = []
+    sorted_points = points[order]
+    barycenters = (
+        sum_over_voxels(sorted_points, voxel_starts, nb_pts_per_voxel)
+        / nb_pts_per_voxel[:, None]
+    )
+    distances = np.linalg.norm(sorted_points - barycenters[voxel_ids], axis=1)
 
-    last_seen = 0
-    for idx in range(len(non_empty_voxel_keys)):
-        indexes_in_voxel = idx_pts_vox_sorted[
-            last_seen : last_seen + nb_pts_per_voxel[idx]
-        ]
-        # point closest to the barycenter
-        sub_sampled_points_idx.append(
-            indexes_in_voxel[
-                np.linalg.norm(
-                    points[indexes_in_voxel] - points[indexes_in_voxel].mean(axis=0),
-                    axis=1,
-                ).argmin()
-            ]
-        )
+    # segment-wise argmin: first point of each voxel reaching the minimum distance of its voxel
+    is_closest = distances == np.minimum.reduceat(distances, voxel_starts)[voxel_ids]
+    closest = np.flatnonzero(is_closest)
+    first_closest = closest[
+        np.concatenate(([True], voxel_ids[closest[1:]] != voxel_ids[closest[:-1]]))
+    ]
+    return order[first_closest]
+
+
+class VoxelPyramid:
+    """
+    Grid subsamplings of a point cloud memoized per voxel size, with a least-recently-used eviction.
+    With derive_coarser_levels, a new level is computed by subsampling the finest cached level that is finer than it
+    instead of the whole point cloud, which is faster but only approximates grid_subsampling.
+    """
+
+    def __init__(
+        self,
+        points: np.ndarray[np.float64],
+        max_levels: int = 8,
+        derive_coarser_levels: bool = False,
+    ) -> None:
+        """
+        Attaches the pyramid to a point cloud.
+
+        Args:
+            points: The point cloud to subsample.
+            max_levels: Maximum number of subsamplings kept in cache.
+            derive_coarser_levels: Whether new levels should be derived from finer cached levels.
+        """
+        self.points = points
+        self.max_levels = max_levels
+        self.derive_coarser_levels = derive_coarser_levels
+        self.levels: OrderedDict[float, np.ndarray[np.int32]] = OrderedDict()
+
+    def subsample(self, voxel_size: float) -> np.ndarray[np.int32]:
+        """
+        Retrieves the indices of the points kept by a grid subsampling, computing them if they are not in cache.
 
-        last_seen += nb_pts_per_voxel[idx]
+        Args:
+            voxel_size: The size of the voxels.
+
+        Returns:
+            The indices of the points kept in the point cloud.
+        """
+        if voxel_size in self.levels:
+            self.levels.move_to_end(voxel_size)
+            return self.levels[voxel_size]
+
+        finer_voxel_sizes = [size for size in self.levels if size < voxel_size]
+        if self.derive_coarser_levels and finer_voxel_sizes:
+            finer_level = self.levels[max(finer_voxel_sizes)]
+            # sharing the origin of the grid keeps the voxels of the coarser levels aligned with the ones of the finer
+            indices = finer_level[
+                grid_subsampling(
+                    self.points[finer_level],
+                    voxel_size,
+                    origin=np.min(self.points, axis=0),
+                )
+            ]
+        else:
+            indices = grid_subsampling(self.points, voxel_size)
 
-    return np.array(sub_sampled_points_idx)
+        self.levels[voxel_size] = indices
+        if len(self.levels) > self.max_levels:
+            self.levels.popitem(last=False)
+        return indices
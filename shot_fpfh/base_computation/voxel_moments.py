@@ -0,0 +1,138 @@
+"""
+Sufficient statistics of the points of a point cloud aggregated per voxel, used to approximate the covariance matrices
+of large spherical neighborhoods from the few voxels they overlap instead of the individual points they contain.
+"""
+import numpy as np
+
+from .neighborhoods import get_segment_ids
+from .spatial_index import create_spatial_index, query_radius_csr
+from .subsampling import get_voxel_keys
+
+
+class VoxelMomentGrid:
+    """
+    Count, sum and sum of outer products of the points of each voxel of a regular grid.
+    The sums are stored as the barycenter and the scatter matrix (sum of the outer products of the coordinates centered
+    on the barycenter) of each voxel, which carry the same information without the cancellations of raw coordinates.
+    A spherical neighborhood is approximated by the voxels whose barycenter lies inside the sphere: the smaller the
+    voxels, the more accurate and the more expensive the approximation, the cost of a query being proportional to the
+    number of voxels rather than the number of points in the sphere.
+    """
+
+    def __init__(self, points: np.ndarray[np.float64], voxel_size: float) -> None:
+        """
+        Accumulates the statistics of every non-empty voxel.
+
+        Args:
+            points: The point cloud.
+            voxel_size: The size of the voxels.
+        """
+        self.voxel_size = voxel_size
+        _, voxel_ids, self.counts = np.unique(
+            get_voxel_keys(points, voxel_size), return_inverse=True, return_counts=True
+        )
+        voxel_ids = voxel_ids.reshape(-1)
+        n_voxels = self.counts.shape[0]
+
+        self.barycenters = (
+            np.bincount(
+                (voxel_ids[:, None] * 3 + np.arange(3)).ravel(),
+                weights=points.ravel(),
+                minlength=n_voxels * 3,
+            ).reshape(n_voxels, 3)
+            / self.counts[:, None]
+        )
+        centered_points = points - self.barycenters[voxel_ids]
+        self.scatter_matrices = np.bincount(
+            (voxel_ids[:, None] * 9 + np.arange(9)).ravel(),
+            weights=(centered_points[:, :, None] * centered_points[:, None, :]).ravel(),
+            minlength=n_voxels * 9,
+        ).reshape(n_voxels, 3, 3)
+        self.kdtree = create_spatial_index(self.barycenters)
+
+    def query_radius(
+        self, query_points: np.ndarray[np.float64], radius: float
+    ) -> tuple[np.ndarray[np.int64], np.ndarray[np.int64]]:
+        """
+        Finds the voxels approximating the spherical neighborhood of each query point.
+
+        Args:
+            query_points: The centers of the neighborhoods.
+            radius: The radius of the neighborhoods.
+
+        Returns:
+            The indices of the voxels in a flat (CSR) layout (indices, offsets).
+        """
+        return query_radius_csr(self.kdtree, query_points, radius)
+
+    def get_moments(
+        self,
+        query_points: np.ndarray[np.float64],
+        indices: np.ndarray[np.int64],
+        offsets: np.ndarray[np.int64],
+    ) -> tuple[np.ndarray[np.float64], np.ndarray[np.float64]]:
+        """
+        Expresses the statistics of the voxels of each neighborhood relative to its center.
+
+        Args:
+            query_points: The centers of the neighborhoods.
+            indices: The indices of the voxels of the neighborhoods in a flat layout, as returned by query_radius.
+            offsets: The offsets of the flat layout.
+
+        Returns:
+            displacements: (indices.shape[0], 3) array of the barycenters of the voxels minus the center of their
+            neighborhood. The sum of the centered points of a voxel is its count times its displacement.
+            second_moments: (indices.shape[0], 3, 3) array of the sums of the outer products of the points of the
+            voxels centered on the center of their neighborhood.
+        """
+        displacements = self.barycenters[indices] - query_points[get_segment_ids(offsets)]
+        second_moments = (
+            self.scatter_matrices[indices]
+            + self.counts[indices, None, None]
+            * displacements[:, :, None]
+            * displacements[:, None, :]
+        )
+        return displacements, second_moments
+
+    def get_covariance_matrices(
+        self, query_points: np.ndarray[np.float64], radius: float
+    ) -> tuple[np.ndarray[np.int64], np.ndarray[np.float64], np.ndarray[np.float64]]:
+        """
+        Approximates the covariance matrices of the spherical neighborhoods of the query points.
+
+        Args:
+            query_points: The centers of the neighborhoods.
+            radius: The radius of the neighborhoods.
+
+        Returns:
+            neighborhood_sizes: (N,) array of the number of points of each neighborhood.
+            barycenters: (N, 3) array of the barycenters of the neighborhoods.
+            cov_matrices: (N, 3, 3) array of the covariance matrices, equal to 0 for empty neighborhoods.
+        """
+        n_points = query_points.shape[0]
+        indices, offsets = self.query_radius(query_points, radius)
+        segment_ids = get_segment_ids(offsets)
+        displacements, second_moments = self.get_moments(query_points, indices, offsets)
+
+        neighborhood_sizes = np.bincount(
+            segment_ids, weights=self.counts[indices], minlength=n_points
+        ).astype(np.int64)
+        normalization = np.maximum(neighborhood_sizes, 1)
+        mean_displacements = (
+            np.bincount(
+                (segment_ids[:, None] * 3 + np.arange(3)).ravel(),
+                weights=(self.counts[indices, None] * displacements).ravel(),
+                minlength=n_points * 3,
+            ).reshape(n_points, 3)
+            / normalization[:, None]
+        )
+        cov_matrices = (
+            np.bincount(
+                (segment_ids[:, None] * 9 + np.arange(9)).ravel(),
+                weights=second_moments.ravel(),
+                minlength=n_points * 9,
+            ).reshape(n_points, 3, 3)
+            / normalization[:, None, None]
+            - mean_displacements[:, :, None] * mean_displacements[:, None, :]
+        )
+        return neighborhood_sizes, query_points + mean_displacements, cov_matrices
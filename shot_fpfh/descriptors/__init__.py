@@ -1,5 +1,8 @@
-from .fpfh import compute_fpfh_descriptor
+from .fpfh import SpfhCache, compute_fpfh_descriptor
+from .fpfh_parallelization import FpfhMultiprocessor
 from .pca_based_descriptors import (
+    batched_pca,
+    get_neighborhoods,
     compute_pca_based_basic_features,
     compute_pca_based_features,
     compute_normals,
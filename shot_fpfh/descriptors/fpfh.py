@@ -6,9 +6,72 @@ Fast Point Feature Histograms (FPFH) for 3D registration,
 """
 
 import numpy as np
-from sklearn.neighbors import KDTree
+from scipy.sparse import csr_matrix
 from tqdm import tqdm
 
+from shot_fpfh.base_computation import (
+    NeighborhoodGraph,
+    SpatialIndex,
+    as_neighborhood_graph,
+    create_spatial_index,
+    get_segment_ids,
+)
+from shot_fpfh.utils import (
+    Executor,
+    SerialExecutor,
+    SharedArrayHandle,
+    attach_shared_arrays,
+)
+from .numba_kernels import Backend, compute_spfh_numba, resolve_backend
+
+
+class SpfhCache:
+    """
+    SPFH of the points of a point cloud, keyed by point index, kept between calls to compute_fpfh_descriptor in lazy
+    mode so that incremental calls only compute the histograms of the points they have not seen yet.
+    A cache is tied to a point cloud and to the parameters of the SPFH.
+    """
+
+    def __init__(self) -> None:
+        self.indices = np.zeros(0, dtype=np.int64)  # sorted
+        self.spfh = np.zeros((0, 0))
+        self.parameters: tuple[float, int, bool] | None = None
+
+    def check_parameters(self, radius: float, n_bins: int, decorrelated: bool) -> None:
+        """
+        Checks that the cache was filled with the same parameters, or binds the cache to these parameters if empty.
+        """
+        if self.parameters is None:
+            self.parameters = (radius, n_bins, decorrelated)
+            self.spfh = np.zeros((0, n_bins * 3 if decorrelated else n_bins**3))
+        elif self.parameters != (radius, n_bins, decorrelated):
+            raise ValueError(
+                f"The SPFH cache was filled with different parameters: {self.parameters}."
+            )
+
+    def contains(self, indices: np.ndarray[np.int64]) -> np.ndarray[bool]:
+        """
+        Checks which points have their SPFH in cache.
+        """
+        return np.isin(indices, self.indices)
+
+    def get(self, indices: np.ndarray[np.int64]) -> np.ndarray[np.float64]:
+        """
+        Retrieves the SPFH of points that are in cache.
+        """
+        return self.spfh[np.searchsorted(self.indices, indices)]
+
+    def update(
+        self, indices: np.ndarray[np.int64], spfh: np.ndarray[np.float64]
+    ) -> None:
+        """
+        Adds the SPFH of points that are not in cache yet.
+        """
+        all_indices = np.concatenate((self.indices, indices))
+        order = np.argsort(all_indices, kind="stable")
+        self.indices = all_indices[order]
+        self.spfh = np.vstack((self.spfh, spfh))[order]
+
 
 def compute_fpfh_descriptor(
     keypoints_indices: np.ndarray[np.int32],
@@ -19,96 +82,424 @@ def compute_fpfh_descriptor(
     decorrelated: bool = False,
     verbose: bool = True,
     disable_progress_bars: bool = True,
+    backend: Backend = "numpy",
+    executor: Executor | None = None,
+    lazy: bool = False,
+    spfh_cache: SpfhCache | None = None,
+    kdtree: SpatialIndex | None = None,
+    neighborhoods: NeighborhoodGraph | None = None,
 ) -> np.ndarray[np.float64]:
-    kdtree = KDTree(cloud_points)
+    """
+    Computes the FPFH descriptors of the keypoints.
+    A spatial index already built on the point cloud can be given to avoid building it again, or directly the
+    neighborhoods of all the points of the point cloud at this radius, with their distances, to skip the radius searches.
+    With the NumPy backend, the SPFH histograms and the FPFH are computed by blocks of points on the executor (serially
+    if none is given). The Numba backend uses a parallel compiled kernel instead (and falls back to NumPy if Numba is not
+    installed).
+    In lazy mode, the SPFH are only computed on the keypoints and their neighbors, which are the only ones the FPFH
+    read. A cache can then be given to reuse the SPFH computed by previous calls on the same point cloud.
+    The SPFH of the neighbors are aggregated into the FPFH with a single product with a sparse weight matrix.
+    """
+    def search_neighborhoods(
+        query_indices: np.ndarray[np.int64], return_distance: bool
+    ) -> NeighborhoodGraph:
+        if neighborhoods is not None:
+            return neighborhoods.select(query_indices)
+        return NeighborhoodGraph.search(
+            kdtree, cloud_points[query_indices], radius, return_distance
+        )
 
-    neighborhoods, distances = kdtree.query_radius(
-        cloud_points, radius, return_distance=True
+    if kdtree is None and neighborhoods is None:
+        kdtree = create_spatial_index(cloud_points)
+
+    if lazy:
+        keypoints_neighborhoods = search_neighborhoods(keypoints_indices, True)
+        spfh_indices = np.union1d(keypoints_indices, keypoints_neighborhoods.indices)
+    else:
+        spfh_indices = np.arange(cloud_points.shape[0])
+
+    if lazy and spfh_cache is not None:
+        spfh_cache.check_parameters(radius, n_bins, decorrelated)
+        query_indices = spfh_indices[~spfh_cache.contains(spfh_indices)]
+    else:
+        query_indices = spfh_indices
+
+    # the distances are only needed to aggregate the FPFH from these neighborhoods when all the points are queried
+    query_neighborhoods = (
+        neighborhoods
+        if neighborhoods is not None and not lazy
+        else search_neighborhoods(query_indices, not lazy)
     )
-    spfh = np.zeros(
-        (cloud_points.shape[0], n_bins * 3)
-        if decorrelated
-        else (cloud_points.shape[0], n_bins, n_bins, n_bins)
+    spfh = compute_spfh_of_points(
+        cloud_points,
+        normals,
+        query_indices,
+        query_neighborhoods,
+        n_bins,
+        decorrelated,
+        backend,
+        executor,
+        disable_progress_bars,
     )
-    neighborhood_size = 0
-
-    for i, point in tqdm(
-        enumerate(cloud_points),
-        desc="SPFH",
-        total=cloud_points.shape[0],
-        disable=disable_progress_bars,
-    ):
-        if neighborhoods[i].shape[0] > 0:
-            neighbors = cloud_points[neighborhoods[i]]
-            neighbors_normals = normals[neighborhoods[i]]
-            centered_neighbors = neighbors - point
-            dist = np.linalg.norm(centered_neighbors, axis=1)
-            u = normals[i]
-            v = np.cross(centered_neighbors[dist > 0], u)
-            w = np.cross(u, v)
-            alpha = np.einsum("ij,ij->i", v, neighbors_normals[dist > 0])
-            phi = centered_neighbors[dist > 0].dot(u) / dist[dist > 0]
-            theta = np.arctan2(
-                np.einsum("ij,ij->i", neighbors_normals[dist > 0], w),
-                neighbors_normals[dist > 0].dot(u),
-            )
-            if decorrelated:
-                spfh[i, :] = (
-                    np.vstack(
-                        (
-                            np.histogram(
-                                alpha,
-                                bins=n_bins,
-                                range=(-1, 1),
-                            )[0],
-                            np.histogram(
-                                phi,
-                                bins=n_bins,
-                                range=(-1, 1),
-                            )[0],
-                            np.histogram(
-                                theta,
-                                bins=n_bins,
-                                range=(-np.pi / 2, np.pi / 2),
-                            )[0],
-                        )
-                    ).T
-                    / neighborhoods[i].shape[0]
-                )
-            else:
-                spfh[i, :, :, :] = (
-                    np.histogramdd(
-                        np.vstack((alpha, phi, theta)).T,
-                        bins=n_bins,
-                        range=[(-1, 1), (-1, 1), (-np.pi / 2, np.pi / 2)],
-                    )[0]
-                    / neighborhoods[i].shape[0]
-                )
-            neighborhood_size += neighborhoods[i].shape[0]
+    if lazy and spfh_cache is not None:
+        spfh_cache.update(query_indices, spfh)
+        spfh = spfh_cache.get(spfh_indices)
 
     if verbose:
         print(
-            f"Mean neighborhood size over the whole point cloud: {neighborhood_size / cloud_points.shape[0]:.2f}"
+            f"Mean neighborhood size over the {query_indices.shape[0]} points whose SPFH was computed: "
+            f"{query_neighborhoods.offsets[-1] / max(query_indices.shape[0], 1):.2f}"
         )
 
-    spfh = spfh.reshape(cloud_points.shape[0], -1)
-    fpfh = np.zeros(
-        (keypoints_indices.shape[0], n_bins * 3 if decorrelated else n_bins**3)
+    if lazy:
+        # position of the points in the rows of the SPFH
+        keypoints_rows = np.searchsorted(spfh_indices, keypoints_indices)
+        keypoints_neighborhoods = NeighborhoodGraph(
+            np.searchsorted(spfh_indices, keypoints_neighborhoods.indices),
+            keypoints_neighborhoods.offsets,
+            keypoints_neighborhoods.distances,
+        )
+    else:
+        keypoints_rows = keypoints_indices
+        keypoints_neighborhoods = query_neighborhoods.select(keypoints_indices)
+
+    return aggregate_fpfh(
+        spfh, keypoints_rows, keypoints_neighborhoods, executor=executor
     )
-    for i, neighborhood in tqdm(
-        enumerate(neighborhoods[keypoints_indices]),
-        desc="FPFH",
-        total=keypoints_indices.shape[0],
-        delay=0.5,
-        disable=disable_progress_bars,
-    ):
-        with np.errstate(invalid="ignore", divide="ignore"):
-            fpfh[i] = (
-                spfh[keypoints_indices[i]]
-                # should be ok to encounter a RuntimeWarning here since we apply a mask after the divide
-                + (spfh[neighborhood] / distances[keypoints_indices[i]][:, None])[
-                    distances[keypoints_indices[i]] > 0
-                ].sum(axis=0)
-                / neighborhood.shape[0]
+
+
+def aggregate_fpfh(
+    spfh: np.ndarray[np.float64],
+    keypoints_rows: np.ndarray[np.int64],
+    neighborhoods: NeighborhoodGraph | tuple[np.ndarray[np.int64], np.ndarray[np.int64]],
+    distances: np.ndarray[np.float64] | None = None,
+    executor: Executor | None = None,
+) -> np.ndarray[np.float64]:
+    """
+    Aggregates the SPFH into the FPFH of the keypoints: spfh[keypoints] + W @ spfh, W being the sparse weight matrix
+    built by get_fpfh_weights. With an executor, the keypoints are split in blocks that are aggregated in parallel.
+
+    Args:
+        spfh: The SPFH matrix.
+        keypoints_rows: The rows of the keypoints in the SPFH matrix.
+        neighborhoods: The neighborhoods of the keypoints as a NeighborhoodGraph, or in a flat layout as a tuple
+        (indices, offsets). The indices are the rows of the neighbors in the SPFH matrix.
+        distances: The distances between the keypoints and their neighbors in the same flat layout. Leave empty to use
+        the ones of the graph.
+        executor: The executor to run the aggregation on. Leave empty to aggregate all the keypoints at once.
+
+    Returns:
+        The FPFH of the keypoints.
+    """
+    neighborhoods = as_neighborhood_graph(neighborhoods)
+    if distances is None:
+        distances = neighborhoods.distances
+    if executor is None:
+        return spfh[keypoints_rows] + get_fpfh_weights(
+            neighborhoods, distances, spfh.shape[0]
+        ) @ spfh
+
+    n_keypoints = keypoints_rows.shape[0]
+    block_size = max(int(np.ceil(n_keypoints / (2 * executor.n_procs))), 1)
+    with executor.share(
+        spfh=spfh,
+        keypoints_rows=keypoints_rows,
+        indices=neighborhoods.indices,
+        offsets=neighborhoods.offsets,
+        distances=distances,
+    ) as handles:
+        return np.vstack(
+            [np.zeros((0, spfh.shape[1]))]
+            + list(
+                executor.imap(
+                    compute_fpfh_on_shared_block,
+                    (
+                        (handles, start, min(start + block_size, n_keypoints))
+                        for start in range(0, n_keypoints, block_size)
+                    ),
+                )
             )
-    return fpfh
+        )
+
+
+def compute_fpfh_on_shared_block(
+    values: tuple[dict[str, SharedArrayHandle | np.ndarray], int, int]
+) -> np.ndarray[np.float64]:
+    """
+    Aggregates the FPFH of a block of keypoints whose data was published by an executor.
+    Arguments are given in a tuple to allow for multiprocessing using multiprocessing.Pool.
+
+    Args:
+        values: (handles, start, stop). The handles refer to the SPFH, the rows of the keypoints in the SPFH, their
+        neighborhoods in a flat layout (indices and offsets) and the distances to their neighbors.
+
+    Returns:
+        The FPFH of the keypoints start to stop.
+    """
+    handles, start, stop = values
+    arrays = attach_shared_arrays(handles)
+    offsets = arrays["offsets"][start : stop + 1]
+    return arrays["spfh"][arrays["keypoints_rows"][start:stop]] + get_fpfh_weights(
+        (arrays["indices"][offsets[0] : offsets[-1]], offsets - offsets[0]),
+        arrays["distances"][offsets[0] : offsets[-1]],
+        arrays["spfh"].shape[0],
+    ) @ arrays["spfh"]
+
+
+def get_fpfh_weights(
+    neighborhoods: NeighborhoodGraph | tuple[np.ndarray[np.int64], np.ndarray[np.int64]],
+    distances: np.ndarray[np.float64],
+    n_columns: int,
+) -> csr_matrix:
+    """
+    Builds the sparse matrix that aggregates the SPFH of the neighbors of the keypoints into their FPFH.
+    The weight of a neighbor is the inverse of its distance to the keypoint, divided by the size of the neighborhood.
+    The keypoint itself (and any neighbor at a null distance) gets no weight.
+
+    Args:
+        neighborhoods: The neighborhoods of the keypoints as a NeighborhoodGraph, or in a flat layout as a tuple
+        (indices, offsets). The indices are the rows of the neighbors in the SPFH matrix.
+        distances: The distances between the keypoints and their neighbors in the same flat layout.
+        n_columns: The number of rows of the SPFH matrix.
+
+    Returns:
+        The (n_keypoints, n_columns) CSR weight matrix.
+    """
+    neighborhoods = as_neighborhood_graph(neighborhoods)
+    indices, offsets = neighborhoods.indices, neighborhoods.offsets
+    neighborhood_sizes = np.diff(offsets)
+    weights = np.zeros(distances.shape[0])
+    np.divide(
+        1,
+        distances * np.repeat(neighborhood_sizes, neighborhood_sizes),
+        out=weights,
+        where=distances > 0,
+    )
+    return csr_matrix(
+        (weights, indices, offsets), shape=(offsets.shape[0] - 1, n_columns)
+    )
+
+
+def compute_spfh_of_points(
+    cloud_points: np.ndarray[np.float64],
+    normals: np.ndarray[np.float64],
+    query_indices: np.ndarray[np.int64],
+    neighborhoods: NeighborhoodGraph | tuple[np.ndarray[np.int64], np.ndarray[np.int64]],
+    n_bins: int,
+    decorrelated: bool = False,
+    backend: Backend = "numpy",
+    executor: Executor | None = None,
+    disable_progress_bar: bool = True,
+) -> np.ndarray[np.float64]:
+    """
+    Computes the SPFH of a subset of the points of the point cloud with the selected backend.
+
+    Args:
+        cloud_points: The point cloud.
+        normals: The normals of the point cloud.
+        query_indices: The indices of the points to compute the SPFH of.
+        neighborhoods: The neighborhoods of the query points as a NeighborhoodGraph, or in a flat layout as a tuple
+        (indices, offsets).
+        n_bins: The number of bins of each feature.
+        decorrelated: Whether the three features are binned in separate histograms instead of a joint one.
+        backend: The backend of the computation.
+        executor: The executor that runs the NumPy backend by blocks of points. Leave empty to run serially.
+        disable_progress_bar: Whether the progress bar should be disabled.
+
+    Returns:
+        The SPFH of the query points.
+    """
+    neighborhoods = as_neighborhood_graph(neighborhoods)
+    indices, offsets = neighborhoods.indices, neighborhoods.offsets
+    if resolve_backend(backend) == "numba":
+        return compute_spfh_numba(
+            cloud_points, normals, query_indices, indices, offsets, n_bins, decorrelated
+        )
+
+    if executor is None:
+        executor = SerialExecutor()
+    n_points = query_indices.shape[0]
+    block_size = max(int(np.ceil(n_points / (2 * executor.n_procs))), 1)
+    blocks = [
+        (start, min(start + block_size, n_points))
+        for start in range(0, n_points, block_size)
+    ]
+    with executor.share(
+        points=cloud_points,
+        normals=normals,
+        query_indices=query_indices,
+        indices=indices,
+        offsets=offsets,
+    ) as handles:
+        return np.vstack(
+            [np.zeros((0, n_bins * 3 if decorrelated else n_bins**3))]
+            + list(
+                tqdm(
+                    executor.imap(
+                        compute_spfh_on_shared_block,
+                        (
+                            (handles, start, stop, n_bins, decorrelated)
+                            for start, stop in blocks
+                        ),
+                    ),
+                    desc="SPFH",
+                    total=len(blocks),
+                    disable=disable_progress_bar,
+                )
+            )
+        )
+
+
+def compute_spfh_on_shared_block(
+    values: tuple[dict[str, SharedArrayHandle | np.ndarray], int, int, int, bool]
+) -> np.ndarray[np.float64]:
+    """
+    Computes the SPFH of a block of query points whose data was published by an executor.
+    Arguments are given in a tuple to allow for multiprocessing using multiprocessing.Pool.
+
+    Args:
+        values: (handles, start, stop, n_bins, decorrelated). The handles refer to the points, their normals, the
+        indices of the query points and their neighborhoods in a flat layout (indices and offsets).
+
+    Returns:
+        The SPFH of the query points start to stop.
+    """
+    handles, start, stop, n_bins, decorrelated = values
+    arrays = attach_shared_arrays(handles)
+    return compute_spfh(
+        (
+            arrays["points"],
+            arrays["normals"],
+            arrays["query_indices"],
+            arrays["indices"],
+            arrays["offsets"],
+            start,
+            stop,
+            n_bins,
+            decorrelated,
+        )
+    )
+
+
+def get_histogram_bins(
+    values: np.ndarray[np.float64], low: float, high: float, n_bins: int
+) -> np.ndarray[np.int64]:
+    """
+    Bins of an array of values in a histogram with n_bins regular bins on [low, high], following np.histogram (the last
+    bin is closed).
+
+    Returns:
+        The bin of each value, -1 for values outside the range.
+    """
+    bins = (
+        np.searchsorted(np.linspace(low, high, n_bins + 1), values, side="right") - 1
+    )
+    bins[values == high] = n_bins - 1
+    bins[~((values >= low) & (values <= high))] = -1
+    return bins
+
+
+def compute_spfh(
+    values: tuple[
+        np.ndarray[np.float64],
+        np.ndarray[np.float64],
+        np.ndarray[np.int64],
+        np.ndarray[np.int64],
+        np.ndarray[np.int64],
+        int,
+        int,
+        int,
+        bool,
+    ]
+) -> np.ndarray[np.float64]:
+    """
+    Computes the Simplified Point Feature Histograms of a range of query points of the point cloud.
+    The neighborhoods are given in a flat layout: the neighbors of the query point cloud_points[query_indices[i]] are
+    indices[offsets[i]:offsets[i + 1]].
+    The features of every (point, neighbor) pair are computed at once, and the histograms are filled with a single
+    np.bincount on a bin index that combines the point and its bins.
+    Arguments are given in a tuple to allow for multiprocessing using multiprocessing.Pool.
+
+    Args:
+        values: (cloud_points, normals, query_indices, indices, offsets, start, stop, n_bins, decorrelated).
+
+    Returns:
+        The SPFH of cloud_points[query_indices[start:stop]] as a (stop - start, n_bins * 3) array if decorrelated, and a
+        (stop - start, n_bins**3) array otherwise.
+    """
+    (
+        cloud_points,
+        normals,
+        query_indices,
+        indices,
+        offsets,
+        start,
+        stop,
+        n_bins,
+        decorrelated,
+    ) = values
+    n_points = stop - start
+    n_features = n_bins * 3 if decorrelated else n_bins**3
+    block_offsets = offsets[start : stop + 1]
+
+    neighbors = indices[block_offsets[0] : block_offsets[-1]]
+    segment_ids = get_segment_ids(block_offsets - block_offsets[0])
+    centers = query_indices[start:stop][segment_ids]
+    centered_neighbors = cloud_points[neighbors] - cloud_points[centers]
+    dist = np.linalg.norm(centered_neighbors, axis=1)
+    # leaving out the points themselves
+    mask = dist > 0
+    segment_ids = segment_ids[mask]
+    centered_neighbors = centered_neighbors[mask]
+    dist = dist[mask]
+    neighbors_normals = normals[neighbors[mask]]
+
+    u = normals[centers[mask]]
+    v = np.cross(centered_neighbors, u)
+    w = np.cross(u, v)
+    alpha_bins = get_histogram_bins(
+        np.einsum("ij,ij->i", v, neighbors_normals), -1, 1, n_bins
+    )
+    phi_bins = get_histogram_bins(
+        np.einsum("ij,ij->i", centered_neighbors, u) / dist, -1, 1, n_bins
+    )
+    theta_bins = get_histogram_bins(
+        np.arctan2(
+            np.einsum("ij,ij->i", neighbors_normals, w),
+            np.einsum("ij,ij->i", neighbors_normals, u),
+        ),
+        -np.pi / 2,
+        np.pi / 2,
+        n_bins,
+    )
+
+    if decorrelated:
+        # (n_bins, 3) histograms, one column per feature
+        bins = np.concatenate(
+            [
+                (segment_ids * n_bins + feature_bins) * 3 + feature
+                for feature, feature_bins in enumerate(
+                    (alpha_bins, phi_bins, theta_bins)
+                )
+            ]
+        )[np.concatenate((alpha_bins, phi_bins, theta_bins)) >= 0]
+    else:
+        # (n_bins, n_bins, n_bins) joint histograms
+        bins = (
+            (segment_ids * n_bins + alpha_bins) * n_bins + phi_bins
+        ) * n_bins + theta_bins
+        bins = bins[(alpha_bins >= 0) & (phi_bins >= 0) & (theta_bins >= 0)]
+
+    spfh = (
+        np.bincount(bins, minlength=n_points * n_features)
+        .astype(np.float64)
+        .reshape(n_points, n_features)
+    )
+    neighborhood_sizes = np.diff(block_offsets)
+    np.divide(
+        spfh,
+        neighborhood_sizes[:, None],
+        out=spfh,
+        where=neighborhood_sizes[:, None] > 0,
+    )
+    return spfh
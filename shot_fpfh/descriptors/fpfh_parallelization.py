@@ -0,0 +1,110 @@
+from dataclasses import dataclass
+from types import TracebackType
+
+import numpy as np
+
+from shot_fpfh.base_computation import (
+    NeighborhoodGraph,
+    SpatialIndex,
+    SpatialIndexBackend,
+    create_spatial_index,
+)
+from shot_fpfh.utils import Executor, ExecutorType, create_executor
+from .fpfh import SpfhCache, compute_fpfh_descriptor
+from .numba_kernels import Backend, resolve_backend, set_n_threads
+
+
+@dataclass
+class FpfhMultiprocessor:
+    """
+    Base class to compute FPFH descriptors in parallel on multiple processes.
+    The SPFH and FPFH passes are split in blocks of points processed by the workers, which retrieve the point cloud,
+    the neighborhoods and the SPFH from shared memory instead of having them pickled.
+    A long-lived executor can be provided to reuse its workers, otherwise one of type executor_type is started upon
+    entering the context and stopped on exit.
+    With the numba backend, the SPFH are computed by a compiled kernel on n_procs threads of the current process.
+    The neighborhoods are searched with a spatial index of type spatial_index_backend (the default one if empty).
+    """
+
+    n_bins: int = 5
+    decorrelated: bool = False
+    lazy: bool = False
+
+    n_procs: int = 8
+    backend: Backend = "numpy"
+    executor_type: ExecutorType = "process"
+    executor: Executor | None = None
+    spatial_index_backend: SpatialIndexBackend | None = None
+    disable_progress_bar: bool = False
+    verbose: bool = True
+
+    def __post_init__(self):
+        self.backend = resolve_backend(self.backend)
+
+    def __enter__(self):
+        self.owns_executor = self.executor is None and self.backend == "numpy"
+        if self.backend == "numba":
+            set_n_threads(self.n_procs)
+        elif self.owns_executor:
+            self.executor = create_executor(self.executor_type, self.n_procs)
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type | None,
+        exc_val: Exception | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        if not self.owns_executor:
+            return
+        if exc_type is not None:
+            self.executor.terminate()
+        else:
+            self.executor.close()
+        self.executor = None
+
+    def compute_descriptor(
+        self,
+        keypoints_indices: np.ndarray[np.int32],
+        cloud_points: np.ndarray[np.float64],
+        normals: np.ndarray[np.float64],
+        radius: float,
+        spfh_cache: SpfhCache | None = None,
+        kdtree: SpatialIndex | None = None,
+        neighborhoods: NeighborhoodGraph | None = None,
+    ) -> np.ndarray[np.float64]:
+        """
+        Parallelization of the function compute_fpfh_descriptor.
+
+        Args:
+            keypoints_indices: The indices of the keypoints in the point cloud.
+            cloud_points: The point cloud.
+            normals: The normals computed on the point cloud.
+            radius: Radius used to compute the SPFH and FPFH.
+            spfh_cache: Cache of the SPFH computed by previous calls on the same point cloud (lazy mode only).
+            kdtree: A spatial index already built on the point cloud. Leave empty to build it.
+            neighborhoods: The neighborhoods of all the points of the point cloud at radius, with their distances.
+            Leave empty to search them.
+
+        Returns:
+            The descriptor as a (keypoints_indices.shape[0], n_bins**3) array, (keypoints_indices.shape[0], 3 * n_bins)
+            if decorrelated.
+        """
+        return compute_fpfh_descriptor(
+            keypoints_indices,
+            cloud_points,
+            normals,
+            radius=radius,
+            n_bins=self.n_bins,
+            decorrelated=self.decorrelated,
+            verbose=self.verbose,
+            disable_progress_bars=self.disable_progress_bar,
+            backend=self.backend,
+            executor=self.executor,
+            lazy=self.lazy,
+            spfh_cache=spfh_cache,
+            kdtree=kdtree
+            if kdtree is not None or neighborhoods is not None
+            else create_spatial_index(cloud_points, self.spatial_index_backend),
+            neighborhoods=neighborhoods,
+        )
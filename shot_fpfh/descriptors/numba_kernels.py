@@ -0,0 +1,410 @@
+"""
+Numba-compiled kernels for the SHOT descriptor, the local reference frames and the SPFH histograms of FPFH.
+The kernels loop explicitly over the keypoints in parallel (prange) and over their neighbors, which removes both the
+interpreter overhead of the small NumPy operations and the inter-process communication: a single process with several
+threads replaces the pool of worker processes.
+Numba is an optional dependency. Without it, the NumPy backend is used instead.
+"""
+import math
+import warnings
+from typing import Callable, Literal
+
+import numpy as np
+
+try:
+    import numba
+    from numba import prange
+except ImportError:
+    numba = None
+    prange = range
+
+Backend = Literal["numpy", "numba"]
+
+
+def resolve_backend(backend: Backend) -> Backend:
+    """
+    Checks that a backend can be used, falling back to the NumPy backend if Numba is not installed.
+
+    Args:
+        backend: The requested backend.
+
+    Returns:
+        The backend to use.
+    """
+    if backend not in ("numpy", "numba"):
+        raise ValueError(f"Incorrect backend: {backend}.")
+    if backend == "numba" and numba is None:
+        warnings.warn("Numba is not installed, falling back to the NumPy backend.")
+        return "numpy"
+    return backend
+
+
+def set_n_threads(n_threads: int) -> None:
+    """
+    Sets the number of threads used by the parallel kernels.
+
+    Args:
+        n_threads: The number of threads, capped by the number of threads Numba was started with.
+    """
+    if numba is not None:
+        numba.set_num_threads(max(1, min(n_threads, numba.config.NUMBA_NUM_THREADS)))
+
+
+def jit(parallel: bool = False) -> Callable[[Callable], Callable]:
+    """
+    Compiles a function with Numba in nopython mode. The function is left as is if Numba is not installed, in which
+    case the kernels are never called by the descriptors since the NumPy backend is selected instead.
+    """
+    if numba is None:
+        return lambda function: function
+    return numba.njit(parallel=parallel, cache=True, fastmath=False)
+
+
+@jit()
+def _cross(a: np.ndarray[np.float64], b: np.ndarray[np.float64]) -> np.ndarray[np.float64]:
+    return np.array(
+        [
+            a[1] * b[2] - a[2] * b[1],
+            a[2] * b[0] - a[0] * b[2],
+            a[0] * b[1] - a[1] * b[0],
+        ]
+    )
+
+
+@jit()
+def _get_azimuth_idx(x: float, y: float) -> int:
+    """
+    Scalar version of get_azimuth_idx.
+    """
+    a = (y > 0) or (y == 0 and x < 0)
+    b = (x > 0) or (x == 0 and y > 0)
+    if x * y > 0 or x == 0:
+        corner = abs(x) < abs(y)
+    else:
+        corner = abs(x) > abs(y)
+    return 4 * int(a) + 2 * int(a != b) + int(corner)
+
+
+@jit()
+def _get_shot_bin(cos_idx: int, theta_idx: int, phi_idx: int, rho_idx: int) -> int:
+    return ((cos_idx * 8 + theta_idx) * 2 + phi_idx) * 2 + rho_idx
+
+
+@jit()
+def _accumulate_shot_neighbor(
+    descriptor: np.ndarray[np.float64],
+    x: float,
+    y: float,
+    z: float,
+    rho: float,
+    cosine: float,
+    radius: float,
+) -> None:
+    """
+    Adds the interpolated contributions of a single neighbor to a SHOT descriptor, following
+    compute_batched_shot_descriptors.
+    """
+    n_cosine_bins, n_azimuth_bins = 11, 8
+
+    theta = math.atan2(y, x)
+    phi = math.acos(min(max(z / rho, -1.0), 1.0))
+
+    cos_bin_pos = (cosine + 1.0) * n_cosine_bins / 2.0 - 0.5
+    cos_bin_idx = int(np.rint(cos_bin_pos))
+    theta_bin_idx = _get_azimuth_idx(x, y)
+    phi_bin_idx = int(z > 0)
+    rho_bin_idx = int(rho > radius / 2)
+    current_bin = _get_shot_bin(cos_bin_idx, theta_bin_idx, phi_bin_idx, rho_bin_idx)
+
+    # interpolation on the local bins
+    delta_cos = cos_bin_pos - cos_bin_idx
+    delta_cos_sign = np.sign(delta_cos)
+    abs_delta_cos = delta_cos_sign * delta_cos
+    if -0.5 < cos_bin_idx < n_cosine_bins - 0.5:
+        descriptor[
+            _get_shot_bin(
+                (cos_bin_idx + int(delta_cos_sign)) % n_cosine_bins,
+                theta_bin_idx,
+                phi_bin_idx,
+                rho_bin_idx,
+            )
+        ] += abs_delta_cos
+
+    # interpolation on the adjacent husks
+    radial_bin_size = radius / 2
+    if rho_bin_idx == 0 and radius / 4 < rho < radius / 2:
+        descriptor[_get_shot_bin(cos_bin_idx, theta_bin_idx, phi_bin_idx, 1)] += (
+            rho - radius / 4
+        ) / radial_bin_size
+    if rho_bin_idx == 1 and radius / 2 < rho < radius * 3 / 4:
+        descriptor[_get_shot_bin(cos_bin_idx, theta_bin_idx, phi_bin_idx, 0)] += (
+            radius * 3 / 4 - rho
+        ) / radial_bin_size
+    current_husk = 0.0
+    if rho < radius / 2:
+        current_husk += 1 - abs(rho - radius / 4) / radial_bin_size
+    if rho > radius / 2:
+        current_husk += 1 - abs(rho - radius * 3 / 4) / radial_bin_size
+
+    # interpolation between adjacent vertical volumes
+    phi_bin_size = np.pi / 2
+    is_equator = abs(phi - np.pi / 2) < 1e-10
+    if (
+        phi_bin_idx == 0
+        and (phi > np.pi / 2 or (is_equator and z <= 0))
+        and phi <= np.pi * 3 / 4
+    ):
+        descriptor[_get_shot_bin(cos_bin_idx, theta_bin_idx, 1, rho_bin_idx)] += (
+            np.pi * 3 / 4 - phi
+        ) / phi_bin_size
+    if (
+        phi_bin_idx == 1
+        and phi < np.pi / 2
+        and (not is_equator or z > 0)
+        and phi >= np.pi / 4
+    ):
+        descriptor[_get_shot_bin(cos_bin_idx, theta_bin_idx, 0, rho_bin_idx)] += (
+            phi - np.pi / 4
+        ) / phi_bin_size
+    if phi < np.pi / 2:
+        current_volume = 1 - abs(phi - np.pi / 4) / phi_bin_size
+    else:
+        current_volume = 1 - abs(phi - np.pi * 3 / 4) / phi_bin_size
+
+    # interpolation between adjacent horizontal volumes
+    theta_bin_size = 2 * np.pi / n_azimuth_bins
+    delta_theta = min(
+        max(
+            (theta - (-np.pi + theta_bin_idx * theta_bin_size)) / theta_bin_size - 0.5,
+            -0.5,
+        ),
+        0.5,
+    )
+    delta_theta_sign = np.sign(delta_theta)
+    abs_delta_theta = delta_theta_sign * delta_theta
+    descriptor[
+        _get_shot_bin(
+            cos_bin_idx,
+            (theta_bin_idx + int(delta_theta_sign)) % n_azimuth_bins,
+            phi_bin_idx,
+            rho_bin_idx,
+        )
+    ] += abs_delta_theta
+
+    descriptor[current_bin] += (
+        (1 - abs_delta_cos) + current_husk + current_volume + (1 - abs_delta_theta)
+    )
+
+
+@jit(parallel=True)
+def compute_multiradius_shot_descriptors_numba(
+    keypoints: np.ndarray[np.float64],
+    support: np.ndarray[np.float64],
+    normals: np.ndarray[np.float64],
+    indices: np.ndarray[np.int64],
+    offsets: np.ndarray[np.int64],
+    radii: np.ndarray[np.float64],
+    local_rfs: np.ndarray[np.float64],
+    normalize: bool,
+    min_neighborhood_size: int,
+) -> np.ndarray[np.float64]:
+    """
+    Numba counterpart of compute_multiradius_shot_descriptors, parallelized over the keypoints.
+    The neighbors are read from the support through the flat layout instead of being gathered beforehand.
+
+    Args:
+        keypoints: The keypoints to compute descriptors on.
+        support: The supporting point cloud.
+        normals: The normals of points in the support.
+        indices: The neighborhoods at the largest radius in a flat layout.
+        offsets: The offsets of the flat layout.
+        radii: The radii used to compute SHOT.
+        local_rfs: The local reference frames used at each radius as a (len(radii), keypoints.shape[0], 3, 3) array.
+        normalize: Whether the descriptors are normalized to Euclidean norm 1.
+        min_neighborhood_size: Neighborhoods with this many neighbors or fewer get a null descriptor.
+
+    Returns:
+        The SHOT descriptors of every radius stacked as a (keypoints.shape[0], 352 * len(radii)) array.
+    """
+    descriptors = np.zeros((keypoints.shape[0], 352 * radii.shape[0]))
+    for k in prange(keypoints.shape[0]):
+        for r in range(radii.shape[0]):
+            radius = radii[r]
+            local_rf = local_rfs[r, k]
+            descriptor = descriptors[k, 352 * r : 352 * (r + 1)]
+
+            n_valid_neighbors = 0
+            for j in range(offsets[k], offsets[k + 1]):
+                centered_neighbor = support[indices[j]] - keypoints[k]
+                rho = math.sqrt(np.sum(centered_neighbor**2))
+                if 0 < rho <= radius:
+                    n_valid_neighbors += 1
+            if n_valid_neighbors <= min_neighborhood_size:
+                continue
+
+            for j in range(offsets[k], offsets[k + 1]):
+                centered_neighbor = support[indices[j]] - keypoints[k]
+                rho = math.sqrt(np.sum(centered_neighbor**2))
+                if rho == 0 or rho > radius:
+                    continue
+                cosine = min(max(np.sum(normals[indices[j]] * local_rf[:, 2]), -1.0), 1.0)
+                # coordinates in the local reference frame
+                _accumulate_shot_neighbor(
+                    descriptor,
+                    np.sum(centered_neighbor * local_rf[:, 0]),
+                    np.sum(centered_neighbor * local_rf[:, 1]),
+                    np.sum(centered_neighbor * local_rf[:, 2]),
+                    rho,
+                    cosine,
+                    radius,
+                )
+
+            if normalize:
+                norm = math.sqrt(np.sum(descriptor**2))
+                if norm > 0:
+                    descriptor /= norm
+    return descriptors
+
+
+@jit(parallel=True)
+def get_batched_local_rfs_numba(
+    keypoints: np.ndarray[np.float64],
+    support: np.ndarray[np.float64],
+    indices: np.ndarray[np.int64],
+    offsets: np.ndarray[np.int64],
+    radius: float,
+) -> np.ndarray[np.float64]:
+    """
+    Numba counterpart of get_batched_local_rfs, parallelized over the keypoints.
+
+    Args:
+        keypoints: The keypoints to compute local reference frames on.
+        support: The supporting point cloud.
+        indices: The neighborhoods in a flat layout.
+        offsets: The offsets of the flat layout.
+        radius: The radius used to compute the local reference frames.
+
+    Returns:
+        The local reference frames as a (keypoints.shape[0], 3, 3) array.
+    """
+    local_rfs = np.zeros((keypoints.shape[0], 3, 3))
+    for k in prange(keypoints.shape[0]):
+        neighborhood_size = offsets[k + 1] - offsets[k]
+        if neighborhood_size == 0:
+            local_rfs[k] = np.eye(3)
+            continue
+
+        # EVD of the weighted covariance matrix
+        weighted_cov_matrix = np.zeros((3, 3))
+        weights_sum = 0.0
+        for j in range(offsets[k], offsets[k + 1]):
+            centered_point = support[indices[j]] - keypoints[k]
+            weight = radius - math.sqrt(np.sum(centered_point**2))
+            weighted_cov_matrix += np.outer(centered_point, centered_point * weight)
+            weights_sum += weight
+        if weights_sum != 0:
+            weighted_cov_matrix /= weights_sum
+        _, eigenvectors = np.linalg.eigh(weighted_cov_matrix)
+        eigenvectors = np.ascontiguousarray(eigenvectors)
+
+        # disambiguating the axes with a majority vote on the neighborhood
+        for axis in (2, 0):
+            negative_votes = 0
+            for j in range(offsets[k], offsets[k + 1]):
+                if np.sum((support[indices[j]] - keypoints[k]) * eigenvectors[:, axis]) < 0:
+                    negative_votes += 1
+            if negative_votes > neighborhood_size - negative_votes:
+                eigenvectors[:, axis] *= -1
+        eigenvectors[:, 1] = _cross(eigenvectors[:, 0], eigenvectors[:, 2])
+
+        for axis in range(3):
+            local_rfs[k, :, axis] = eigenvectors[:, 2 - axis]
+    return local_rfs
+
+
+@jit()
+def _get_histogram_bin(value: float, low: float, high: float, n_bins: int) -> int:
+    """
+    Bin of a value in a histogram with n_bins regular bins on [low, high], following np.histogram (the last bin is
+    closed). Returns -1 for values outside the range.
+    """
+    if not low <= value <= high:
+        return -1
+    if value == high:
+        return n_bins - 1
+    # the edges are computed like np.linspace does to get the same bins for values on the edges
+    step = (high - low) / n_bins
+    bin_idx = min(int((value - low) / step), n_bins - 1)
+    if value < low + bin_idx * step:
+        bin_idx -= 1
+    elif bin_idx < n_bins - 1 and value >= low + (bin_idx + 1) * step:
+        bin_idx += 1
+    return bin_idx
+
+
+@jit(parallel=True)
+def compute_spfh_numba(
+    points: np.ndarray[np.float64],
+    normals: np.ndarray[np.float64],
+    query_indices: np.ndarray[np.int64],
+    indices: np.ndarray[np.int64],
+    offsets: np.ndarray[np.int64],
+    n_bins: int,
+    decorrelated: bool,
+) -> np.ndarray[np.float64]:
+    """
+    Computes the Simplified Point Feature Histograms of a subset of the points, parallelized over the points.
+
+    Args:
+        points: The point cloud.
+        normals: The normals of the point cloud.
+        query_indices: The indices of the points to compute the SPFH of.
+        indices: The neighborhoods of the query points in a flat layout.
+        offsets: The offsets of the flat layout.
+        n_bins: The number of bins of each feature.
+        decorrelated: Whether the three features are binned in separate histograms instead of a joint one.
+
+    Returns:
+        The SPFH as a (query_indices.shape[0], n_bins * 3) array if decorrelated, (query_indices.shape[0], n_bins**3)
+        otherwise.
+    """
+    spfh = np.zeros(
+        (query_indices.shape[0], n_bins * 3 if decorrelated else n_bins**3)
+    )
+    for i in prange(query_indices.shape[0]):
+        neighborhood_size = offsets[i + 1] - offsets[i]
+        if neighborhood_size == 0:
+            continue
+        point = points[query_indices[i]]
+        u = normals[query_indices[i]]
+        for j in range(offsets[i], offsets[i + 1]):
+            centered_neighbor = points[indices[j]] - point
+            dist = math.sqrt(np.sum(centered_neighbor**2))
+            if dist == 0:
+                continue
+            neighbor_normal = normals[indices[j]]
+            v = _cross(centered_neighbor, u)
+            w = _cross(u, v)
+            alpha_bin = _get_histogram_bin(
+                np.sum(v * neighbor_normal), -1.0, 1.0, n_bins
+            )
+            phi_bin = _get_histogram_bin(
+                np.sum(centered_neighbor * u) / dist, -1.0, 1.0, n_bins
+            )
+            theta_bin = _get_histogram_bin(
+                math.atan2(np.sum(neighbor_normal * w), np.sum(neighbor_normal * u)),
+                -np.pi / 2,
+                np.pi / 2,
+                n_bins,
+            )
+            if decorrelated:
+                if alpha_bin >= 0:
+                    spfh[i, alpha_bin * 3] += 1
+                if phi_bin >= 0:
+                    spfh[i, phi_bin * 3 + 1] += 1
+                if theta_bin >= 0:
+                    spfh[i, theta_bin * 3 + 2] += 1
+            elif alpha_bin >= 0 and phi_bin >= 0 and theta_bin >= 0:
+                spfh[i, (alpha_bin * n_bins + phi_bin) * n_bins + theta_bin] += 1
+        spfh[i] /= neighborhood_size
+    return spfh
@@ -1,12 +1,26 @@
 """
 Implementation of local PCA on point clouds for normal computations and feature extraction (PCA-based descriptors).
+The covariance matrices of the neighborhoods are computed by blocks of bounded size, either on a dense (N, k) array of
+neighbors (k nearest neighbors) or on a flat (CSR) layout (radius searches), and diagonalized by stacked calls to eigh.
 """
 import numpy as np
 from matplotlib import pyplot as plt
-from sklearn.neighbors import KDTree
 
+from shot_fpfh.base_computation import (
+    NeighborhoodGraph,
+    SpatialIndex,
+    VoxelMomentGrid,
+    as_neighborhood_graph,
+    create_spatial_index,
+)
 from shot_fpfh.utils import timeit
 
+Neighborhoods = (
+    np.ndarray[np.int64]
+    | NeighborhoodGraph
+    | tuple[np.ndarray[np.int64], np.ndarray[np.int64]]
+)
+
 
 def pca(
     points: np.ndarray[np.float64],
@@ -22,6 +36,207 @@ def pca(
     return eigenvalues, eigenvectors
 
 
+def segment_mean(
+    values: np.ndarray[np.float64],
+    segment_ids: np.ndarray[np.int64],
+    segment_sizes: np.ndarray[np.int64],
+) -> np.ndarray[np.float64]:
+    """
+    Averages values over the segments of a flat (CSR) layout with one bincount per feature.
+
+    Args:
+        values: (M, ...) array of values.
+        segment_ids: (M,) array of the index of the segment each value belongs to.
+        segment_sizes: (n_segments,) array of sizes of the segments. The mean of an empty segment is 0.
+
+    Returns:
+        (n_segments, ...) array of means.
+    """
+    flat_values = values.reshape(values.shape[0], -1)
+    sums = np.stack(
+        [
+            np.bincount(
+                segment_ids,
+                weights=flat_values[:, feature],
+                minlength=segment_sizes.shape[0],
+            )
+            for feature in range(flat_values.shape[1])
+        ],
+        axis=1,
+    ).reshape((segment_sizes.shape[0], *values.shape[1:]))
+    return sums / np.maximum(segment_sizes, 1).reshape(-1, *[1] * (values.ndim - 1))
+
+
+def get_moments(
+    centered_points: np.ndarray[np.float64], eigenvectors: np.ndarray[np.float64]
+) -> np.ndarray[np.float64]:
+    """
+    Computes the moments of centered neighbors in the local frames of their neighborhoods.
+
+    Args:
+        centered_points: (M, 3) array of neighbors centered on the barycenter of their neighborhood.
+        eigenvectors: (M, 3, 3) array of the eigenvectors of the neighborhood of each neighbor, stored in columns.
+
+    Returns:
+        (M, 8) array made of the absolute first moments and the second moments of the centered neighbors projected on
+        the rows of the eigenvectors matrices, followed by the first and second vertical moments, before averaging.
+    """
+    moment = np.einsum("mj,mij->mi", centered_points, eigenvectors)
+    vert_moment = centered_points[:, 2:]
+    return np.hstack((moment, moment**2, vert_moment, vert_moment**2))
+
+
+def pca_on_segments(
+    cloud_points: np.ndarray[np.float64],
+    neighborhoods: NeighborhoodGraph,
+    compute_moments: bool = False,
+) -> tuple[np.ndarray[np.float64], ...]:
+    """
+    Computes PCA on neighborhoods given in a flat (CSR) layout, see batched_pca.
+    The 6 distinct entries of the covariance matrices are accumulated with one bincount each, which avoids
+    materializing the outer products of the neighbors.
+    """
+    n_neighborhoods = neighborhoods.n_neighborhoods
+    neighborhood_sizes = neighborhoods.sizes
+    segment_ids = neighborhoods.get_segment_ids()
+    neighbors = cloud_points[neighborhoods.indices]
+    centered_points = neighbors - segment_mean(
+        neighbors, segment_ids, neighborhood_sizes
+    )[segment_ids]
+
+    normalization = np.maximum(neighborhood_sizes, 1)
+    cov_matrices = np.empty((n_neighborhoods, 3, 3))
+    for i, j in ((0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)):
+        cov_matrices[:, i, j] = cov_matrices[:, j, i] = (
+            np.bincount(
+                segment_ids,
+                weights=centered_points[:, i] * centered_points[:, j],
+                minlength=n_neighborhoods,
+            )
+            / normalization
+        )
+    eigenvalues, eigenvectors = np.linalg.eigh(cov_matrices)
+
+    if not compute_moments:
+        return eigenvalues, eigenvectors
+    moments = segment_mean(
+        get_moments(centered_points, eigenvectors[segment_ids]),
+        segment_ids,
+        neighborhood_sizes,
+    )
+    moments[:, :3] = np.abs(moments[:, :3])
+    return eigenvalues, eigenvectors, moments
+
+
+def pca_on_dense_neighborhoods(
+    cloud_points: np.ndarray[np.float64],
+    neighborhoods: np.ndarray[np.int64],
+    compute_moments: bool = False,
+) -> tuple[np.ndarray[np.float64], ...]:
+    """
+    Computes PCA on neighborhoods given as a dense (N, k) array of indices, see batched_pca.
+    """
+    neighbors = cloud_points[neighborhoods]
+    centered_points = neighbors - neighbors.mean(axis=1, keepdims=True)
+    cov_matrices = (
+        np.einsum("nki,nkj->nij", centered_points, centered_points)
+        / neighborhoods.shape[1]
+    )
+    eigenvalues, eigenvectors = np.linalg.eigh(cov_matrices)
+
+    if not compute_moments:
+        return eigenvalues, eigenvectors
+    moment = np.einsum("nkj,nij->nki", centered_points, eigenvectors)
+    vert_moment = centered_points[:, :, 2:]
+    moments = np.hstack(
+        (
+            np.abs(moment.mean(axis=1)),
+            (moment**2).mean(axis=1),
+            vert_moment.mean(axis=1),
+            (vert_moment**2).mean(axis=1),
+        )
+    )
+    return eigenvalues, eigenvectors, moments
+
+
+def batched_pca(
+    cloud_points: np.ndarray[np.float64],
+    neighborhoods: Neighborhoods,
+    compute_moments: bool = False,
+    block_size: int = 2**18,
+) -> tuple[np.ndarray[np.float64], ...]:
+    """
+    Computes PCA on all the neighborhoods, by blocks of neighborhoods holding at most block_size neighbors in total so
+    that the temporary arrays stay bounded whatever the size of the neighborhoods.
+
+    Args:
+        cloud_points: The point cloud.
+        neighborhoods: Either a dense (N, k) array of indices of neighbors in cloud_points (k nearest neighbors), or
+        neighborhoods of any size as a NeighborhoodGraph, a tuple (indices, offsets) describing a flat (CSR) layout or
+        the output of KDTree.query_radius.
+        compute_moments: Whether to compute the moments of the neighborhoods in their local frames.
+        block_size: Maximum number of neighbors processed at once (a larger neighborhood is processed on its own).
+
+    Returns:
+        eigenvalues: (N, 3) array of the eigenvalues of the covariance matrices in ascending order.
+        eigenvectors: (N, 3, 3) array of the associated eigenvectors, stored in columns.
+        moments: (N, 8) array made of the absolute first moments and the second moments of the centered neighbors
+        projected on the rows of the eigenvectors matrices, followed by the first and second vertical moments. Only
+        returned if compute_moments is True.
+    """
+    if isinstance(neighborhoods, np.ndarray) and neighborhoods.ndim == 2:
+        # dense fast path, all the neighborhoods have the same size
+        n_rows = max(block_size // max(neighborhoods.shape[1], 1), 1)
+        blocks = [
+            pca_on_dense_neighborhoods(
+                cloud_points, neighborhoods[start : start + n_rows], compute_moments
+            )
+            for start in range(0, neighborhoods.shape[0], n_rows)
+        ]
+    else:
+        graph = as_neighborhood_graph(neighborhoods)
+        blocks = [
+            pca_on_segments(cloud_points, graph.slice(start, stop), compute_moments)
+            for start, stop in graph.split_in_blocks(block_size)
+        ]
+
+    if not blocks:
+        return (np.zeros((0, 3)), np.zeros((0, 3, 3))) + (
+            (np.zeros((0, 8)),) if compute_moments else ()
+        )
+    return tuple(np.concatenate(results) for results in zip(*blocks))
+
+
+def get_neighborhoods(
+    query_points: np.ndarray[np.float64],
+    cloud_points: np.ndarray[np.float64],
+    *,
+    k: int | None = None,
+    radius: float | None = None,
+    kdtree: SpatialIndex | None = None,
+) -> Neighborhoods:
+    """
+    Searches the neighborhoods of the query points in the layout expected by batched_pca.
+
+    Args:
+        query_points: The points whose neighborhoods are searched.
+        cloud_points: The point cloud.
+        k: Number of neighbors, takes precedence over radius.
+        radius: Radius of the spherical neighborhoods.
+        kdtree: A spatial index built on cloud_points, built if not provided.
+
+    Returns:
+        A dense (N, k) array of indices if k is provided, a NeighborhoodGraph otherwise.
+    """
+    assert (
+        k is not None or radius is not None
+    ), "No parameter provided for the neighborhood search."
+    kdtree = kdtree if kdtree is not None else create_spatial_index(cloud_points)
+    if k is not None:
+        return kdtree.query(query_points, k=k, return_distance=False)
+    return NeighborhoodGraph.search(kdtree, query_points, radius)
+
+
 def compute_normals(
     query_points: np.ndarray[np.float64],
     cloud_points: np.ndarray[np.float64],
@@ -29,28 +244,32 @@ def compute_normals(
     k: int | None = None,
     radius: float | None = None,
     pre_computed_normals: np.ndarray[np.float64] | None = None,
+    voxel_size: float | None = None,
+    kdtree: SpatialIndex | None = None,
 ) -> np.ndarray[np.float64]:
     """
     Computes PCA-based normals on a point cloud.
     Reorients normals based on pre-computed normals if provided.
+    A spatial index already built on cloud_points can be given to avoid building it again.
+    With voxel_size, the covariance matrices of the spherical neighborhoods are approximated from the statistics of the
+    voxels of that size they overlap (see VoxelMomentGrid), which is only available with a radius.
     """
-    assert (
-        k is not None or radius is not None
-    ), "No parameter provided for the neighborhood search."
-    normals = np.zeros((query_points.shape[0], 3))
-    neighborhoods = (
-        KDTree(cloud_points).query(query_points, k=k, return_distance=False)
-        if k is not None
-        else KDTree(cloud_points).query_radius(query_points, radius)
-    )
-    for i in range(query_points.shape[0]):
-        normals[i] = pca(cloud_points[neighborhoods[i]])[1][:, 0]
-        # reorienting the normal using a rough pre-computation of the normals
-        if (
-            pre_computed_normals is not None
-            and normals[i].dot(pre_computed_normals[i]) < 0
-        ):
-            normals[i] *= -1
+    if voxel_size is not None:
+        assert radius is not None, "Approximate normals require a radius."
+        cov_matrices = VoxelMomentGrid(cloud_points, voxel_size).get_covariance_matrices(
+            query_points, radius
+        )[2]
+        normals = np.linalg.eigh(cov_matrices)[1][:, :, 0]
+    else:
+        normals = batched_pca(
+            cloud_points,
+            get_neighborhoods(
+                query_points, cloud_points, k=k, radius=radius, kdtree=kdtree
+            ),
+        )[1][:, :, 0]
+    # reorienting the normals using a rough pre-computation of the normals
+    if pre_computed_normals is not None:
+        normals[(normals * pre_computed_normals).sum(axis=1) < 0] *= -1
 
     return normals
 
@@ -63,10 +282,9 @@ def compute_sphericity(
     """
     Computes the sphericity on a point cloud.
     """
-    eigenvalues = np.zeros((query_points.shape[0], 3))
-    neighborhoods = KDTree(cloud_points).query_radius(query_points, radius)
-    for i in range(query_points.shape[0]):
-        eigenvalues[i] = pca(cloud_points[neighborhoods[i]])[0]
+    eigenvalues = batched_pca(
+        cloud_points, get_neighborhoods(query_points, cloud_points, radius=radius)
+    )[0]
     return eigenvalues[:, 0] / (eigenvalues[:, 2] + 1e-6)
 
 
@@ -87,17 +305,15 @@ def compute_local_pca_with_moments(
         all_eigenvalues: (N, 3)-array of the eigenvalues associated with each query point.
         all_eigenvectors: (N, 3, 3)-array of the eigenvectors associated with each query point.
     """
+    if nghbrd_search.lower() == "spherical":
+        neighborhoods = get_neighborhoods(query_points, cloud_points, radius=radius)
+        neighborhood_sizes = neighborhoods.sizes.tolist()
+    elif nghbrd_search.lower() == "knn":
+        neighborhoods = get_neighborhoods(query_points, cloud_points, k=k)
+        neighborhood_sizes = [k] * query_points.shape[0]
+    else:
+        raise ValueError(f"Incorrect neighborhood search: {nghbrd_search}.")
 
-    kdtree = KDTree(cloud_points)
-    neighborhoods = (
-        kdtree.query_radius(query_points, radius)
-        if nghbrd_search.lower() == "spherical"
-        else kdtree.query(query_points, k=k, return_distance=False)
-        if nghbrd_search.lower() == "knn"
-        else None
-    )
-
-    neighborhood_sizes = [neighborhood.shape[0] for neighborhood in neighborhoods]
     # checking the sizes of the neighborhoods and plotting the histogram
     if nghbrd_search.lower() == "spherical" and verbose:
         print(
@@ -113,30 +329,9 @@ def compute_local_pca_with_moments(
         plt.ylabel("Number of neighborhoods")
         plt.show()
 
-    all_eigenvalues = np.zeros((query_points.shape[0], 3))
-    all_eigenvectors = np.zeros((query_points.shape[0], 3, 3))
-    moments = np.zeros((query_points.shape[0], 8))
-
-    for i, point in enumerate(query_points):
-        barycenter = cloud_points[neighborhoods[i]].mean(axis=0)
-        centered_points = cloud_points[neighborhoods[i]] - barycenter
-        cov_matrix = centered_points.T @ centered_points / neighborhoods[i].shape[0]
-        eigenvalues, eigenvectors = np.linalg.eigh(cov_matrix)
-        moment = centered_points @ eigenvectors.T
-        vert_moment = centered_points[:, 2]
-
-        all_eigenvalues[i], all_eigenvectors[i], moments[i] = (
-            eigenvalues,
-            eigenvectors,
-            np.hstack(
-                (
-                    np.abs(moment.mean(axis=0)),
-                    (moment**2).mean(axis=0),
-                    vert_moment.mean(axis=0),
-                    (vert_moment**2).mean(axis=0),
-                ),
-            ),
-        )
+    all_eigenvalues, all_eigenvectors, moments = batched_pca(
+        cloud_points, neighborhoods, compute_moments=True
+    )
 
     return all_eigenvalues, all_eigenvectors, moments, neighborhood_sizes
 
@@ -155,11 +350,9 @@ def compute_pca_based_basic_features(
     """
     Computes PCA-based descriptors on a point cloud.
     """
-    all_eigenvalues = np.zeros((query_points.shape[0], 3))
-    all_eigenvectors = np.zeros((query_points.shape[0], 3, 3))
-    neighborhoods = KDTree(cloud_points).query_radius(query_points, radius)
-    for i in range(query_points.shape[0]):
-        all_eigenvalues[i], all_eigenvectors[i] = pca(cloud_points[neighborhoods[i]])
+    all_eigenvalues, all_eigenvectors = batched_pca(
+        cloud_points, get_neighborhoods(query_points, cloud_points, radius=radius)
+    )
 
     lbd3, lbd2, lbd1 = (
         all_eigenvalues[:, 0],
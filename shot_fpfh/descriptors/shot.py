@@ -7,9 +7,15 @@ Computer Vision and Image Understanding,
 import warnings
 
 import numpy as np
-from sklearn.neighbors import KDTree
 from tqdm import tqdm
 
+from shot_fpfh.base_computation import (
+    VoxelMomentGrid,
+    create_spatial_index,
+    get_offsets,
+    get_segment_ids,
+)
+
 
 def get_local_rf(
     values: tuple[np.ndarray[np.float64, 3], np.ndarray[np.float64], float],
@@ -17,33 +23,139 @@ def get_local_rf(
     """
     Extracts a local reference frame based on the eigendecomposition of the weighted covariance matrix.
     Arguments are given in a tuple to allow for multiprocessing using multiprocessing.Pool.
+    Use get_batched_local_rfs to compute several local reference frames at once.
     """
     point, neighbors, radius = values
-    if neighbors.shape[0] == 0:
-        return np.eye(3)
+    return get_batched_local_rfs(
+        (point[None, :], neighbors, np.array([0, neighbors.shape[0]]), radius)
+    )[0]
+
+
+def get_batched_local_rfs(
+    values: tuple[
+        np.ndarray[np.float64], np.ndarray[np.float64], np.ndarray[np.int64], float
+    ],
+) -> np.ndarray[np.float64]:
+    """
+    Extracts the local reference frames of a batch of keypoints based on the eigendecomposition of the weighted
+    covariance matrices.
+    The neighborhoods are given in a flat layout: the neighbors of keypoint i are neighbors[offsets[i]:offsets[i + 1]].
+    The covariance matrices and the votes that disambiguate the axes are accumulated with segment sums, and a single
+    np.linalg.eigh is performed on the stack of covariance matrices.
+    Arguments are given in a tuple to allow for multiprocessing using multiprocessing.Pool.
+
+    Args:
+        values: (keypoints, neighbors, offsets, radius).
+
+    Returns:
+        The local reference frames as a (keypoints.shape[0], 3, 3) array.
+    """
+    keypoints, neighbors, offsets, radius = values
+    n_keypoints = keypoints.shape[0]
+    neighborhood_sizes = np.diff(offsets)
 
-    centered_points = neighbors - point
+    segment_ids = get_segment_ids(offsets)
+    centered_points = neighbors - keypoints[segment_ids]
 
-    # EVD of the weighted covariance matrix
+    # EVD of the weighted covariance matrices
     radius_minus_distances = radius - np.linalg.norm(centered_points, axis=1)
-    weighted_cov_matrix = (
-        centered_points.T
-        @ (centered_points * radius_minus_distances[:, None])
-        / radius_minus_distances.sum()
+    weighted_cov_matrices = (
+        np.bincount(
+            (segment_ids[:, None] * 9 + np.arange(9)).ravel(),
+            weights=(
+                centered_points[:, :, None]
+                * (centered_points * radius_minus_distances[:, None])[:, None, :]
+            ).ravel(),
+            minlength=n_keypoints * 9,
+        )
+        .astype(np.float64, copy=False)
+        .reshape(n_keypoints, 3, 3)
+    )
+    weights_sums = np.bincount(
+        segment_ids, weights=radius_minus_distances, minlength=n_keypoints
     )
-    eigenvalues, eigenvectors = np.linalg.eigh(weighted_cov_matrix)
+    np.divide(
+        weighted_cov_matrices,
+        weights_sums[:, None, None],
+        out=weighted_cov_matrices,
+        where=weights_sums[:, None, None] != 0,
+    )
+    eigenvalues, eigenvectors = np.linalg.eigh(weighted_cov_matrices)
 
-    # disambiguating the axes
+    # disambiguating the axes with a majority vote on each neighborhood
     # TODO: deal with the equality case (where the two sums below are equal)
-    x_orient = (neighbors - point) @ eigenvectors[:, 2]
-    if (x_orient < 0).sum() > (x_orient >= 0).sum():
-        eigenvectors[:, 2] *= -1
-    z_orient = (neighbors - point) @ eigenvectors[:, 0]
-    if (z_orient < 0).sum() > (z_orient >= 0).sum():
-        eigenvectors[:, 0] *= -1
-    eigenvectors[:, 1] = np.cross(eigenvectors[:, 0], eigenvectors[:, 2])
+    x_orient = np.einsum("ij,ij->i", centered_points, eigenvectors[segment_ids, :, 2])
+    x_negative_votes = np.bincount(segment_ids[x_orient < 0], minlength=n_keypoints)
+    eigenvectors[x_negative_votes > neighborhood_sizes - x_negative_votes, :, 2] *= -1
+    z_orient = np.einsum("ij,ij->i", centered_points, eigenvectors[segment_ids, :, 0])
+    z_negative_votes = np.bincount(segment_ids[z_orient < 0], minlength=n_keypoints)
+    eigenvectors[z_negative_votes > neighborhood_sizes - z_negative_votes, :, 0] *= -1
+    eigenvectors[:, :, 1] = np.cross(eigenvectors[:, :, 0], eigenvectors[:, :, 2])
+
+    local_rfs = np.flip(eigenvectors, axis=2)
+    local_rfs[neighborhood_sizes == 0] = np.eye(3)
+
+    return local_rfs
+
+
+def get_approximate_local_rfs(
+    keypoints: np.ndarray[np.float64], grid: VoxelMomentGrid, radius: float
+) -> np.ndarray[np.float64]:
+    """
+    Approximates the local reference frames of get_batched_local_rfs from the statistics of the voxels overlapped by
+    the neighborhoods instead of their points. The weight of each point is replaced by the weight of the barycenter of
+    its voxel, and the points of a voxel vote together on the side of its barycenter.
+
+    Args:
+        keypoints: The keypoints to compute local reference frames on.
+        grid: The statistics of the voxels of the support.
+        radius: The radius used to compute the local reference frames.
+
+    Returns:
+        The local reference frames as a (keypoints.shape[0], 3, 3) array.
+    """
+    n_keypoints = keypoints.shape[0]
+    indices, offsets = grid.query_radius(keypoints, radius)
+    segment_ids = get_segment_ids(offsets)
+    displacements, second_moments = grid.get_moments(keypoints, indices, offsets)
+    counts = grid.counts[indices]
+    neighborhood_sizes = np.bincount(segment_ids, weights=counts, minlength=n_keypoints)
+
+    # EVD of the weighted covariance matrices
+    radius_minus_distances = radius - np.linalg.norm(displacements, axis=1)
+    weighted_cov_matrices = np.bincount(
+        (segment_ids[:, None] * 9 + np.arange(9)).ravel(),
+        weights=(second_moments * radius_minus_distances[:, None, None]).ravel(),
+        minlength=n_keypoints * 9,
+    ).reshape(n_keypoints, 3, 3)
+    weights_sums = np.bincount(
+        segment_ids, weights=counts * radius_minus_distances, minlength=n_keypoints
+    )
+    np.divide(
+        weighted_cov_matrices,
+        weights_sums[:, None, None],
+        out=weighted_cov_matrices,
+        where=weights_sums[:, None, None] != 0,
+    )
+    eigenvalues, eigenvectors = np.linalg.eigh(weighted_cov_matrices)
+
+    # disambiguating the axes with a majority vote on each neighborhood, weighted by the counts of the voxels
+    x_orient = np.einsum("ij,ij->i", displacements, eigenvectors[segment_ids, :, 2])
+    x_negative_votes = np.bincount(
+        segment_ids[x_orient < 0], weights=counts[x_orient < 0], minlength=n_keypoints
+    )
+    eigenvectors[x_negative_votes > neighborhood_sizes - x_negative_votes, :, 2] *= -1
+    z_orient = np.einsum("ij,ij->i", displacements, eigenvectors[segment_ids, :, 0])
+    z_negative_votes = np.bincount(
+        segment_ids[z_orient < 0], weights=counts[z_orient < 0], minlength=n_keypoints
+    )
+    eigenvectors[z_negative_votes > neighborhood_sizes - z_negative_votes, :, 0] *= -1
+    eigenvectors[:, :, 1] = np.cross(eigenvectors[:, :, 0], eigenvectors[:, :, 2])
+
+    local_rfs = np.flip(eigenvectors, axis=2)
+    local_rfs[neighborhood_sizes == 0] = np.eye(3)
 
-    return np.flip(eigenvectors, axis=1)
+    return local_rfs
 
 
 def get_azimuth_idx(
@@ -169,139 +281,272 @@ def interpolate_vertical_volumes(
     return upper_volume, lower_volume, current_volume
 
 
-# noinspection DuplicatedCode
-def compute_single_shot_descriptor(
+def compute_batched_shot_descriptors(
     values: tuple[
-        np.ndarray[np.float64, 3],
         np.ndarray[np.float64],
         np.ndarray[np.float64],
+        np.ndarray[np.float64],
+        np.ndarray[np.int64],
         float,
-        np.ndarray[np.float64, (3, 3)],
+        np.ndarray[np.float64],
         bool,
         int,
     ]
-) -> np.ndarray[np.float64, 352]:
+) -> np.ndarray[np.float64]:
     """
-    Computes a single SHOT descriptor.
+    Computes the SHOT descriptors of a batch of keypoints in a single pass.
+    The neighborhoods are given in a flat layout: the neighbors of keypoint i are neighbors[offsets[i]:offsets[i + 1]].
+    Every bin index and interpolation weight is computed on the whole batch at once, and the contributions are
+    scattered into the descriptors with a single np.bincount on a linearized bin index, which also accumulates the
+    contributions of neighbors that fall into the same bin.
     Arguments are given in a tuple to allow for multiprocessing using multiprocessing.Pool.
 
     Args:
-        values: (point, neighbors, normals, radius, local_rf, normalize, min_neighborhood_size).
+        values: (keypoints, neighbors, neighbors_normals, offsets, radius, local_rfs, normalize, min_neighborhood_size).
 
     Returns:
-        The SHOT descriptor.
+        The SHOT descriptors as a (keypoints.shape[0], 352) array.
     """
     # the number of bins are hardcoded in this version, passing parameters in a multiprocessed settings gets cumbersome
     n_cosine_bins, n_azimuth_bins, n_elevation_bins, n_radial_bins = 11, 8, 2, 2
+    descriptor_size = n_cosine_bins * n_azimuth_bins * n_elevation_bins * n_radial_bins
 
-    descriptor = np.zeros(
-        (n_cosine_bins, n_azimuth_bins, n_elevation_bins, n_radial_bins)
-    )
     (
-        point,
+        keypoints,
         neighbors,
         normals,
+        offsets,
         radius,
-        eigenvectors,
+        local_rfs,
         normalize,
         min_neighborhood_size,
     ) = values
-    rho = np.linalg.norm(neighbors - point, axis=1)
-    if (rho > 0).sum() > min_neighborhood_size:
-        neighbors = neighbors[rho > 0]
-        local_coordinates = (neighbors - point) @ eigenvectors
-        cosine = np.clip(normals[rho > 0] @ eigenvectors[:, 2].T, -1, 1)
-        rho = rho[rho > 0]
-
-        order = np.argsort(rho)
-        rho = rho[order]
-        local_coordinates = local_coordinates[order]
-        cosine = cosine[order]
-
-        # computing the spherical coordinates in the local coordinate system
-        theta = np.arctan2(local_coordinates[:, 1], local_coordinates[:, 0])
-        phi = np.arccos(np.clip(local_coordinates[:, 2] / rho, -1, 1))
-
-        # computing the indices in the histograms
-        cos_bin_pos = (cosine + 1.0) * n_cosine_bins / 2.0 - 0.5
-        cos_bin_idx = np.rint(cos_bin_pos).astype(int)
-        theta_bin_idx = get_azimuth_idx(
-            local_coordinates[:, 0], local_coordinates[:, 1]
-        )
-        # the two arrays below have to be cast as ints, otherwise they will be treated as masks
-        phi_bin_idx = (local_coordinates[:, 2] > 0).astype(int)
-        rho_bin_idx = (rho > radius / 2).astype(int)
-
-        # interpolation on the local bins
-        delta_cos = (
-            cos_bin_pos - cos_bin_idx
-        )  # normalized distance with the neighbor bin
-        delta_cos_sign = np.sign(delta_cos)  # left-neighbor or right-neighbor
-        abs_delta_cos = delta_cos_sign * delta_cos  # probably faster than np.abs
-        # noinspection PyRedundantParentheses
-        descriptor[
-            (cos_bin_idx + delta_cos_sign).astype(int) % n_cosine_bins,
-            theta_bin_idx,
-            phi_bin_idx,
-            rho_bin_idx,
-        ] += abs_delta_cos * (
-            (cos_bin_idx > -0.5) & (cos_bin_idx < n_cosine_bins - 0.5)
-        )
-        descriptor[cos_bin_idx, theta_bin_idx, phi_bin_idx, rho_bin_idx] += (
-            1 - abs_delta_cos
-        )
+    n_keypoints = keypoints.shape[0]
+
+    segment_ids = get_segment_ids(offsets)
+    centered_neighbors = neighbors - keypoints[segment_ids]
+    rho = np.linalg.norm(centered_neighbors, axis=1)
+    # leaving out the keypoints themselves and the neighborhoods that are not dense enough
+    valid_keypoints = (
+        np.bincount(segment_ids[rho > 0], minlength=n_keypoints)
+        > min_neighborhood_size
+    )
+    mask = (rho > 0) & valid_keypoints[segment_ids]
+    segment_ids = segment_ids[mask]
+    rho = rho[mask]
+    neighbors_local_rfs = local_rfs[segment_ids]
+    local_coordinates = np.einsum(
+        "ij,ijk->ik", centered_neighbors[mask], neighbors_local_rfs
+    )
+    cosine = np.clip(
+        np.einsum("ij,ij->i", normals[mask], neighbors_local_rfs[:, :, 2]), -1, 1
+    )
 
-        # interpolation on the adjacent husks
-        outer_bin, inner_bin, current_bin = interpolate_on_adjacent_husks(rho, radius)
-        descriptor[cos_bin_idx, theta_bin_idx, phi_bin_idx, 1] += outer_bin * (
-            rho_bin_idx == 0
+    # computing the spherical coordinates in the local coordinate system
+    theta = np.arctan2(local_coordinates[:, 1], local_coordinates[:, 0])
+    phi = np.arccos(np.clip(local_coordinates[:, 2] / rho, -1, 1))
+
+    # computing the indices in the histograms
+    cos_bin_pos = (cosine + 1.0) * n_cosine_bins / 2.0 - 0.5
+    cos_bin_idx = np.rint(cos_bin_pos).astype(int)
+    theta_bin_idx = get_azimuth_idx(local_coordinates[:, 0], local_coordinates[:, 1])
+    phi_bin_idx = (local_coordinates[:, 2] > 0).astype(int)
+    rho_bin_idx = (rho > radius / 2).astype(int)
+
+    def linearize(
+        cos_idx: np.ndarray[np.int64],
+        theta_idx: np.ndarray[np.int64],
+        phi_idx: np.ndarray[np.int64] | int,
+        rho_idx: np.ndarray[np.int64] | int,
+    ) -> np.ndarray[np.int64]:
+        """
+        Index of a bin in the flattened (n_keypoints * 352,) array of all the descriptors.
+        """
+        return (
+            segment_ids * descriptor_size
+            + ((cos_idx * n_azimuth_bins + theta_idx) * n_elevation_bins + phi_idx)
+            * n_radial_bins
+            + rho_idx
         )
-        descriptor[cos_bin_idx, theta_bin_idx, phi_bin_idx, 0] += inner_bin * (
-            rho_bin_idx == 1
-        )
-        descriptor[cos_bin_idx, theta_bin_idx, phi_bin_idx, rho_bin_idx] += current_bin
 
-        # interpolation between adjacent vertical volumes
-        upper_volume, lower_volume, current_volume = interpolate_vertical_volumes(
-            phi, local_coordinates[:, 2]
-        )
-        descriptor[cos_bin_idx, theta_bin_idx, 1, rho_bin_idx] += upper_volume * (
-            phi_bin_idx == 0
+    current_bin = linearize(cos_bin_idx, theta_bin_idx, phi_bin_idx, rho_bin_idx)
+
+    # interpolation on the local bins
+    delta_cos = cos_bin_pos - cos_bin_idx  # normalized distance with the neighbor bin
+    delta_cos_sign = np.sign(delta_cos)  # left-neighbor or right-neighbor
+    abs_delta_cos = delta_cos_sign * delta_cos
+
+    # interpolation on the adjacent husks
+    outer_bin, inner_bin, current_husk = interpolate_on_adjacent_husks(rho, radius)
+
+    # interpolation between adjacent vertical volumes
+    upper_volume, lower_volume, current_volume = interpolate_vertical_volumes(
+        phi, local_coordinates[:, 2]
+    )
+
+    # interpolation between adjacent horizontal volumes
+    theta_bin_size = 2 * np.pi / n_azimuth_bins
+    delta_theta = np.clip(
+        (theta - (-np.pi + theta_bin_idx * theta_bin_size)) / theta_bin_size - 0.5,
+        -0.5,
+        0.5,
+    )
+    delta_theta_sign = np.sign(delta_theta)  # left-neighbor or right-neighbor
+    abs_delta_theta = delta_theta_sign * delta_theta
+
+    bins = np.concatenate(
+        (
+            linearize(
+                (cos_bin_idx + delta_cos_sign).astype(int) % n_cosine_bins,
+                theta_bin_idx,
+                phi_bin_idx,
+                rho_bin_idx,
+            ),
+            linearize(cos_bin_idx, theta_bin_idx, phi_bin_idx, 1),
+            linearize(cos_bin_idx, theta_bin_idx, phi_bin_idx, 0),
+            linearize(cos_bin_idx, theta_bin_idx, 1, rho_bin_idx),
+            linearize(cos_bin_idx, theta_bin_idx, 0, rho_bin_idx),
+            linearize(
+                cos_bin_idx,
+                (theta_bin_idx + delta_theta_sign).astype(int) % n_azimuth_bins,
+                phi_bin_idx,
+                rho_bin_idx,
+            ),
+            current_bin,
         )
-        descriptor[cos_bin_idx, theta_bin_idx, 0, rho_bin_idx] += lower_volume * (
-            phi_bin_idx == 1
+    )
+    weights = np.concatenate(
+        (
+            abs_delta_cos * ((cos_bin_idx > -0.5) & (cos_bin_idx < n_cosine_bins - 0.5)),
+            outer_bin * (rho_bin_idx == 0),
+            inner_bin * (rho_bin_idx == 1),
+            upper_volume * (phi_bin_idx == 0),
+            lower_volume * (phi_bin_idx == 1),
+            abs_delta_theta,
+            # all the contributions to the current bin are summed before being scattered
+            (1 - abs_delta_cos) + current_husk + current_volume + (1 - abs_delta_theta),
         )
-        descriptor[
-            cos_bin_idx, theta_bin_idx, phi_bin_idx, rho_bin_idx
-        ] += current_volume
-
-        # interpolation between adjacent horizontal volumes
-        # local_coordinates[:, 0] * local_coordinates[:, 1] != 0
-        theta_bin_size = 2 * np.pi / n_azimuth_bins
-        delta_theta = np.clip(
-            (theta - (-np.pi + theta_bin_idx * theta_bin_size)) / theta_bin_size - 0.5,
-            -0.5,
-            0.5,
+    )
+    descriptors = (
+        np.bincount(bins, weights=weights, minlength=n_keypoints * descriptor_size)
+        .astype(np.float64, copy=False)
+        .reshape(n_keypoints, descriptor_size)
+    )
+
+    # normalizing the descriptors to Euclidian norm 1
+    if normalize:
+        descriptors_norm = np.linalg.norm(descriptors, axis=1)
+        np.divide(
+            descriptors,
+            descriptors_norm[:, None],
+            out=descriptors,
+            where=descriptors_norm[:, None] > 0,
         )
-        delta_theta_sign = np.sign(delta_theta)  # left-neighbor or right-neighbor
-        abs_delta_theta = delta_theta_sign * delta_theta
-        descriptor[
-            cos_bin_idx,
-            (theta_bin_idx + delta_theta_sign).astype(int) % n_azimuth_bins,
-            phi_bin_idx,
-            rho_bin_idx,
-        ] += abs_delta_theta
-        descriptor[cos_bin_idx, theta_bin_idx, phi_bin_idx, rho_bin_idx] += (
-            1 - abs_delta_theta
+    return descriptors
+
+
+def compute_multiradius_shot_descriptors(
+    values: tuple[
+        np.ndarray[np.float64],
+        np.ndarray[np.float64],
+        np.ndarray[np.float64],
+        np.ndarray[np.int64],
+        list[float],
+        np.ndarray[np.float64],
+        bool,
+        int,
+    ]
+) -> np.ndarray[np.float64]:
+    """
+    Computes the SHOT descriptors of a batch of keypoints at several radii from their neighborhoods at the largest one.
+    The neighborhoods are given in a flat layout: the neighbors of keypoint i are neighbors[offsets[i]:offsets[i + 1]].
+    Arguments are given in a tuple to allow for multiprocessing using multiprocessing.Pool.
+
+    Args:
+        values: (keypoints, neighbors, neighbors_normals, offsets, radii, local_rfs, normalize, min_neighborhood_size).
+        local_rfs is a (len(radii), keypoints.shape[0], 3, 3) array that holds the local RFs used at each radius.
+
+    Returns:
+        The SHOT descriptors of every radius stacked as a (keypoints.shape[0], 352 * len(radii)) array.
+    """
+    (
+        keypoints,
+        neighbors,
+        normals,
+        offsets,
+        radii,
+        local_rfs,
+        normalize,
+        min_neighborhood_size,
+    ) = values
+    segment_ids = get_segment_ids(offsets)
+    distances = np.linalg.norm(neighbors - keypoints[segment_ids], axis=1)
+
+    descriptors = []
+    for radius, radius_local_rfs in zip(radii, local_rfs):
+        mask = distances <= radius
+        descriptors.append(
+            compute_batched_shot_descriptors(
+                (
+                    keypoints,
+                    neighbors[mask],
+                    normals[mask],
+                    get_offsets(
+                        np.bincount(segment_ids[mask], minlength=keypoints.shape[0])
+                    ),
+                    radius,
+                    radius_local_rfs,
+                    normalize,
+                    min_neighborhood_size,
+                )
+            )
         )
+    return np.hstack(descriptors)
+
+
+def compute_single_shot_descriptor(
+    values: tuple[
+        np.ndarray[np.float64, 3],
+        np.ndarray[np.float64],
+        np.ndarray[np.float64],
+        float,
+        np.ndarray[np.float64, (3, 3)],
+        bool,
+        int,
+    ]
+) -> np.ndarray[np.float64, 352]:
+    """
+    Computes a single SHOT descriptor.
+    Arguments are given in a tuple to allow for multiprocessing using multiprocessing.Pool.
+    Use compute_batched_shot_descriptors to compute several descriptors at once.
 
-        # normalizing the descriptor to Euclidian norm 1
-        if (descriptor_norm := np.linalg.norm(descriptor)) > 0:
-            if normalize:
-                return descriptor.ravel() / descriptor_norm
-            else:
-                return descriptor.ravel()
-    return np.zeros(n_cosine_bins * n_azimuth_bins * n_elevation_bins * n_radial_bins)
+    Args:
+        values: (point, neighbors, normals, radius, local_rf, normalize, min_neighborhood_size).
+
+    Returns:
+        The SHOT descriptor.
+    """
+    (
+        point,
+        neighbors,
+        normals,
+        radius,
+        eigenvectors,
+        normalize,
+        min_neighborhood_size,
+    ) = values
+    return compute_batched_shot_descriptors(
+        (
+            point[None, :],
+            neighbors,
+            normals,
+            np.array([0, neighbors.shape[0]]),
+            radius,
+            eigenvectors[None, :, :],
+            normalize,
+            min_neighborhood_size,
+        )
+    )[0]
 
 
 # noinspection DuplicatedCode
@@ -335,7 +580,7 @@ def compute_shot_descriptor(
         n_radial_bins == 2
     ), "Generic function for other than 2 radial divisions not implemented"
 
-    kdtree = KDTree(cloud_points)
+    kdtree = create_spatial_index(cloud_points)
     neighborhoods = kdtree.query_radius(keypoints, radius)
 
     all_descriptors = np.zeros(
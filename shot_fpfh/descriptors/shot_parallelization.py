@@ -1,31 +1,118 @@
 from dataclasses import dataclass
-from multiprocessing import Pool
 from types import TracebackType
+from typing import Iterator
 
 import numpy as np
-from sklearn.neighbors import KDTree
 from tqdm import tqdm
 
-from shot_fpfh.base_computation import grid_subsampling
-from .shot import get_local_rf, compute_single_shot_descriptor
+from shot_fpfh.base_computation import (
+    MultiRadiusNeighborhoods,
+    NeighborhoodGraph,
+    SpatialIndex,
+    SpatialIndexBackend,
+    SpatialIndexCache,
+    VoxelMomentGrid,
+    VoxelPyramid,
+    as_neighborhood_graph,
+    create_spatial_index,
+    grid_subsampling,
+)
+from shot_fpfh.utils import (
+    Executor,
+    ExecutorType,
+    SharedArrayHandle,
+    attach_shared_arrays,
+    create_executor,
+)
+from .numba_kernels import (
+    Backend,
+    compute_multiradius_shot_descriptors_numba,
+    get_batched_local_rfs_numba,
+    resolve_backend,
+    set_n_threads,
+)
+from .shot import (
+    get_approximate_local_rfs,
+    get_batched_local_rfs,
+    compute_multiradius_shot_descriptors,
+)
+
+
+def compute_shot_descriptors_on_shared_block(
+    values: tuple[
+        dict[str, SharedArrayHandle | np.ndarray], int, int, list[float], bool, int
+    ]
+) -> np.ndarray[np.float64]:
+    """
+    Computes the SHOT descriptors of a block of keypoints whose data was published in shared memory.
+    Arguments are given in a tuple to allow for multiprocessing using multiprocessing.Pool.
+
+    Args:
+        values: (handles, start, stop, radii, normalize, min_neighborhood_size). The handles refer to the keypoints,
+        the support, its normals, the local RFs and the neighborhoods in a flat layout (indices and offsets).
+
+    Returns:
+        The SHOT descriptors of keypoints[start:stop] at every radius.
+    """
+    handles, start, stop, radii, normalize, min_neighborhood_size = values
+    arrays = attach_shared_arrays(handles)
+    offsets = arrays["offsets"][start : stop + 1]
+    indices = arrays["indices"][offsets[0] : offsets[-1]]
+    return compute_multiradius_shot_descriptors(
+        (
+            arrays["keypoints"][start:stop],
+            arrays["support"][indices],
+            arrays["normals"][indices],
+            offsets - offsets[0],
+            radii,
+            arrays["local_rfs"][:, start:stop],
+            normalize,
+            min_neighborhood_size,
+        )
+    )
 
 
 @dataclass
 class ShotMultiprocessor:
     """
     Base class to compute SHOT descriptors in parallel on multiple processes.
+    With use_shared_memory, the support, its normals and the neighborhoods are published once in shared memory instead
+    of being pickled to the workers, which only receive the bounds of the blocks of keypoints they process.
+    A long-lived executor can be provided to reuse its workers, otherwise one of type executor_type is started upon
+    entering the context and stopped on exit. The thread and serial executors always share the arrays without copy.
+    With the numba backend, the kernels are compiled and run in parallel on n_procs threads of the current process
+    instead of a pool of worker processes. It falls back to the numpy backend if Numba is not installed.
+    With lrf_voxel_size, the local reference frames are approximated from the statistics of the voxels of that size
+    overlapped by the neighborhoods, which makes their cost independent of the number of points in large spheres. The
+    approximation is not neutral: the points of a voxel vote together on the sign of the axes, which flips the x-axis
+    of about 9% of the keypoints with voxels of a tenth of the radius and about 20% with a fifth of the radius, and
+    changes the descriptors of these keypoints accordingly. It is meant for large radii where speed prevails.
+    The neighborhoods are searched with a spatial index of type spatial_index_backend (the default one if empty).
     """
 
     normalize: bool = True
     share_local_rfs: bool = True
     min_neighborhood_size: int = 100
+    lrf_voxel_size: float | None = None
 
     n_procs: int = 8
+    backend: Backend = "numpy"
+    use_shared_memory: bool = False
+    executor_type: ExecutorType = "process"
+    executor: Executor | None = None
+    spatial_index_backend: SpatialIndexBackend | None = None
     disable_progress_bar: bool = False
     verbose: bool = True
 
+    def __post_init__(self):
+        self.backend = resolve_backend(self.backend)
+
     def __enter__(self):
-        self.pool = Pool(processes=self.n_procs)
+        self.owns_executor = self.executor is None and self.backend == "numpy"
+        if self.backend == "numba":
+            set_n_threads(self.n_procs)
+        elif self.owns_executor:
+            self.executor = create_executor(self.executor_type, self.n_procs)
         return self
 
     def __exit__(
@@ -34,68 +121,109 @@ class ShotMultiprocessor:
         exc_val: Exception | None,
         exc_tb: TracebackType | None,
     ) -> None:
+        if not self.owns_executor:
+            return
         if exc_type is not None:
-            self.pool.terminate()
+            self.executor.terminate()
         else:
-            self.pool.close()
-        self.pool.join()
+            self.executor.close()
+        self.executor = None
 
     def compute_local_rf(
         self,
         keypoints: np.ndarray[np.float64],
-        neighborhoods: np.ndarray[np.object_],
+        neighborhoods: NeighborhoodGraph
+        | np.ndarray[np.object_]
+        | tuple[np.ndarray[np.int64], np.ndarray[np.int64]],
         support: np.ndarray[np.float64],
         radius: float,
+        show_progress: bool = True,
+        voxel_grid: VoxelMomentGrid | None = None,
     ) -> np.ndarray[np.float64]:
         """
-        Parallelization of the function get_local_rf.
+        Computation of the local reference frames with the batched function get_batched_local_rfs.
+        This step is vectorized and performed in the main process: it costs about as much as a single stacked
+        eigendecomposition, which is less than the inter-process communication it would require.
 
         Args:
             support: The supporting point cloud.
             keypoints: The keypoints to compute local reference frames on.
             radius: The radius used to compute the local reference frames.
-            neighborhoods: The neighborhoods associated with each keypoint. neighborhoods[i] should be an array of ints.
+            neighborhoods: The neighborhoods associated with each keypoint, as a NeighborhoodGraph. The output of
+            KDTree.query_radius and a flat layout given as a tuple (indices, offsets) are also accepted.
+            show_progress: Whether the progress bar is displayed, unless disabled on the instance.
+            voxel_grid: The statistics of the voxels of size lrf_voxel_size of the support. Leave empty to build them.
+            Only used with lrf_voxel_size.
 
         Returns:
             The local reference frames computed on every keypoint.
         """
-        return np.array(
-            list(
-                tqdm(
-                    self.pool.imap(
-                        get_local_rf,
-                        [
-                            (
-                                keypoint,
-                                support[neighborhoods[i]],
-                                radius,
-                            )
-                            for i, keypoint in enumerate(keypoints)
-                        ],
-                    ),
+        if self.lrf_voxel_size is not None:
+            if voxel_grid is None:
+                voxel_grid = VoxelMomentGrid(support, self.lrf_voxel_size)
+            return get_approximate_local_rfs(keypoints, voxel_grid, radius)
+        graph = as_neighborhood_graph(neighborhoods)
+        indices, offsets = graph.indices, graph.offsets
+        if self.backend == "numba":
+            return get_batched_local_rfs_numba(
+                keypoints, support, indices, offsets, radius
+            )
+        blocks = self.split_in_blocks(keypoints.shape[0])
+        return np.vstack(
+            [np.zeros((0, 3, 3))]
+            + [
+                get_batched_local_rfs(
+                    (
+                        keypoints[start:stop],
+                        support[indices[offsets[start] : offsets[stop]]],
+                        offsets[start : stop + 1] - offsets[start],
+                        radius,
+                    )
+                )
+                for start, stop in tqdm(
+                    blocks,
                     desc=f"Local RFs with radius {radius}",
-                    total=keypoints.shape[0],
-                    disable=self.disable_progress_bar,
+                    disable=self.disable_progress_bar or not show_progress,
                 )
-            )
+            ]
         )
 
+    def split_in_blocks(self, n_keypoints: int) -> list[tuple[int, int]]:
+        """
+        Splits the keypoints in contiguous blocks, two per process, that are each processed in a single task.
+
+        Args:
+            n_keypoints: The number of keypoints to split.
+
+        Returns:
+            The (start, stop) bounds of each block.
+        """
+        block_size = max(int(np.ceil(n_keypoints / (2 * self.n_procs))), 1)
+        return [
+            (start, min(start + block_size, n_keypoints))
+            for start in range(0, n_keypoints, block_size)
+        ]
+
     def compute_descriptor(
         self,
         keypoints: np.ndarray[np.float64],
         normals: np.ndarray[np.float64],
-        neighborhoods: np.ndarray[np.object_],
+        neighborhoods: NeighborhoodGraph
+        | np.ndarray[np.object_]
+        | tuple[np.ndarray[np.int64], np.ndarray[np.int64]],
         local_rfs: np.ndarray[np.float64],
         support: np.ndarray[np.float64],
         radius: float,
     ) -> np.ndarray[np.float64]:
         """
-        Parallelization of the function compute_single_shot_descriptor.
+        Parallelization of the function compute_batched_shot_descriptors.
+        The keypoints are split in blocks whose neighborhoods are concatenated and processed in a single pass.
 
         Args:
             keypoints: The keypoints to compute descriptors on.
             normals: The normals of points in the support.
-            neighborhoods: The neighborhoods associated with each keypoint. neighborhoods[i] should be an array of ints.
+            neighborhoods: The neighborhoods associated with each keypoint, as a NeighborhoodGraph. The output of
+            KDTree.query_radius and a flat layout given as a tuple (indices, offsets) are also accepted.
             local_rfs: The local reference frames associated with each keypoint.
             support: The supporting point cloud.
             radius: The radius used to compute SHOT.
@@ -103,30 +231,184 @@ class ShotMultiprocessor:
         Returns:
             The descriptor computed on every keypoint.
         """
-        return np.array(
-            list(
+        return self.compute_multiradius_descriptor(
+            keypoints=keypoints,
+            normals=normals,
+            neighborhoods=neighborhoods,
+            local_rfs=local_rfs[None, :, :, :],
+            support=support,
+            radii=[radius],
+        )
+
+    def compute_multiradius_descriptor(
+        self,
+        keypoints: np.ndarray[np.float64],
+        normals: np.ndarray[np.float64],
+        neighborhoods: NeighborhoodGraph
+        | np.ndarray[np.object_]
+        | tuple[np.ndarray[np.int64], np.ndarray[np.int64]],
+        local_rfs: np.ndarray[np.float64],
+        support: np.ndarray[np.float64],
+        radii: list[float],
+        show_progress: bool = True,
+    ) -> np.ndarray[np.float64]:
+        """
+        Parallelization of the function compute_multiradius_shot_descriptors.
+        Each task computes the descriptors of a block of keypoints at every radius.
+
+        Args:
+            keypoints: The keypoints to compute descriptors on.
+            normals: The normals of points in the support.
+            neighborhoods: The neighborhoods at the largest radius, as a NeighborhoodGraph (or any layout accepted by
+            compute_local_rf).
+            local_rfs: The local reference frames used at each radius as a (len(radii), keypoints.shape[0], 3, 3) array.
+            support: The supporting point cloud.
+            radii: The radii used to compute SHOT.
+            show_progress: Whether the progress bar is displayed, unless disabled on the instance.
+
+        Returns:
+            The descriptors computed on every keypoint as a (keypoints.shape[0], 352 * len(radii)) array.
+        """
+        graph = as_neighborhood_graph(neighborhoods)
+        indices, offsets = graph.indices, graph.offsets
+        if self.backend == "numba":
+            return compute_multiradius_shot_descriptors_numba(
+                keypoints,
+                support,
+                normals,
+                indices,
+                offsets,
+                np.asarray(radii, dtype=np.float64),
+                local_rfs,
+                self.normalize,
+                self.min_neighborhood_size,
+            )
+        blocks = self.split_in_blocks(keypoints.shape[0])
+        description = (
+            f"SHOT desc with radius {', '.join(str(radius) for radius in radii)}"
+        )
+        if self.use_shared_memory or self.executor.zero_copy:
+            with self.executor.share(
+                keypoints=keypoints,
+                support=support,
+                normals=normals,
+                indices=indices,
+                offsets=offsets,
+                local_rfs=local_rfs,
+            ) as handles:
+                descriptors = list(
+                    tqdm(
+                        self.executor.imap(
+                            compute_shot_descriptors_on_shared_block,
+                            (
+                                (
+                                    handles,
+                                    start,
+                                    stop,
+                                    radii,
+                                    self.normalize,
+                                    self.min_neighborhood_size,
+                                )
+                                for start, stop in blocks
+                            ),
+                        ),
+                        desc=description,
+                        total=len(blocks),
+                        disable=self.disable_progress_bar or not show_progress,
+                    )
+                )
+        else:
+            descriptors = list(
                 tqdm(
-                    self.pool.imap(
-                        compute_single_shot_descriptor,
-                        [
+                    self.executor.imap(
+                        compute_multiradius_shot_descriptors,
+                        (
                             (
-                                keypoint,
-                                support[neighborhoods[i]],
-                                normals[neighborhoods[i]],
-                                radius,
-                                local_rfs[i],
+                                keypoints[start:stop],
+                                support[indices[offsets[start] : offsets[stop]]],
+                                normals[indices[offsets[start] : offsets[stop]]],
+                                offsets[start : stop + 1] - offsets[start],
+                                radii,
+                                local_rfs[:, start:stop],
                                 self.normalize,
                                 self.min_neighborhood_size,
                             )
-                            for i, keypoint in enumerate(keypoints)
-                        ],
-                        chunksize=int(np.ceil(keypoints.shape[0] / (2 * self.n_procs))),
+                            for start, stop in blocks
+                        ),
                     ),
-                    desc=f"SHOT desc with radius {radius}",
-                    total=keypoints.shape[0],
-                    disable=self.disable_progress_bar,
+                    desc=description,
+                    total=len(blocks),
+                    disable=self.disable_progress_bar or not show_progress,
                 )
             )
+        return np.vstack([np.zeros((0, 352 * len(radii)))] + descriptors)
+
+    def get_support(
+        self,
+        point_cloud: np.ndarray[np.float64],
+        normals: np.ndarray[np.float64],
+        subsampling_voxel_size: float | None,
+        pyramid: VoxelPyramid | None = None,
+    ) -> tuple[np.ndarray[np.float64], np.ndarray[np.float64]]:
+        """
+        Selects the support point cloud used to compute the descriptors.
+
+        Args:
+            point_cloud: The entire point cloud.
+            normals: The normals computed on the point cloud.
+            subsampling_voxel_size: Subsampling strength. Leave empty to keep the whole support.
+            pyramid: Cached subsamplings of the point cloud. Leave empty to subsample the point cloud from scratch.
+
+        Returns:
+            The support and its normals.
+        """
+        if subsampling_voxel_size is None:
+            return point_cloud, normals
+        support = (
+            pyramid.subsample(subsampling_voxel_size)
+            if pyramid is not None
+            else grid_subsampling(point_cloud, subsampling_voxel_size)
+        )
+        if self.verbose:
+            print(
+                f"Keeping a support of {support.shape[0]} points out of {point_cloud.shape[0]} "
+                f"(voxel size: {subsampling_voxel_size})"
+            )
+        return point_cloud[support], normals[support]
+
+    def get_support_kdtree(
+        self,
+        point_cloud: np.ndarray[np.float64],
+        support: np.ndarray[np.float64],
+        subsampling_voxel_size: float | None,
+        pyramid: VoxelPyramid | None = None,
+        spatial_indices: SpatialIndexCache | None = None,
+    ) -> SpatialIndex:
+        """
+        Retrieves the spatial index built on the support.
+        A subsampled support can only be found in cache along with the pyramid that holds its indices.
+
+        Args:
+            point_cloud: The entire point cloud.
+            support: The support as returned by get_support.
+            subsampling_voxel_size: Subsampling strength. Leave empty to keep the whole support.
+            pyramid: Cached subsamplings of the point cloud.
+            spatial_indices: Cached spatial indices of the point cloud and its subsamplings. Leave empty to build it.
+
+        Returns:
+            The spatial index built on the support.
+        """
+        if spatial_indices is None or (
+            subsampling_voxel_size is not None and pyramid is None
+        ):
+            return create_spatial_index(support, self.spatial_index_backend)
+        return spatial_indices.get(
+            point_cloud,
+            subsampling_voxel_size,
+            None
+            if subsampling_voxel_size is None
+            else pyramid.subsample(subsampling_voxel_size),
+            self.spatial_index_backend,
         )
 
     def compute_descriptor_single_scale(
@@ -136,6 +418,8 @@ class ShotMultiprocessor:
         keypoints: np.ndarray[np.float64],
         radius: float,
         subsampling_voxel_size: float | None = None,
+        pyramid: VoxelPyramid | None = None,
+        spatial_indices: SpatialIndexCache | None = None,
     ) -> np.ndarray[np.float64]:
         """
         Computes the SHOT descriptor on a single scale.
@@ -147,36 +431,35 @@ class ShotMultiprocessor:
             keypoints: The keypoints to compute descriptors on.
             radius: Radius used to compute the SHOT descriptors.
             subsampling_voxel_size: Subsampling strength. Leave empty to keep the whole support.
+            pyramid: Cached subsamplings of the point cloud. Leave empty to subsample the point cloud from scratch.
+            spatial_indices: Cached spatial indices of the point cloud and its subsamplings. Leave empty to build them.
 
         Returns:
             The descriptor as a (self.keypoints.shape[0], 352) array.
         """
-        support = (
-            grid_subsampling(point_cloud, subsampling_voxel_size)
-            if subsampling_voxel_size is not None
-            else None
+        support, support_normals = self.get_support(
+            point_cloud, normals, subsampling_voxel_size, pyramid
+        )
+        neighborhoods = NeighborhoodGraph.search(
+            self.get_support_kdtree(
+                point_cloud, support, subsampling_voxel_size, pyramid, spatial_indices
+            ),
+            keypoints,
+            radius,
         )
-        if self.verbose and support is not None:
-            print(
-                f"Keeping a support of {support.shape[0]} points out of {point_cloud.shape[0]} "
-                f"(voxel size: {subsampling_voxel_size:.2f})"
-            )
-        neighborhoods = KDTree(
-            point_cloud[support] if support is not None else point_cloud
-        ).query_radius(keypoints, radius)
         local_rfs = self.compute_local_rf(
             keypoints=keypoints,
             neighborhoods=neighborhoods,
-            support=point_cloud[support] if support is not None else point_cloud,
+            support=support,
             radius=radius,
         )
         return self.compute_descriptor(
             keypoints=keypoints,
-            normals=normals[support] if support is not None else normals,
+            normals=support_normals,
             neighborhoods=neighborhoods,
             local_rfs=local_rfs,
             radius=radius,
-            support=point_cloud[support] if support is not None else point_cloud,
+            support=support,
         )
 
     def compute_descriptor_bi_scale(
@@ -187,10 +470,13 @@ class ShotMultiprocessor:
         local_rf_radius: float,
         shot_radius: float,
         subsampling_voxel_size: float | None = None,
+        pyramid: VoxelPyramid | None = None,
+        spatial_indices: SpatialIndexCache | None = None,
     ) -> np.ndarray[np.float64]:
         """
         Computes the SHOT descriptor on a point cloud with two distinct radii: one for the computation of the local
         reference frames and the other one for the computation of the descriptor.
+        Both neighborhoods are retrieved with a single radius search.
         Normals are expected to be normalized to 1.
 
         Args:
@@ -200,41 +486,179 @@ class ShotMultiprocessor:
             local_rf_radius: Radius used to compute the local reference frames.
             shot_radius: Radius used to compute the SHOT descriptors.
             subsampling_voxel_size: Subsampling strength. Leave empty to keep the whole support.
+            pyramid: Cached subsamplings of the point cloud. Leave empty to subsample the point cloud from scratch.
+            spatial_indices: Cached spatial indices of the point cloud and its subsamplings. Leave empty to build them.
 
         Returns:
             The descriptor as a (self.keypoints.shape[0], 352) array.
         """
-        support = (
-            grid_subsampling(point_cloud, subsampling_voxel_size)
-            if subsampling_voxel_size is not None
-            else None
+        support, support_normals = self.get_support(
+            point_cloud, normals, subsampling_voxel_size, pyramid
+        )
+        neighborhoods = MultiRadiusNeighborhoods(
+            support,
+            keypoints,
+            [local_rf_radius, shot_radius],
+            kdtree=self.get_support_kdtree(
+                point_cloud, support, subsampling_voxel_size, pyramid, spatial_indices
+            ),
         )
-        if self.verbose and support is not None:
-            print(
-                f"Keeping a support of {support.shape[0]} points out of {point_cloud.shape[0]} "
-                f"(voxel size: {subsampling_voxel_size})"
-            )
-        neighborhoods = KDTree(
-            point_cloud[support] if support is not None else point_cloud
-        ).query_radius(keypoints, local_rf_radius)
         local_rfs = self.compute_local_rf(
             keypoints=keypoints,
-            neighborhoods=neighborhoods,
-            support=point_cloud[support] if support is not None else point_cloud,
+            neighborhoods=neighborhoods.restrict(local_rf_radius),
+            support=support,
             radius=local_rf_radius,
         )
-        neighborhoods = KDTree(point_cloud[support]).query_radius(
-            keypoints, shot_radius
-        )
         return self.compute_descriptor(
             keypoints=keypoints,
-            normals=normals[support] if support is not None else normals,
-            neighborhoods=neighborhoods,
+            normals=support_normals,
+            neighborhoods=neighborhoods.restrict(shot_radius),
             local_rfs=local_rfs,
             radius=shot_radius,
-            support=point_cloud[support] if support is not None else point_cloud,
+            support=support,
         )
 
+    def get_multiscale_supports(
+        self,
+        point_cloud: np.ndarray[np.float64],
+        normals: np.ndarray[np.float64],
+        n_scales: int,
+        voxel_sizes: list[float] | np.ndarray[np.float64] | None = None,
+        pyramid: VoxelPyramid | None = None,
+        spatial_indices: SpatialIndexCache | None = None,
+    ) -> list[
+        tuple[
+            np.ndarray[np.float64],
+            np.ndarray[np.float64],
+            SpatialIndex,
+            VoxelMomentGrid | None,
+            list[int],
+        ]
+    ]:
+        """
+        Groups the scales by support and prepares each support once.
+
+        Args:
+            point_cloud: The entire point cloud.
+            normals: The normals computed on the point cloud.
+            n_scales: The number of scales.
+            voxel_sizes: The voxel sizes used to subsample the support. Leave empty to keep the whole support.
+            pyramid: Cached subsamplings of the point cloud. Leave empty to subsample the point cloud from scratch.
+            spatial_indices: Cached spatial indices of the point cloud and its subsamplings. Leave empty to build them.
+
+        Returns:
+            For each distinct support, the support, its normals, the spatial index built on it, the statistics of its voxels
+            of size lrf_voxel_size (None without lrf_voxel_size) and the scales it is used by.
+        """
+        scales_per_voxel_size: dict[float | None, list[int]] = {}
+        for scale in range(n_scales):
+            scales_per_voxel_size.setdefault(
+                voxel_sizes[scale] if voxel_sizes is not None else None, []
+            ).append(scale)
+
+        supports = []
+        for voxel_size, scales in scales_per_voxel_size.items():
+            support, support_normals = self.get_support(
+                point_cloud, normals, voxel_size, pyramid
+            )
+            kdtree = self.get_support_kdtree(
+                point_cloud, support, voxel_size, pyramid, spatial_indices
+            )
+            voxel_grid = (
+                VoxelMomentGrid(support, self.lrf_voxel_size)
+                if self.lrf_voxel_size is not None
+                else None
+            )
+            supports.append((support, support_normals, kdtree, voxel_grid, scales))
+        return supports
+
+    def compute_multiscale_block(
+        self,
+        keypoints: np.ndarray[np.float64],
+        supports: list[
+            tuple[
+                np.ndarray[np.float64],
+                np.ndarray[np.float64],
+                SpatialIndex,
+                VoxelMomentGrid | None,
+                list[int],
+            ]
+        ],
+        radii: list[float] | np.ndarray[np.float64],
+        weights: list[float] | np.ndarray[np.float64],
+        local_rf_radius: float | None = None,
+        show_progress: bool = True,
+    ) -> np.ndarray[np.float64]:
+        """
+        Computes the SHOT descriptors of a set of keypoints on multiple scales.
+        The scales that share the same support are computed from a single radius search at the largest of their radii,
+        and in the same tasks.
+
+        Args:
+            keypoints: The keypoints to compute descriptors on.
+            supports: The supports as returned by get_multiscale_supports.
+            radii: The radii to compute the descriptors with.
+            weights: The weights to multiply each scale with.
+            local_rf_radius: Radius used to compute the local reference frames of every scale on the first support.
+            Leave empty to use the radius of each scale, or the one of the first scale if the local RFs are shared.
+            show_progress: Whether the progress bars of the computation are displayed.
+
+        Returns:
+            The descriptor as a (keypoints.shape[0], 352 * n_scales) array.
+        """
+        all_descriptors = np.zeros((keypoints.shape[0], 352 * len(radii)))
+
+        local_rfs = None
+        for support, support_normals, kdtree, voxel_grid, scales in supports:
+            scales_radii = [radii[scale] for scale in scales]
+            use_local_rf_radius = local_rf_radius is not None and local_rfs is None
+            neighborhoods = MultiRadiusNeighborhoods(
+                support,
+                keypoints,
+                scales_radii + ([local_rf_radius] if use_local_rf_radius else []),
+                kdtree=kdtree,
+            )
+            if use_local_rf_radius:
+                local_rfs = self.compute_local_rf(
+                    keypoints=keypoints,
+                    neighborhoods=neighborhoods.restrict(local_rf_radius),
+                    support=support,
+                    radius=local_rf_radius,
+                    show_progress=show_progress,
+                    voxel_grid=voxel_grid,
+                )
+            scales_local_rfs = []
+            for scale in scales:
+                # if shared, only using the smallest radius to determine the local RF
+                if local_rfs is None or (
+                    local_rf_radius is None and not self.share_local_rfs
+                ):
+                    # recomputing the local rfs if not shared
+                    local_rfs = self.compute_local_rf(
+                        keypoints=keypoints,
+                        neighborhoods=neighborhoods.restrict(radii[scale]),
+                        support=support,
+                        radius=radii[scale],
+                        show_progress=show_progress,
+                        voxel_grid=voxel_grid,
+                    )
+                scales_local_rfs.append(local_rfs)
+            descriptors = self.compute_multiradius_descriptor(
+                keypoints=keypoints,
+                normals=support_normals,
+                neighborhoods=neighborhoods.restrict(max(scales_radii)),
+                local_rfs=np.stack(scales_local_rfs),
+                support=support,
+                radii=scales_radii,
+                show_progress=show_progress,
+            )
+            for i, scale in enumerate(scales):
+                all_descriptors[:, 352 * scale : 352 * (scale + 1)] = (
+                    descriptors[:, 352 * i : 352 * (i + 1)] * weights[scale]
+                )
+
+        return all_descriptors
+
     def compute_descriptor_multiscale(
         self,
         point_cloud: np.ndarray[np.float64],
@@ -243,9 +667,13 @@ class ShotMultiprocessor:
         radii: list[float] | np.ndarray[np.float64],
         voxel_sizes: list[float] | np.ndarray[np.float64] | None = None,
         weights: list[float] | np.ndarray[np.float64] | None = None,
+        pyramid: VoxelPyramid | None = None,
+        spatial_indices: SpatialIndexCache | None = None,
     ) -> np.ndarray[np.float64]:
         """
         Computes the SHOT descriptor on multiple scales.
+        The scales that share the same support are computed from a single radius search at the largest of their radii,
+        and in the same tasks.
         Normals are expected to be normalized to 1.
 
         Args:
@@ -255,55 +683,131 @@ class ShotMultiprocessor:
             radii: The radii to compute the descriptors with.
             voxel_sizes: The voxel sizes used to subsample the support. Leave empty to keep the whole support.
             weights: The weights to multiply each scale with. Leave empty to multiply by 1.
+            pyramid: Cached subsamplings of the point cloud. Leave empty to subsample the point cloud from scratch.
+            spatial_indices: Cached spatial indices of the point cloud and its subsamplings. Leave empty to build them.
 
         Returns:
             The descriptor as a (self.keypoints.shape[0], 352 * n_scales) array.
         """
-        if weights is None:
-            weights = np.ones(len(radii))
+        return self.compute_multiscale_block(
+            keypoints=keypoints,
+            supports=self.get_multiscale_supports(
+                point_cloud, normals, len(radii), voxel_sizes, pyramid, spatial_indices
+            ),
+            radii=radii,
+            weights=weights if weights is not None else np.ones(len(radii)),
+        )
 
-        all_descriptors = np.zeros((len(radii), keypoints.shape[0], 352))
+    def iter_descriptor_blocks(
+        self,
+        point_cloud: np.ndarray[np.float64],
+        normals: np.ndarray[np.float64],
+        keypoints: np.ndarray[np.float64],
+        radii: list[float] | np.ndarray[np.float64],
+        voxel_sizes: list[float] | np.ndarray[np.float64] | None = None,
+        weights: list[float] | np.ndarray[np.float64] | None = None,
+        local_rf_radius: float | None = None,
+        block_size: int = 16384,
+        pyramid: VoxelPyramid | None = None,
+        spatial_indices: SpatialIndexCache | None = None,
+    ) -> Iterator[tuple[int, np.ndarray[np.float64]]]:
+        """
+        Computes the SHOT descriptors block of keypoints by block of keypoints.
+        The neighborhoods are only retrieved for the keypoints of the current block, which bounds the peak memory by the
+        block size instead of the number of keypoints. The supports, their spatial indices and their voxel statistics are
+        built once.
+        The scales are handled like in compute_descriptor_multiscale. The single-scale descriptor corresponds to a
+        single radius, and the bi-scale one to a single radius along with a local_rf_radius.
+        Normals are expected to be normalized to 1.
 
-        local_rfs = None
-        for scale, radius in enumerate(radii):
-            # choosing the support point cloud
-            support = (
-                grid_subsampling(point_cloud, voxel_sizes[scale])
-                if voxel_sizes is not None
-                else None
-            )
-            if self.verbose and support is not None:
-                print(
-                    f"Keeping a support of {support.shape[0]} points out of {point_cloud.shape[0]} "
-                    f"(voxel size: {voxel_sizes[scale]})"
-                )
-            neighborhoods = KDTree(
-                point_cloud[support] if support is not None else point_cloud
-            ).query_radius(keypoints, radius)
+        Args:
+            point_cloud: The entire point cloud.
+            normals: The normals computed on the point cloud.
+            keypoints: The keypoints to compute descriptors on.
+            radii: The radii to compute the descriptors with.
+            voxel_sizes: The voxel sizes used to subsample the support. Leave empty to keep the whole support.
+            weights: The weights to multiply each scale with. Leave empty to multiply by 1.
+            local_rf_radius: Radius used to compute the local reference frames. Leave empty to use the radius of the
+            scales.
+            block_size: Number of keypoints per block.
+            pyramid: Cached subsamplings of the point cloud. Leave empty to subsample the point cloud from scratch.
+            spatial_indices: Cached spatial indices of the point cloud and its subsamplings. Leave empty to build them.
 
-            # if shared, only using the smallest radius to determine the local RF
-            if local_rfs is None or not self.share_local_rfs:
-                # recomputing the local rfs if not shared
-                local_rfs = self.compute_local_rf(
-                    keypoints=keypoints,
-                    neighborhoods=neighborhoods,
-                    support=point_cloud[support]
-                    if support is not None
-                    else point_cloud,
-                    radius=radius,
-                )
-            all_descriptors[scale, :, :] = (
-                self.compute_descriptor(
-                    keypoints=keypoints,
-                    normals=normals[support] if support is not None else normals,
-                    neighborhoods=neighborhoods,
-                    local_rfs=local_rfs,
-                    radius=radius,
-                    support=point_cloud[support]
-                    if support is not None
-                    else point_cloud,
-                )
-                * weights[scale]
+        Yields:
+            The index of the first keypoint of the block and the descriptors of the block as a
+            (block_size, 352 * n_scales) array (smaller for the last block).
+        """
+        if weights is None:
+            weights = np.ones(len(radii))
+        supports = self.get_multiscale_supports(
+            point_cloud, normals, len(radii), voxel_sizes, pyramid, spatial_indices
+        )
+        for start in tqdm(
+            range(0, keypoints.shape[0], block_size),
+            desc="SHOT desc by block",
+            disable=self.disable_progress_bar,
+        ):
+            yield start, self.compute_multiscale_block(
+                keypoints=keypoints[start : start + block_size],
+                supports=supports,
+                radii=radii,
+                weights=weights,
+                local_rf_radius=local_rf_radius,
+                show_progress=False,
             )
 
-        return all_descriptors.reshape(keypoints.shape[0], 352 * len(radii))
+    def compute_descriptor_into(
+        self,
+        out: np.ndarray[np.float64],
+        point_cloud: np.ndarray[np.float64],
+        normals: np.ndarray[np.float64],
+        keypoints: np.ndarray[np.float64],
+        radii: list[float] | np.ndarray[np.float64],
+        voxel_sizes: list[float] | np.ndarray[np.float64] | None = None,
+        weights: list[float] | np.ndarray[np.float64] | None = None,
+        local_rf_radius: float | None = None,
+        block_size: int = 16384,
+        pyramid: VoxelPyramid | None = None,
+        spatial_indices: SpatialIndexCache | None = None,
+    ) -> np.ndarray[np.float64]:
+        """
+        Computes the SHOT descriptors block by block with iter_descriptor_blocks and writes them into an array provided
+        by the caller, typically a np.memmap too large to be held in memory.
+
+        Args:
+            out: The (keypoints.shape[0], 352 * n_scales) array to write the descriptors into.
+            point_cloud: The entire point cloud.
+            normals: The normals computed on the point cloud.
+            keypoints: The keypoints to compute descriptors on.
+            radii: The radii to compute the descriptors with.
+            voxel_sizes: The voxel sizes used to subsample the support. Leave empty to keep the whole support.
+            weights: The weights to multiply each scale with. Leave empty to multiply by 1.
+            local_rf_radius: Radius used to compute the local reference frames. Leave empty to use the radius of the
+            scales.
+            block_size: Number of keypoints per block.
+            pyramid: Cached subsamplings of the point cloud. Leave empty to subsample the point cloud from scratch.
+            spatial_indices: Cached spatial indices of the point cloud and its subsamplings. Leave empty to build them.
+
+        Returns:
+            The output array.
+        """
+        assert out.shape == (
+            keypoints.shape[0],
+            352 * len(radii),
+        ), "Incorrect shape of the output array."
+        for start, descriptors in self.iter_descriptor_blocks(
+            point_cloud=point_cloud,
+            normals=normals,
+            keypoints=keypoints,
+            radii=radii,
+            voxel_sizes=voxel_sizes,
+            weights=weights,
+            local_rf_radius=local_rf_radius,
+            block_size=block_size,
+            pyramid=pyramid,
+            spatial_indices=spatial_indices,
+        ):
+            out[start : start + descriptors.shape[0]] = descriptors
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
@@ -2,13 +2,15 @@
 Implementation of the ICP method.
 """
 import numpy as np
-from sklearn.neighbors import KDTree
 from tqdm import trange
 
 from shot_fpfh.base_computation import (
     solver_point_to_point,
     solver_point_to_plane,
+    SpatialIndex,
     Transformation,
+    VoxelPyramid,
+    create_spatial_index,
     grid_subsampling,
 )
 
@@ -41,7 +43,7 @@ def icp_point_to_point_with_sampling(
         has_converged: boolean value indicating whether the method has converged or not.
     """
     points_aligned = np.copy(scan)
-    kdtree = KDTree(ref)
+    kdtree = create_spatial_index(ref)
     sampling_limit = min(sampling_limit, scan.shape[0])
 
     rms = 0.0
@@ -87,13 +89,21 @@ def icp_point_to_point(
     max_iter: int = 100,
     rms_threshold: float = 1e-2,
     disable_progress_bar: bool = False,
+    scan_pyramid: VoxelPyramid | None = None,
+    ref_kdtree: SpatialIndex | None = None,
 ) -> tuple[Transformation, float, bool]:
     """
     Iterative closest point algorithm with a point to point strategy.
     Each iteration is performed on a subsampling of the point clouds to fasten the computation.
+    The subsampling is retrieved from scan_pyramid if given.
+    A spatial index already built on ref can be given to avoid building it again.
     """
-    kdtree = KDTree(ref)
-    subsampled_indices = grid_subsampling(scan, voxel_size)
+    kdtree = ref_kdtree if ref_kdtree is not None else create_spatial_index(ref)
+    subsampled_indices = (
+        scan_pyramid.subsample(voxel_size)
+        if scan_pyramid is not None
+        else grid_subsampling(scan, voxel_size)
+    )
     transformation_icp = transformation_init
     rms = 0.0
 
@@ -144,13 +154,21 @@ def icp_point_to_plane(
     max_iter: int = 50,
     rms_threshold: float = 1e-2,
     disable_progress_bar: bool = False,
+    scan_pyramid: VoxelPyramid | None = None,
+    ref_kdtree: SpatialIndex | None = None,
 ) -> tuple[Transformation, float, bool]:
     """
     Point to plane ICP.
     More robust to point clouds of variable densities where the plane estimations by the normals are good.
+    The subsampling of the scan is retrieved from scan_pyramid if given.
+    A spatial index already built on ref can be given to avoid building it again.
     """
-    kdtree = KDTree(ref)
-    subsampled_indices = grid_subsampling(scan, voxel_size)
+    kdtree = ref_kdtree if ref_kdtree is not None else create_spatial_index(ref)
+    subsampled_indices = (
+        scan_pyramid.subsample(voxel_size)
+        if scan_pyramid is not None
+        else grid_subsampling(scan, voxel_size)
+    )
     transformation_icp = transformation_init
     rms = 0.0
 
@@ -1,48 +1,282 @@
 import numpy as np
-from sklearn.neighbors import KDTree
 
-from shot_fpfh.base_computation import grid_subsampling
+from shot_fpfh.base_computation import (
+    NeighborhoodGraph,
+    SpatialIndex,
+    SpatialIndexBackend,
+    SpatialIndexCache,
+    VoxelPyramid,
+    get_voxel_keys,
+    grid_subsampling,
+    create_spatial_index,
+    query_radius_csr,
+)
+from shot_fpfh.descriptors import batched_pca
 
 # setting a seed
 rng = np.random.default_rng(seed=1)
 
 
 def select_keypoints_iteratively(
-    points: np.ndarray[np.float64], radius: float
-) -> np.ndarray[np.int32]:
+    points: np.ndarray[np.float64],
+    radius: float,
+    kdtree: SpatialIndex | None = None,
+    batch_size: int = 2**14,
+) -> np.ndarray[np.int64]:
     """
     Selects a subset of the points to create a set of key points on which descriptors will be computed.
-    Operates by selecting a point randomly, counting its spherical neighbors as visited,
-    removing the visited points from the pool of candidate points and reiterating on it.
+    Poisson-disk sampling: the selected points are more than radius apart, and every point lies within radius of a
+    selected point.
+    The candidates are drawn from a background grid whose cells have a diagonal of radius (size radius / sqrt(3)), hence
+    any point covers its whole cell: each round proposes the first remaining point of every cell, and the proposals are
+    processed in vectorized batches. A proposal is accepted unless it lies within radius of a proposal of the same batch
+    with a smaller index (found in the 124 surrounding cells), and the points within radius of the accepted ones are
+    then discarded with a single radius search per batch. Rejected proposals are proposed again in the next round.
+    The spacing and coverage guarantees are the ones of the former greedy loop, which selected the first point not yet
+    covered in the order of the indices, but the keypoints selected differ (and so may their number).
+    A spatial index already built on the points can be given to avoid building it again.
+
+    Args:
+        points: The point cloud.
+        radius: The minimum distance between two keypoints.
+        kdtree: A spatial index built on the points. Leave empty to build one with the default backend.
+        batch_size: The number of proposals processed at once.
 
     Returns:
-        selected: array containing the indices of the selected points.
+        selected: array containing the sorted indices of the selected points.
     """
+    if points.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    if kdtree is None:
+        kdtree = create_spatial_index(points)
+
+    # a margin of two cells keeps the coordinates of the cells around the points non-negative
+    cell_size = radius / np.sqrt(3)
+    origin = np.min(points, axis=0) - 2 * cell_size
+    cells_coordinates = ((points - origin) // cell_size).astype(np.int64)
+    grid_shape = np.max(cells_coordinates, axis=0) + 3
+    if np.prod(grid_shape.astype(np.float64)) >= np.iinfo(np.int64).max:
+        raise ValueError(
+            f"The grid with a cell size of {cell_size} is too large to be hashed."
+        )
+    cell_keys = np.ravel_multi_index(cells_coordinates.T, grid_shape)
+    strides = np.array([grid_shape[1] * grid_shape[2], grid_shape[2], 1])
+    neighbor_cells_offsets = (
+        np.stack(np.meshgrid(*[np.arange(-2, 3)] * 3, indexing="ij"), axis=-1).reshape(
+            -1, 3
+        )
+        @ strides
+    )
+    neighbor_cells_offsets = neighbor_cells_offsets[neighbor_cells_offsets != 0]
+
+    # points sorted by cell, then by index
+    order = np.argsort(cell_keys, kind="stable")
+    sorted_keys = cell_keys[order]
     selected = np.zeros(points.shape[0], dtype=bool)
-    visited = np.zeros(points.shape[0], dtype=bool)
-    kdtree = KDTree(points)
+    remaining = np.ones(points.shape[0], dtype=bool)
+    while remaining.any():
+        # first remaining point of each cell
+        remaining_points = order[remaining[order]]
+        remaining_keys = sorted_keys[remaining[order]]
+        proposals = remaining_points[
+            np.concatenate(([True], remaining_keys[1:] != remaining_keys[:-1]))
+        ]
+        for start in range(0, proposals.shape[0], batch_size):
+            batch = proposals[start : start + batch_size]
+            batch = batch[remaining[batch]]
+            if batch.shape[0] == 0:
+                continue
+            batch_keys = cell_keys[batch]  # sorted, one proposal per cell
 
-    while not visited.all():
-        point_idx = (~visited).nonzero()[0][0]
-        selected[point_idx] = True
-        visited[kdtree.query_radius([points[point_idx]], radius)[0]] = True
+            # proposals of the batch in the cells around each proposal
+            neighbor_keys = batch_keys[:, None] + neighbor_cells_offsets[None, :]
+            neighbors = np.minimum(
+                np.searchsorted(batch_keys, neighbor_keys), batch.shape[0] - 1
+            )
+            is_found = batch_keys[neighbors] == neighbor_keys
+            rows, columns = is_found.nonzero()
+            proposal, neighbor = batch[rows], batch[neighbors[rows, columns]]
+            is_conflicting = (neighbor < proposal) & (
+                np.linalg.norm(points[proposal] - points[neighbor], axis=1) <= radius
+            )
+            accepted = np.setdiff1d(batch, proposal[is_conflicting])
+
+            selected[accepted] = True
+            remaining[query_radius_csr(kdtree, points[accepted], radius)[0]] = False
+            remaining[accepted] = False
 
     return selected.nonzero()[0]
 
 
+def select_keypoints_iss(
+    points: np.ndarray[np.float64],
+    salient_radius: float,
+    non_max_radius: float | None = None,
+    gamma_21: float = 0.975,
+    gamma_32: float = 0.975,
+    min_n_neighbors: int = 5,
+    kdtree: SpatialIndex | None = None,
+    spatial_index_backend: SpatialIndexBackend | None = None,
+    block_size: int = 2**16,
+) -> np.ndarray[np.int64]:
+    """
+    Selects a subset of the points to create a set of key points on which descriptors will be computed.
+    Intrinsic Shape Signatures (Y. Zhong, 2009): the eigenvalues l1 >= l2 >= l3 of the covariance matrix of the spherical
+    neighborhood of each point are computed by blocks of points with a single stacked eigendecomposition. The points
+    whose eigenvalues are well separated (l2 / l1 < gamma_21 and l3 / l2 < gamma_32) are salient, with a saliency of
+    l3, which is low on planes and lines. The salient points that have the highest saliency among the salient points
+    within non_max_radius are kept (non-maximum suppression, ties being broken by the smallest index).
+    The covariance matrices are not weighted by the inverse of the local density as in the original method.
+    A spatial index already built on the points can be given to avoid building it again.
+
+    Args:
+        points: The point cloud.
+        salient_radius: The radius of the neighborhoods the covariance matrices are computed on.
+        non_max_radius: The radius of the non-maximum suppression. Leave empty to use salient_radius.
+        gamma_21: The upper bound on the ratio of the second to the first eigenvalue.
+        gamma_32: The upper bound on the ratio of the third to the second eigenvalue.
+        min_n_neighbors: The minimum number of points in the neighborhood of a keypoint.
+        kdtree: A spatial index built on the points. Leave empty to build one of type spatial_index_backend.
+        spatial_index_backend: The type of the spatial indices built (the default one if empty).
+        block_size: The number of points whose neighborhoods are searched at once.
+
+    Returns:
+        selected keypoints: array containing the sorted indices of the selected points.
+    """
+    if kdtree is None:
+        kdtree = create_spatial_index(points, spatial_index_backend)
+    if non_max_radius is None:
+        non_max_radius = salient_radius
+
+    saliency = np.zeros(points.shape[0])
+    is_salient = np.zeros(points.shape[0], dtype=bool)
+    for start in range(0, points.shape[0], block_size):
+        neighborhoods = NeighborhoodGraph.search(
+            kdtree, points[start : start + block_size], salient_radius
+        )
+        eigenvalues = batched_pca(points, neighborhoods)[0]  # ascending order
+        ratio_21 = np.ones(eigenvalues.shape[0])
+        ratio_32 = np.ones(eigenvalues.shape[0])
+        np.divide(
+            eigenvalues[:, 1],
+            eigenvalues[:, 2],
+            out=ratio_21,
+            where=eigenvalues[:, 2] > 0,
+        )
+        np.divide(
+            eigenvalues[:, 0],
+            eigenvalues[:, 1],
+            out=ratio_32,
+            where=eigenvalues[:, 1] > 0,
+        )
+        saliency[start : start + block_size] = eigenvalues[:, 0]
+        is_salient[start : start + block_size] = (
+            (neighborhoods.sizes >= min_n_neighbors)
+            & (ratio_21 < gamma_21)
+            & (ratio_32 < gamma_32)
+        )
+
+    candidates = is_salient.nonzero()[0]
+    if candidates.shape[0] == 0:
+        return candidates
+    # rank of each candidate by saliency, the smallest index winning the ties
+    ranks = np.empty(candidates.shape[0], dtype=np.int64)
+    ranks[np.lexsort((-candidates, saliency[candidates]))] = np.arange(
+        candidates.shape[0]
+    )
+    neighborhoods = NeighborhoodGraph.search(
+        create_spatial_index(points[candidates], spatial_index_backend),
+        points[candidates],
+        non_max_radius,
+    )
+    # each candidate is in its own neighborhood, hence none of them is empty
+    return candidates[
+        ranks
+        == np.maximum.reduceat(
+            ranks[neighborhoods.indices], neighborhoods.offsets[:-1]
+        )
+    ]
+
+
 def select_keypoints_subsampling(
-    points: np.ndarray[np.float64], voxel_size: float
+    points: np.ndarray[np.float64],
+    voxel_size: float,
+    pyramid: VoxelPyramid | None = None,
 ) -> np.ndarray[np.int32]:
     """
     Selects a subset of the points to create a set of key points on which descriptors will be computed.
     Operates by subsampling the point cloud and keeping the points closest to the barycenter of each voxel.
+    The subsampling is retrieved from the pyramid of the point cloud if given.
 
     Returns:
         selected key points: array containing the indices of the selected points.
     """
+    if pyramid is not None:
+        return pyramid.subsample(voxel_size)
     return grid_subsampling(points, voxel_size)
 
 
+def select_keypoints_farthest_point(
+    points: np.ndarray[np.float64],
+    n_keypoints: int,
+    proxy_voxel_size: float | None = None,
+    pyramid: VoxelPyramid | None = None,
+) -> np.ndarray[np.int64]:
+    """
+    Selects a subset of the points to create a set of key points on which descriptors will be computed.
+    Farthest point sampling: starting from the point farthest from the barycenter, each new keypoint is the point
+    farthest from the keypoints already selected. The squared distance of every point to the closest keypoint is kept
+    up to date in a single array, which costs a few vectorized passes over the points per keypoint.
+    With proxy_voxel_size, the sampling runs on a grid subsampling of the point cloud (retrieved from the pyramid if
+    given), which is much faster and barely changes the spread of the keypoints.
+
+    Args:
+        points: The point cloud.
+        n_keypoints: The number of keypoints to select. Fewer keypoints are returned if there are fewer candidates or
+        fewer distinct candidate positions, as duplicated points are never selected twice.
+        proxy_voxel_size: The size of the voxels of the subsampling the keypoints are selected in. Leave empty to select
+        them among all the points.
+        pyramid: Cached subsamplings of the point cloud. Leave empty to subsample the point cloud from scratch.
+
+    Returns:
+        selected keypoints: array containing the indices of the selected points, in the order of their selection.
+    """
+    if proxy_voxel_size is not None:
+        candidates = select_keypoints_subsampling(points, proxy_voxel_size, pyramid)
+    else:
+        candidates = np.arange(points.shape[0])
+    n_keypoints = min(n_keypoints, candidates.shape[0])
+    candidate_points = points[candidates]
+
+    selected = np.zeros(n_keypoints, dtype=np.int64)
+    if n_keypoints == 0:
+        return selected
+    centered_points = candidate_points - candidate_points.mean(axis=0)
+    selected[0] = np.argmax(np.einsum("ij,ij->i", centered_points, centered_points))
+    # one contiguous array per coordinate and buffers reused by every update, which keeps each update to a few passes
+    # over contiguous memory
+    coordinates = np.ascontiguousarray(candidate_points.T)
+    min_sq_distances = np.full(candidate_points.shape[0], np.inf)
+    sq_distances = np.empty(candidate_points.shape[0])
+    buffer = np.empty(candidate_points.shape[0])
+    for i in range(1, n_keypoints):
+        last_selected = candidate_points[selected[i - 1]]
+        np.subtract(coordinates[0], last_selected[0], out=sq_distances)
+        np.square(sq_distances, out=sq_distances)
+        for axis in (1, 2):
+            np.subtract(coordinates[axis], last_selected[axis], out=buffer)
+            np.square(buffer, out=buffer)
+            np.add(sq_distances, buffer, out=sq_distances)
+        np.minimum(min_sq_distances, sq_distances, out=min_sq_distances)
+        selected[i] = np.argmax(min_sq_distances)
+        if min_sq_distances[selected[i]] == 0:
+            # every candidate lies on a keypoint already (duplicated points), selecting more would repeat them
+            selected = selected[:i]
+            break
+
+    return candidates[selected]
+
+
 def select_keypoints_randomly(
     points: np.ndarray[np.float64], n_feature_points: int
 ) -> np.ndarray[np.int32]:
@@ -66,56 +300,37 @@ def select_keypoints_with_density_threshold(
     voxel_size: float,
     density_threshold_value: int,
     density_threshold_radius: float | None = None,
-) -> np.ndarray[np.int32]:
+    spatial_indices: SpatialIndexCache | None = None,
+    spatial_index_backend: SpatialIndexBackend | None = None,
+    pyramid: VoxelPyramid | None = None,
+) -> np.ndarray[np.int64]:
     """
     Selects a subset of the points to create a set of key points on which descriptors will be computed.
     Operates by subsampling the point cloud and keeping the points closest to the barycenter of each voxel whose density
     exceeds a certain value.
+    The density is the number of points in the voxel, or the number of neighbors of the kept point within
+    density_threshold_radius if it differs from the voxel size, counted for all the kept points with a single query.
+    The subsampling is retrieved from the pyramid of the point cloud if given. The spatial index needed to count the
+    neighbors is retrieved from spatial_indices if given, and is of type spatial_index_backend (the default one if
+    empty).
 
     Returns:
         selected keypoints: array containing the indices of the selected points.
     """
-    non_empty_voxel_keys, inverse, nb_pts_per_voxel = np.unique(
-        ((points - np.min(points, axis=0)) // voxel_size).astype(int),
-        axis=0,
-        return_inverse=True,
-        return_counts=True,
-    )
-    if density_threshold_radius is None:
-        density_threshold_radius = voxel_size
-
-    idx_pts_vox_sorted = np.argsort(inverse)
-    sub_sampled_points_idx = []
-    kdtree = None
-    if density_threshold_radius != voxel_size:
-        kdtree = KDTree(points)
-
-    last_seen = 0
-    for idx in range(len(non_empty_voxel_keys)):
-        indexes_in_voxel = idx_pts_vox_sorted[
-            last_seen : last_seen + nb_pts_per_voxel[idx]
-        ]
-        # point closest to the barycenter
-        point_closest_to_centroid = indexes_in_voxel[
-            np.linalg.norm(
-                points[indexes_in_voxel] - points[indexes_in_voxel].mean(axis=0),
-                axis=1,
-            ).argmin()
-        ]
-        if (
-            voxel_size == density_threshold_radius
-            and nb_pts_per_voxel[idx] > density_threshold_value
-        ) or (
-            voxel_size != density_threshold_radius
-            and (
-                kdtree.query_radius(
-                    [points[point_closest_to_centroid]], density_threshold_radius
-                )[0].shape[0]
-                > density_threshold_value
-            )
-        ):
-            sub_sampled_points_idx.append(point_closest_to_centroid)
-
-        last_seen += nb_pts_per_voxel[idx]
+    representatives = select_keypoints_subsampling(points, voxel_size, pyramid)
+    if density_threshold_radius is None or density_threshold_radius == voxel_size:
+        _, voxel_ids, nb_pts_per_voxel = np.unique(
+            get_voxel_keys(points, voxel_size), return_inverse=True, return_counts=True
+        )
+        densities = nb_pts_per_voxel[voxel_ids.reshape(-1)[representatives]]
+    else:
+        kdtree = (
+            spatial_indices.get(points, backend=spatial_index_backend)
+            if spatial_indices is not None
+            else create_spatial_index(points, spatial_index_backend)
+        )
+        densities = kdtree.count_radius(
+            points[representatives], density_threshold_radius
+        )
 
-    return np.array(sub_sampled_points_idx)
+    return representatives[densities > density_threshold_value]
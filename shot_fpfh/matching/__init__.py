@@ -1,3 +1,8 @@
 from .filters import threshold_filter, quantile_filter, left_median_filter
-from .matching import match_descriptors, basic_matching, double_matching_with_rejects
+from .matching import (
+    find_nearest_descriptors,
+    match_descriptors,
+    basic_matching,
+    double_matching_with_rejects,
+)
 from .ransac import ransac_on_matches
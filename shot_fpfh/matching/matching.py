@@ -4,6 +4,81 @@ import numpy as np
 from scipy.spatial.distance import cdist
 
 
+def find_nearest_descriptors(
+    scan_descriptors: np.ndarray[np.float64],
+    ref_descriptors: np.ndarray[np.float64],
+    k: int = 1,
+    memory_budget: int = 2**28,
+) -> tuple[np.ndarray[np.float64], np.ndarray[np.int64], np.ndarray[np.int64]]:
+    """
+    Finds the k nearest reference descriptors of each scan descriptor without storing the whole distance matrix.
+    The scan descriptors are processed by blocks of rows whose squared distances to all the reference descriptors are
+    computed with a matrix product, the size of the blocks being chosen so that a block takes about memory_budget bytes.
+    Only the k nearest neighbors of each row and the running nearest scan descriptor of each reference descriptor (to
+    check the reciprocity of the matches) are kept from each block. The distances returned are recomputed exactly on
+    the pairs found.
+
+    Args:
+        scan_descriptors: (N, d) array of descriptors computed on the dataset of interest.
+        ref_descriptors: (M, d) array of descriptors computed on the reference dataset.
+        k: The number of neighbors searched (1 or 2 in practice).
+        memory_budget: The approximate number of bytes the temporary arrays of a block can take.
+
+    Returns:
+        distances: (N, k) array of the distances to the k nearest reference descriptors in ascending order, padded with
+        inf if there are less than k reference descriptors.
+        indices: (N, k) array of the indices of the k nearest reference descriptors, padded with -1.
+        column_argmin: (M,) array of the index of the nearest scan descriptor of each reference descriptor.
+    """
+    n_scan, n_ref = scan_descriptors.shape[0], ref_descriptors.shape[0]
+    n_neighbors = min(k, n_ref)
+    distances = np.full((n_scan, k), np.inf)
+    indices = np.full((n_scan, k), -1, dtype=np.int64)
+    column_min = np.full(n_ref, np.inf)
+    column_argmin = np.zeros(n_ref, dtype=np.int64)
+
+    # the largest temporary arrays are the distance block and the indices of the partition, or the gathered nearest
+    # descriptors and their differences to the block when the descriptors are longer than the reference set
+    block_size = max(
+        memory_budget
+        // (16 * max(n_ref, n_neighbors * scan_descriptors.shape[1], 1)),
+        1,
+    )
+    ref_sq_norms = np.einsum("ij,ij->i", ref_descriptors, ref_descriptors)
+    for start in range(0, n_scan if n_ref > 0 else 0, block_size):
+        block = scan_descriptors[start : start + block_size]
+        sq_distances = block @ ref_descriptors.T
+        sq_distances *= -2
+        sq_distances += np.einsum("ij,ij->i", block, block)[:, None]
+        sq_distances += ref_sq_norms[None, :]
+        rows = np.arange(block.shape[0])[:, None]
+
+        if n_neighbors == 1:
+            block_indices = sq_distances.argmin(axis=1)[:, None]
+        else:
+            block_indices = np.argpartition(sq_distances, n_neighbors - 1, axis=1)[
+                :, :n_neighbors
+            ]
+            block_indices = np.take_along_axis(
+                block_indices,
+                np.argsort(sq_distances[rows, block_indices], axis=1, kind="stable"),
+                axis=1,
+            )
+        indices[start : start + block.shape[0], :n_neighbors] = block_indices
+        distances[start : start + block.shape[0], :n_neighbors] = np.linalg.norm(
+            block[:, None, :] - ref_descriptors[block_indices], axis=2
+        )
+
+        # the first block reaching the minimum keeps it, like an argmin on the whole matrix
+        block_column_argmin = sq_distances.argmin(axis=0)
+        block_column_min = sq_distances[block_column_argmin, np.arange(n_ref)]
+        is_closer = block_column_min < column_min
+        column_min[is_closer] = block_column_min[is_closer]
+        column_argmin[is_closer] = block_column_argmin[is_closer] + start
+
+    return distances, indices, column_argmin
+
+
 def match_descriptors(
     scan_descriptors: np.ndarray[np.float64],
     ref_descriptors: np.ndarray[np.float64],
@@ -12,11 +87,13 @@ def match_descriptors(
     filter_nonreciprocal: bool = False,
     verbose: bool = True,
     n_min_matches: int = 100,
+    memory_budget: int = 2**28,
     **kwargs: bool | int | float | tuple[float, float],
 ) -> tuple[np.ndarray[np.int32], np.ndarray[np.int32]]:
     """
     Computes the distance matrix between two sets of descriptors and filters the nearest match found for each descriptor
     of the query set. Can additionally filter out matches that are not reciprocal.
+    With the Euclidian norm, the distance matrix is computed by blocks (see find_nearest_descriptors).
     For infinite norm measure, provide the multiscale descriptors as a (n_scales, n_points, descriptor_length) array.
 
     Args:
@@ -27,6 +104,7 @@ def match_descriptors(
         verbose: verbosity level.
         n_min_matches: Minimum number of matches below which this function will automatically switch back to keeping
         non-reciprocal matches if enabled.
+        memory_budget: The approximate number of bytes a block of the distance matrix can take (Euclidian norm only).
         kwargs: Arguments to pass to the filter function.
 
     Returns:
@@ -40,12 +118,12 @@ def match_descriptors(
         non_empty_ref_descriptors = np.any(ref_descriptors, axis=1).nonzero()[0]
 
         # brute force computation of the distance matrix, faster than a KDTree as the search space has a high dimension
-        distance_matrix = cdist(
+        distances, indices, column_argmin = find_nearest_descriptors(
             scan_descriptors[non_empty_descriptors],
             ref_descriptors[non_empty_ref_descriptors],
+            memory_budget=memory_budget,
         )
-        indices = distance_matrix.argmin(axis=1)
-        distances = distance_matrix[np.arange(non_empty_descriptors.shape[0]), indices]
+        distances, indices = distances[:, 0], indices[:, 0]
 
         # filter function based on the distance observed, returns a mask
         filtered_indices = (
@@ -56,9 +134,7 @@ def match_descriptors(
 
         # filtering out non-reciprocal matches
         if filter_nonreciprocal:
-            reciprocal_matches = distance_matrix.argmin(axis=0)[indices] == np.arange(
-                indices.shape[0]
-            )
+            reciprocal_matches = column_argmin[indices] == np.arange(indices.shape[0])
             # applying the mask iff it will lead to more than n_min_matches
             if (
                 final_mask := filtered_indices & reciprocal_matches
@@ -138,7 +214,9 @@ def match_descriptors(
 
 
 def basic_matching(
-    scan_descriptors: np.ndarray[np.float64], ref_descriptors: np.ndarray[np.float64]
+    scan_descriptors: np.ndarray[np.float64],
+    ref_descriptors: np.ndarray[np.float64],
+    memory_budget: int = 2**28,
 ) -> tuple[np.ndarray[np.int32], np.ndarray[np.int32]]:
     """
     Matching strategy that matches each descriptor with its nearest neighbor in the feature space.
@@ -146,17 +224,18 @@ def basic_matching(
     Args:
         scan_descriptors: Descriptors computed on the dataset of interest.
         ref_descriptors: Descriptors computed on the reference dataset.
+        memory_budget: The approximate number of bytes a block of the distance matrix can take.
 
     Returns:
         Indices of the matches established.
     """
     non_empty_descriptors = np.any(scan_descriptors, axis=1).nonzero()[0]
     non_empty_ref_descriptors = np.any(ref_descriptors, axis=1).nonzero()[0]
-    distance_matrix = cdist(
+    indices = find_nearest_descriptors(
         scan_descriptors[non_empty_descriptors],
         ref_descriptors[non_empty_ref_descriptors],
-    )
-    indices = distance_matrix.argmin(axis=1)
+        memory_budget=memory_budget,
+    )[1][:, 0]
     return non_empty_descriptors, non_empty_ref_descriptors[indices]
 
 
@@ -165,10 +244,12 @@ def double_matching_with_rejects(
     ref_descriptors: np.ndarray[np.float64],
     threshold: float,
     verbose: bool = True,
+    memory_budget: int = 2**28,
 ) -> tuple[np.ndarray[np.int32], np.ndarray[np.int32]]:
     """
     Matching strategy that establishes point-to-point correspondences between descriptors and rejects matches where
-    the ratio between the distance to the closest neighbor and to the second-closest neighbor is below a threshold.
+    the ratio between the distance to the closest neighbor and to the second-closest neighbor is above a threshold
+    (Lowe's ratio test).
     The motivation between this strategy is that for false matches, there will likely be a number of other false matches
     within similar distances due to the high dimensionality of the feature space.
     TODO: try out different distances such as the chi^2 statistic.
@@ -178,6 +259,7 @@ def double_matching_with_rejects(
         ref_descriptors: Descriptors computed on the reference dataset.
         threshold: Threshold for rejection of incorrect matches.
         verbose: Adds verbosity to the execution of the function.
+        memory_budget: The approximate number of bytes a block of the distance matrix can take.
 
     Returns:
         matches_indices: Indices of the matches established in the initial array.
@@ -185,20 +267,20 @@ def double_matching_with_rejects(
     """
     non_empty_descriptors = np.any(scan_descriptors, axis=1).nonzero()[0]
     non_empty_ref_descriptors = np.any(ref_descriptors, axis=1).nonzero()[0]
-    distance_matrix = cdist(
+    neighbor_distances, indices, _ = find_nearest_descriptors(
         scan_descriptors[non_empty_descriptors],
         ref_descriptors[non_empty_ref_descriptors],
+        k=2,
+        memory_budget=memory_budget,
     )
-    indices = np.argpartition(distance_matrix, kth=2, axis=1)
-    neighbor_distances = distance_matrix[np.arange(scan_descriptors.shape[0]), indices]
     mask = (
         np.divide(
             neighbor_distances[:, 0],
             neighbor_distances[:, 1],
-            out=np.ones(scan_descriptors.shape[0]),
+            out=np.ones(non_empty_descriptors.shape[0]),
             where=neighbor_distances[:, 1] != 0,
         )
-        >= threshold
+        < threshold
     )
 
     if verbose:
@@ -207,6 +289,6 @@ def double_matching_with_rejects(
         )
 
     return (
-        non_empty_descriptors[mask.nonzero()[0]],
-        non_empty_ref_descriptors[neighbor_distances[mask, 0]],
+        non_empty_descriptors[mask],
+        non_empty_ref_descriptors[indices[mask, 0]],
     )
@@ -1,18 +1,26 @@
 """
 Generic pipeline with open choices for the algorithms used to select keypoints and filter matches.
 """
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from types import TracebackType
 from typing import Literal
 
 import numpy as np
-from sklearn.neighbors import KDTree
 
 from shot_fpfh.analysis import get_incorrect_matches, plot_distance_hists
-from shot_fpfh.base_computation import Transformation
-from shot_fpfh.descriptors import ShotMultiprocessor, compute_fpfh_descriptor
+from shot_fpfh.base_computation import (
+    SpatialIndex,
+    SpatialIndexBackend,
+    SpatialIndexCache,
+    Transformation,
+    VoxelPyramid,
+)
+from shot_fpfh.descriptors import FpfhMultiprocessor, ShotMultiprocessor
 from shot_fpfh.icp import icp_point_to_point, icp_point_to_plane
 from shot_fpfh.keypoint_selection import (
     select_query_indices_randomly,
+    select_keypoints_farthest_point,
+    select_keypoints_iss,
     select_keypoints_iteratively,
     select_keypoints_subsampling,
     select_keypoints_with_density_threshold,
@@ -24,7 +32,7 @@ from shot_fpfh.matching import (
     threshold_filter,
     ransac_on_matches,
 )
-from shot_fpfh.utils import write_ply
+from shot_fpfh.utils import Executor, ExecutorType, create_executor, write_ply
 
 
 @dataclass
@@ -32,6 +40,13 @@ class RegistrationPipeline:
     """
     Generic class for descriptor-based registration between local maps.
     Allows for a selection among a variety of algorithms for keypoint selection, matching, and ICP.
+    The workers of the parallel stages (processes, threads or serial depending on executor_type) are started once and
+    reused until the pipeline is closed. An executor can be passed to share the same workers between several pipelines.
+    The grid subsamplings of both point clouds are cached in voxel pyramids shared by the keypoint selection, the
+    supports of the descriptors and the ICP. Likewise, the spatial indices built on the point clouds and their subsets
+    are cached in a registry so that each of them is built once and reused by every stage. Their backend is
+    spatial_index_backend (the default one if empty), unless another one is given for a stage ("keypoints",
+    "descriptors", "icp" or "metrics") in stage_spatial_index_backends.
     """
 
     scan: np.ndarray[np.float64]
@@ -47,14 +62,150 @@ class RegistrationPipeline:
 
     matches: tuple[np.ndarray[np.int32], np.ndarray[np.int32]] | None = None
 
+    executor_type: ExecutorType = "process"
+    executor: Executor | None = None
+    owns_executor: bool = field(default=False, init=False, repr=False)
+
+    spatial_index_backend: SpatialIndexBackend | None = None
+    stage_spatial_index_backends: dict[
+        Literal["keypoints", "descriptors", "icp", "metrics"], SpatialIndexBackend
+    ] = field(default_factory=dict)
+
+    scan_pyramid: VoxelPyramid = field(init=False, repr=False)
+    ref_pyramid: VoxelPyramid = field(init=False, repr=False)
+    spatial_indices: SpatialIndexCache = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.scan_pyramid = VoxelPyramid(self.scan)
+        self.ref_pyramid = VoxelPyramid(self.ref)
+        self.spatial_indices = SpatialIndexCache()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type | None,
+        exc_val: Exception | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.close(terminate=exc_type is not None)
+
+    def get_executor(self, n_procs: int = ShotMultiprocessor.n_procs) -> Executor:
+        """
+        Retrieves the executor shared by the parallel stages, starting it on first use.
+
+        Args:
+            n_procs: Number of workers to start if the executor is not running yet. Ignored otherwise.
+
+        Returns:
+            The long-lived executor.
+        """
+        if self.executor is None:
+            self.executor = create_executor(self.executor_type, n_procs)
+            self.owns_executor = True
+        return self.executor
+
+    def get_spatial_index_backend(
+        self, stage: Literal["keypoints", "descriptors", "icp", "metrics"]
+    ) -> SpatialIndexBackend | None:
+        """
+        Retrieves the backend of the spatial indices used by a stage.
+        """
+        return self.stage_spatial_index_backends.get(stage, self.spatial_index_backend)
+
+    def get_spatial_index(
+        self,
+        points: np.ndarray[np.float64],
+        stage: Literal["keypoints", "descriptors", "icp", "metrics"],
+        subsampling: str | float | None = None,
+        indices: np.ndarray[np.int64] | None = None,
+    ) -> SpatialIndex:
+        """
+        Retrieves the spatial index built on a point cloud or on a subset of it with the backend of a stage.
+
+        Args:
+            points: The whole point cloud.
+            stage: The stage the spatial index is used by.
+            subsampling: The name of the subset. Leave empty for the whole point cloud.
+            indices: The indices of the points of the subset in the point cloud. Leave empty for the whole point cloud.
+
+        Returns:
+            The spatial index, built only once per point cloud, subset and backend.
+        """
+        return self.spatial_indices.get(
+            points, subsampling, indices, self.get_spatial_index_backend(stage)
+        )
+
+    def get_shot_multiprocessor(
+        self, **shot_multiprocessor_config: bool | int | str
+    ) -> ShotMultiprocessor:
+        """
+        Instantiates a ShotMultiprocessor that runs on the executor of the pipeline, unless it uses the numba backend
+        which runs on threads of the current process.
+
+        Args:
+            shot_multiprocessor_config: The parameters to pass to ShotMultiprocessor (all have default values).
+
+        Returns:
+            The ShotMultiprocessor, to use as a context manager.
+        """
+        shot_multiprocessor_config.setdefault(
+            "spatial_index_backend", self.get_spatial_index_backend("descriptors")
+        )
+        shot_multiprocessor = ShotMultiprocessor(**shot_multiprocessor_config)
+        if shot_multiprocessor.backend == "numpy":
+            shot_multiprocessor.executor = self.get_executor(shot_multiprocessor.n_procs)
+        return shot_multiprocessor
+
+    def get_fpfh_multiprocessor(
+        self, **fpfh_multiprocessor_config: bool | int | str
+    ) -> FpfhMultiprocessor:
+        """
+        Instantiates a FpfhMultiprocessor that runs on the executor of the pipeline, unless it uses the numba backend
+        which runs on threads of the current process.
+
+        Args:
+            fpfh_multiprocessor_config: The parameters to pass to FpfhMultiprocessor (all have default values).
+
+        Returns:
+            The FpfhMultiprocessor, to use as a context manager.
+        """
+        fpfh_multiprocessor = FpfhMultiprocessor(**fpfh_multiprocessor_config)
+        if fpfh_multiprocessor.backend == "numpy":
+            fpfh_multiprocessor.executor = self.get_executor(fpfh_multiprocessor.n_procs)
+        return fpfh_multiprocessor
+
+    def close(self, terminate: bool = False) -> None:
+        """
+        Stops the worker processes started by the pipeline. An executor passed at initialization is left running.
+
+        Args:
+            terminate: Whether the worker processes should be stopped without waiting for their pending tasks, e.g.
+            after a failure.
+        """
+        if self.owns_executor:
+            if terminate:
+                self.executor.terminate()
+            else:
+                self.executor.close()
+            self.executor = None
+            self.owns_executor = False
+
     def select_keypoints(
         self,
         selection_algorithm: Literal[
-            "random", "iterative", "subsampling", "subsampling_with_density"
+            "random",
+            "iterative",
+            "subsampling",
+            "subsampling_with_density",
+            "iss",
+            "farthest_point",
         ],
         *,
         neighborhood_size: float | None = None,
         min_n_neighbors: int | None = None,
+        n_keypoints: int | None = None,
         proportion_picked: float = 0.5,
         force_recompute: bool = False,
     ) -> None:
@@ -63,8 +214,13 @@ class RegistrationPipeline:
 
         Args:
             selection_algorithm: The algorithm to use for the selection.
-            neighborhood_size: The size of the spheres to use for the iterative and the subsampling-based methods.
-            min_n_neighbors: Minimum number of neighbors in the subsampling-based method with a density threshold.
+            neighborhood_size: The size of the spheres to use for the iterative (Poisson-disk sampling, see
+            select_keypoints_iteratively) and the subsampling-based methods, and the radius of both the saliency and the
+            non-maximum suppression in the ISS detector.
+            min_n_neighbors: Minimum number of neighbors in the subsampling-based method with a density threshold and
+            in the ISS detector (5 if empty).
+            n_keypoints: The number of keypoints selected in each point cloud by farthest point sampling, which runs on
+            a subsampling with voxels of size neighborhood_size if given.
             proportion_picked: The proportion of points randomly picked with the random selection algorithm.
             force_recompute: Whether the keypoints should be recomputed even if already present.
         """
@@ -83,11 +239,15 @@ class RegistrationPipeline:
             print("\n-- Selecting keypoints iteratively --")
             if self.scan_keypoints is None or force_recompute:
                 self.scan_keypoints = select_keypoints_iteratively(
-                    self.scan, neighborhood_size
+                    self.scan,
+                    neighborhood_size,
+                    self.get_spatial_index(self.scan, "keypoints"),
                 )
             if self.ref_keypoints is None or force_recompute:
                 self.ref_keypoints = select_keypoints_iteratively(
-                    self.ref, neighborhood_size
+                    self.ref,
+                    neighborhood_size,
+                    self.get_spatial_index(self.ref, "keypoints"),
                 )
         elif selection_algorithm == "subsampling":
             print(
@@ -95,11 +255,11 @@ class RegistrationPipeline:
             )
             if self.scan_keypoints is None or force_recompute:
                 self.scan_keypoints = select_keypoints_subsampling(
-                    self.scan, neighborhood_size
+                    self.scan, neighborhood_size, self.scan_pyramid
                 )
             if self.ref_keypoints is None or force_recompute:
                 self.ref_keypoints = select_keypoints_subsampling(
-                    self.ref, neighborhood_size
+                    self.ref, neighborhood_size, self.ref_pyramid
                 )
         elif selection_algorithm == "subsampling_with_density":
             print(
@@ -107,11 +267,50 @@ class RegistrationPipeline:
             )
             if self.scan_keypoints is None or force_recompute:
                 self.scan_keypoints = select_keypoints_with_density_threshold(
-                    self.scan, neighborhood_size, min_n_neighbors
+                    self.scan,
+                    neighborhood_size,
+                    min_n_neighbors,
+                    spatial_indices=self.spatial_indices,
+                    spatial_index_backend=self.get_spatial_index_backend("keypoints"),
+                    pyramid=self.scan_pyramid,
                 )
             if self.ref_keypoints is None or force_recompute:
                 self.ref_keypoints = select_keypoints_with_density_threshold(
-                    self.ref, neighborhood_size, min_n_neighbors
+                    self.ref,
+                    neighborhood_size,
+                    min_n_neighbors,
+                    spatial_indices=self.spatial_indices,
+                    spatial_index_backend=self.get_spatial_index_backend("keypoints"),
+                    pyramid=self.ref_pyramid,
+                )
+        elif selection_algorithm == "iss":
+            print("\n-- Selecting salient keypoints (ISS) --")
+            if self.scan_keypoints is None or force_recompute:
+                self.scan_keypoints = select_keypoints_iss(
+                    self.scan,
+                    neighborhood_size,
+                    min_n_neighbors=min_n_neighbors or 5,
+                    kdtree=self.get_spatial_index(self.scan, "keypoints"),
+                    spatial_index_backend=self.get_spatial_index_backend("keypoints"),
+                )
+            if self.ref_keypoints is None or force_recompute:
+                self.ref_keypoints = select_keypoints_iss(
+                    self.ref,
+                    neighborhood_size,
+                    min_n_neighbors=min_n_neighbors or 5,
+                    kdtree=self.get_spatial_index(self.ref, "keypoints"),
+                    spatial_index_backend=self.get_spatial_index_backend("keypoints"),
+                )
+        elif selection_algorithm == "farthest_point":
+            print("\n-- Selecting keypoints by farthest point sampling --")
+            assert n_keypoints is not None, "No number of keypoints passed."
+            if self.scan_keypoints is None or force_recompute:
+                self.scan_keypoints = select_keypoints_farthest_point(
+                    self.scan, n_keypoints, neighborhood_size, self.scan_pyramid
+                )
+            if self.ref_keypoints is None or force_recompute:
+                self.ref_keypoints = select_keypoints_farthest_point(
+                    self.ref, n_keypoints, neighborhood_size, self.ref_pyramid
                 )
         else:
             raise ValueError("Incorrect keypoint selection algorithm.")
@@ -143,7 +342,9 @@ class RegistrationPipeline:
             The descriptor as a (self.keypoints.shape[0], 352) array.
         """
         print("\n-- Computing single-scale SHOT descriptors --")
-        with ShotMultiprocessor(**shot_multiprocessor_config) as shot_multiprocessor:
+        with self.get_shot_multiprocessor(
+            **shot_multiprocessor_config
+        ) as shot_multiprocessor:
             if self.scan_descriptors is None or force_recompute:
                 self.scan_descriptors = (
                     shot_multiprocessor.compute_descriptor_single_scale(
@@ -152,6 +353,8 @@ class RegistrationPipeline:
                         normals=self.scan_normals,
                         radius=radius,
                         subsampling_voxel_size=subsampling_voxel_size,
+                        pyramid=self.scan_pyramid,
+                        spatial_indices=self.spatial_indices,
                     )
                 )
             if self.ref_descriptors is None or force_recompute:
@@ -162,6 +365,8 @@ class RegistrationPipeline:
                         normals=self.ref_normals,
                         radius=radius,
                         subsampling_voxel_size=subsampling_voxel_size,
+                        pyramid=self.ref_pyramid,
+                        spatial_indices=self.spatial_indices,
                     )
                 )
 
@@ -189,7 +394,9 @@ class RegistrationPipeline:
             The descriptor as a (self.keypoints.shape[0], 352) array.
         """
         print("\n-- Computing SHOT descriptors with two scales (local RF and SHOT) --")
-        with ShotMultiprocessor(**shot_multiprocessor_config) as shot_multiprocessor:
+        with self.get_shot_multiprocessor(
+            **shot_multiprocessor_config
+        ) as shot_multiprocessor:
             if self.scan_descriptors is None or force_recompute:
                 self.scan_descriptors = shot_multiprocessor.compute_descriptor_bi_scale(
                     point_cloud=self.scan,
@@ -198,6 +405,8 @@ class RegistrationPipeline:
                     local_rf_radius=local_rf_radius,
                     shot_radius=shot_radius,
                     subsampling_voxel_size=subsampling_voxel_size,
+                    pyramid=self.scan_pyramid,
+                    spatial_indices=self.spatial_indices,
                 )
             if self.ref_descriptors is None or force_recompute:
                 self.ref_descriptors = shot_multiprocessor.compute_descriptor_bi_scale(
@@ -207,6 +416,8 @@ class RegistrationPipeline:
                     local_rf_radius=local_rf_radius,
                     shot_radius=shot_radius,
                     subsampling_voxel_size=subsampling_voxel_size,
+                    pyramid=self.ref_pyramid,
+                    spatial_indices=self.spatial_indices,
                 )
 
     def compute_shot_descriptor_multiscale(
@@ -232,7 +443,9 @@ class RegistrationPipeline:
             The descriptor as a (self.keypoints.shape[0], 352 * n_scales) array.
         """
         print("\n-- Computing multi-scale SHOT descriptors --")
-        with ShotMultiprocessor(**shot_multiprocessor_config) as shot_multiprocessor:
+        with self.get_shot_multiprocessor(
+            **shot_multiprocessor_config
+        ) as shot_multiprocessor:
             if self.scan_descriptors is None or force_recompute:
                 self.scan_descriptors = (
                     shot_multiprocessor.compute_descriptor_multiscale(
@@ -242,6 +455,8 @@ class RegistrationPipeline:
                         radii=radii,
                         voxel_sizes=voxel_sizes,
                         weights=weights,
+                        pyramid=self.scan_pyramid,
+                        spatial_indices=self.spatial_indices,
                     )
                 )
             if self.ref_descriptors is None or force_recompute:
@@ -253,6 +468,8 @@ class RegistrationPipeline:
                         radii=radii,
                         voxel_sizes=voxel_sizes,
                         weights=weights,
+                        pyramid=self.ref_pyramid,
+                        spatial_indices=self.spatial_indices,
                     )
                 )
 
@@ -263,6 +480,7 @@ class RegistrationPipeline:
             "fpfh", "shot_single_scale", "shot_bi_scale", "shot_multiscale"
         ] = "shot_single_scale",
         fpfh_n_bins: int = 5,
+        fpfh_lazy: bool = False,
         phi: float = 3.0,
         rho: float = 10.0,
         n_scales: int = 2,
@@ -271,6 +489,7 @@ class RegistrationPipeline:
         share_local_rfs: bool = True,
         min_neighborhood_size: int = 100,
         n_procs: int = 8,
+        backend: Literal["numpy", "numba"] = "numpy",
         disable_progress_bars: bool = False,
         verbose: bool = True,
         force_recompute: bool = False,
@@ -283,6 +502,7 @@ class RegistrationPipeline:
                 share_local_rfs=share_local_rfs,
                 min_neighborhood_size=min_neighborhood_size,
                 n_procs=n_procs,
+                backend=backend,
                 disable_progress_bar=disable_progress_bars,
                 verbose=verbose,
                 force_recompute=force_recompute,
@@ -296,6 +516,7 @@ class RegistrationPipeline:
                 share_local_rfs=share_local_rfs,
                 min_neighborhood_size=min_neighborhood_size,
                 n_procs=n_procs,
+                backend=backend,
                 disable_progress_bar=disable_progress_bars,
                 verbose=verbose,
                 force_recompute=force_recompute,
@@ -308,31 +529,37 @@ class RegistrationPipeline:
                 share_local_rfs=share_local_rfs,
                 min_neighborhood_size=min_neighborhood_size,
                 n_procs=n_procs,
+                backend=backend,
                 disable_progress_bar=disable_progress_bars,
                 verbose=verbose,
                 force_recompute=force_recompute,
             )
         elif descriptor_choice == "fpfh":
-            if self.scan_descriptors is None or force_recompute:
-                self.scan_descriptors = compute_fpfh_descriptor(
-                    self.scan_keypoints,
-                    self.scan,
-                    self.scan_normals,
-                    radius=radius,
-                    n_bins=fpfh_n_bins,
-                    disable_progress_bars=disable_progress_bars,
-                    verbose=verbose,
-                )
-            if self.ref_descriptors is None or force_recompute:
-                self.ref_descriptors = compute_fpfh_descriptor(
-                    self.ref_keypoints,
-                    self.ref,
-                    self.ref_normals,
-                    radius=radius,
-                    n_bins=fpfh_n_bins,
-                    disable_progress_bars=disable_progress_bars,
-                    verbose=verbose,
-                )
+            print("\n-- Computing FPFH descriptors --")
+            with self.get_fpfh_multiprocessor(
+                n_bins=fpfh_n_bins,
+                lazy=fpfh_lazy,
+                n_procs=n_procs,
+                backend=backend,
+                disable_progress_bar=disable_progress_bars,
+                verbose=verbose,
+            ) as fpfh_multiprocessor:
+                if self.scan_descriptors is None or force_recompute:
+                    self.scan_descriptors = fpfh_multiprocessor.compute_descriptor(
+                        self.scan_keypoints,
+                        self.scan,
+                        self.scan_normals,
+                        radius=radius,
+                        kdtree=self.get_spatial_index(self.scan, "descriptors"),
+                    )
+                if self.ref_descriptors is None or force_recompute:
+                    self.ref_descriptors = fpfh_multiprocessor.compute_descriptor(
+                        self.ref_keypoints,
+                        self.ref,
+                        self.ref_normals,
+                        radius=radius,
+                        kdtree=self.get_spatial_index(self.ref, "descriptors"),
+                    )
         else:
             raise ValueError("Incorrect descriptor choice")
 
@@ -504,6 +731,8 @@ class RegistrationPipeline:
                 max_iter=max_iter,
                 rms_threshold=rms_threshold,
                 disable_progress_bar=disable_progress_bar,
+                scan_pyramid=self.scan_pyramid,
+                ref_kdtree=self.get_spatial_index(self.ref, "icp"),
             )
         elif icp_type == "point_to_plane":
             print("\n-- Running point-to-plane ICP --")
@@ -517,6 +746,8 @@ class RegistrationPipeline:
                 max_iter=max_iter,
                 rms_threshold=rms_threshold,
                 disable_progress_bar=disable_progress_bar,
+                scan_pyramid=self.scan_pyramid,
+                ref_kdtree=self.get_spatial_index(self.ref, "icp"),
             )
         else:
             raise ValueError("Incorrect ICP type selected.")
@@ -539,7 +770,7 @@ class RegistrationPipeline:
         points_aligned_icp = transformation_icp[self.scan]
 
         def get_inlier_points(
-            scan_points: np.ndarray[np.float64], ref_points: np.ndarray[np.float64]
+            scan_points: np.ndarray[np.float64], ref_kdtree: SpatialIndex
         ) -> np.ndarray[bool]:
             """
             Retrieves a mask on an array of points that indicates whether a point has a neighbor in ref within a certain
@@ -547,21 +778,25 @@ class RegistrationPipeline:
 
             Args:
                 scan_points: The points to align.
-                ref_points: The reference point cloud.
+                ref_kdtree: The spatial index built on the reference point cloud.
 
             Returns:
                 A mask array where True values indicate inliers.
             """
             return (
-                KDTree(ref_points).query(scan_points)[0].squeeze() <= distance_threshold
+                ref_kdtree.query(scan_points)[0].squeeze() <= distance_threshold
             )
 
         return (
-            get_inlier_points(points_aligned_icp, self.ref).sum()
+            get_inlier_points(
+                points_aligned_icp, self.get_spatial_index(self.ref, "metrics")
+            ).sum()
             / points_aligned_icp.shape[0],
             get_inlier_points(
                 points_aligned_icp[self.scan_keypoints],
-                self.ref[self.ref_keypoints],
+                self.get_spatial_index(
+                    self.ref, "metrics", "keypoints", self.ref_keypoints
+                ),
             ).sum()
             / self.scan_keypoints.shape[0],
         )
@@ -1,2 +1,11 @@
 from .io_ply import read_ply, write_ply, get_data
 from .perf_monitoring import checkpoint, timeit
+from .shared_memory import SharedArrayHandle, SharedArrays, attach_shared_arrays
+from .executors import (
+    Executor,
+    ExecutorType,
+    ProcessExecutor,
+    SerialExecutor,
+    ThreadExecutor,
+    create_executor,
+)
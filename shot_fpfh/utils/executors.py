@@ -0,0 +1,201 @@
+"""
+Long-lived executors shared by the parallel stages of the pipeline.
+Three executors share the same interface: a pool of worker processes, a pool of threads and a serial executor.
+"""
+from contextlib import AbstractContextManager, nullcontext
+from multiprocessing import Pool, resource_tracker
+from multiprocessing.pool import ThreadPool
+from types import TracebackType
+from typing import Callable, Iterable, Iterator, Literal, Protocol
+
+import numpy as np
+
+from .shared_memory import SharedArrayHandle, SharedArrays
+
+ExecutorType = Literal["process", "thread", "serial"]
+
+
+class Executor(Protocol):
+    """
+    Interface of the executors. Arrays published with share are retrieved in the tasks with attach_shared_arrays.
+    zero_copy indicates that the tasks run in the current process and can reference its arrays directly.
+    """
+
+    n_procs: int
+    zero_copy: bool
+
+    def __enter__(self):
+        ...
+
+    def __exit__(
+        self,
+        exc_type: type | None,
+        exc_val: Exception | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        ...
+
+    def imap(
+        self, func: Callable, iterable: Iterable, chunksize: int = 1
+    ) -> Iterator:
+        ...
+
+    def share(
+        self, **arrays: np.ndarray
+    ) -> AbstractContextManager[dict[str, SharedArrayHandle | np.ndarray]]:
+        ...
+
+    def close(self) -> None:
+        ...
+
+    def terminate(self) -> None:
+        ...
+
+
+class ProcessExecutor:
+    """
+    Pool of worker processes that is started once and reused by every computation until it is explicitly closed.
+    Arrays published with share are attached lazily by the workers, which keep them attached for the following tasks.
+    """
+
+    zero_copy = False
+
+    def __init__(self, n_procs: int = 8) -> None:
+        """
+        Starts the worker processes.
+
+        Args:
+            n_procs: Number of worker processes.
+        """
+        self.n_procs = n_procs
+        # the workers have to share the resource tracker of the main process, otherwise each of them would start its
+        # own tracker that considers the shared memory blocks they attach as leaked when they stop
+        resource_tracker.ensure_running()
+        self.pool = Pool(processes=n_procs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type | None,
+        exc_val: Exception | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        if exc_type is not None:
+            self.terminate()
+        else:
+            self.close()
+
+    def imap(
+        self, func: Callable, iterable: Iterable, chunksize: int = 1
+    ) -> Iterator:
+        """
+        Lazily applies a function to every element of an iterable in the worker processes, preserving the order.
+        """
+        return self.pool.imap(func, iterable, chunksize=chunksize)
+
+    def share(self, **arrays: np.ndarray) -> SharedArrays:
+        """
+        Publishes arrays in shared memory. The handles returned upon entering the context can be sent to the workers
+        that retrieve the arrays with attach_shared_arrays.
+
+        Args:
+            **arrays: The arrays to publish, indexed by the name under which the workers will retrieve them.
+
+        Returns:
+            The context manager that releases the shared memory on exit.
+        """
+        return SharedArrays(**arrays)
+
+    def close(self) -> None:
+        """
+        Waits for the pending tasks and stops the worker processes.
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self) -> None:
+        """
+        Stops the worker processes without waiting for the pending tasks.
+        """
+        self.pool.terminate()
+        self.pool.join()
+
+
+class ThreadExecutor(ProcessExecutor):
+    """
+    Pool of threads of the current process. The tasks read the arrays of the main thread without any copy, and the
+    heavy NumPy operations of the kernels release the GIL for most of their runtime.
+    """
+
+    zero_copy = True
+
+    def __init__(self, n_procs: int = 8) -> None:
+        """
+        Starts the threads.
+
+        Args:
+            n_procs: Number of threads.
+        """
+        self.n_procs = n_procs
+        self.pool = ThreadPool(processes=n_procs)
+
+    def share(self, **arrays: np.ndarray) -> nullcontext:
+        """
+        Publishes arrays for the tasks, which receive the arrays themselves.
+
+        Args:
+            **arrays: The arrays to publish, indexed by the name under which the tasks will retrieve them.
+
+        Returns:
+            A context manager that returns the arrays upon entering.
+        """
+        return nullcontext(arrays)
+
+
+class SerialExecutor(ThreadExecutor):
+    """
+    Executor that runs the tasks one after the other in the current thread, mostly useful for debugging and profiling.
+    """
+
+    def __init__(self, n_procs: int = 1) -> None:
+        """
+        Args:
+            n_procs: Ignored, the tasks are split as if there were n_procs workers.
+        """
+        self.n_procs = n_procs
+
+    def imap(
+        self, func: Callable, iterable: Iterable, chunksize: int = 1
+    ) -> Iterator:
+        """
+        Lazily applies a function to every element of an iterable in the current thread.
+        """
+        return map(func, iterable)
+
+    def close(self) -> None:
+        pass
+
+    def terminate(self) -> None:
+        pass
+
+
+def create_executor(executor_type: ExecutorType = "process", n_procs: int = 8) -> Executor:
+    """
+    Starts an executor.
+
+    Args:
+        executor_type: Whether the tasks are run on worker processes, on threads or serially.
+        n_procs: Number of workers.
+
+    Returns:
+        The executor.
+    """
+    if executor_type == "process":
+        return ProcessExecutor(n_procs=n_procs)
+    if executor_type == "thread":
+        return ThreadExecutor(n_procs=n_procs)
+    if executor_type == "serial":
+        return SerialExecutor(n_procs=n_procs)
+    raise ValueError(f"Incorrect executor type: {executor_type}.")
@@ -0,0 +1,115 @@
+"""
+Utility functions to share numpy arrays between processes without pickling them.
+"""
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from types import TracebackType
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class SharedArrayHandle:
+    """
+    Picklable reference to a numpy array stored in a shared memory block.
+    """
+
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+
+class SharedArrays:
+    """
+    Context manager that publishes numpy arrays in shared memory blocks and releases the blocks on exit.
+    Entering the context returns the handles to pass to the worker processes, which retrieve the arrays with
+    attach_shared_arrays.
+    """
+
+    def __init__(self, **arrays: np.ndarray) -> None:
+        """
+        Copies the arrays once in shared memory.
+
+        Args:
+            **arrays: The arrays to publish, indexed by the name under which the workers will retrieve them.
+        """
+        self.shared_memories: list[SharedMemory] = []
+        self.handles: dict[str, SharedArrayHandle] = {}
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            shared_memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shared_memory.buf)[
+                ...
+            ] = array
+            self.shared_memories.append(shared_memory)
+            self.handles[key] = SharedArrayHandle(
+                shared_memory.name, array.shape, array.dtype.str
+            )
+
+    def __enter__(self) -> dict[str, SharedArrayHandle]:
+        return self.handles
+
+    def __exit__(
+        self,
+        exc_type: type | None,
+        exc_val: Exception | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.release()
+
+    def release(self) -> None:
+        """
+        Frees the shared memory blocks. The arrays can no longer be attached afterward.
+        """
+        for shared_memory in self.shared_memories:
+            shared_memory.close()
+            shared_memory.unlink()
+        self.shared_memories = []
+
+
+# shared memory blocks attached in the current process, indexed by the name of the block
+_attached_arrays: dict[str, tuple[SharedMemory, np.ndarray]] = {}
+
+
+def attach_shared_arrays(
+    handles: dict[str, SharedArrayHandle | np.ndarray]
+) -> dict[str, np.ndarray]:
+    """
+    Retrieves arrays published with SharedArrays without copying them.
+    Blocks are only attached once per process and stay attached for the following calls, which means that this
+    function can be used as the initializer of a multiprocessing.Pool to attach them as soon as the workers start.
+    Blocks from previous publications that are not part of the handles are detached to let the memory be freed.
+    Arrays published by executors that run in the current process are given as is and returned unchanged.
+
+    Args:
+        handles: The handles returned by SharedArrays, or the arrays themselves.
+
+    Returns:
+        The shared arrays, indexed by the same keys as the handles.
+    """
+    handles_to_attach = {
+        key: handle
+        for key, handle in handles.items()
+        if isinstance(handle, SharedArrayHandle)
+    }
+    if not handles_to_attach:
+        # arrays of the current process, the attached blocks are left untouched since several threads can get here
+        return dict(handles)
+    names = {handle.name for handle in handles_to_attach.values()}
+    for name in _attached_arrays.keys() - names:
+        # the array is dropped before closing the block, which cannot be closed while it is referenced
+        shared_memory = _attached_arrays.pop(name)[0]
+        shared_memory.close()
+    for handle in handles_to_attach.values():
+        if handle.name not in _attached_arrays:
+            shared_memory = SharedMemory(name=handle.name)
+            _attached_arrays[handle.name] = (
+                shared_memory,
+                np.ndarray(handle.shape, dtype=handle.dtype, buffer=shared_memory.buf),
+            )
+    return {
+        key: _attached_arrays[handle.name][1]
+        if isinstance(handle, SharedArrayHandle)
+        else handle
+        for key, handle in handles.items()
+    }
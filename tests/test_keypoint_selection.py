@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import KDTree
+
+from shot_fpfh.base_computation import VoxelPyramid
+from shot_fpfh.keypoint_selection import (
+    select_keypoints_iteratively,
+    select_keypoints_with_density_threshold,
+)
+
+
+def select_keypoints_with_density_threshold_loop(
+    points: np.ndarray[np.float64],
+    voxel_size: float,
+    density_threshold_value: int,
+    density_threshold_radius: float | None = None,
+) -> np.ndarray[np.int64]:
+    """
+    Reference per-voxel implementation of select_keypoints_with_density_threshold.
+    """
+    non_empty_voxel_keys, inverse, nb_pts_per_voxel = np.unique(
+        ((points - np.min(points, axis=0)) // voxel_size).astype(int),
+        axis=0,
+        return_inverse=True,
+        return_counts=True,
+    )
+    if density_threshold_radius is None:
+        density_threshold_radius = voxel_size
+
+    idx_pts_vox_sorted = np.argsort(inverse.reshape(-1))
+    sub_sampled_points_idx = []
+    kdtree = None
+    if density_threshold_radius != voxel_size:
+        kdtree = KDTree(points)
+
+    last_seen = 0
+    for idx in range(len(non_empty_voxel_keys)):
+        indexes_in_voxel = idx_pts_vox_sorted[
+            last_seen : last_seen + nb_pts_per_voxel[idx]
+        ]
+        point_closest_to_centroid = indexes_in_voxel[
+            np.linalg.norm(
+                points[indexes_in_voxel] - points[indexes_in_voxel].mean(axis=0),
+                axis=1,
+            ).argmin()
+        ]
+        if (
+            voxel_size == density_threshold_radius
+            and nb_pts_per_voxel[idx] > density_threshold_value
+        ) or (
+            voxel_size != density_threshold_radius
+            and (
+                kdtree.query_radius(
+                    [points[point_closest_to_centroid]], density_threshold_radius
+                )[0].shape[0]
+                > density_threshold_value
+            )
+        ):
+            sub_sampled_points_idx.append(point_closest_to_centroid)
+
+        last_seen += nb_pts_per_voxel[idx]
+
+    return np.array(sub_sampled_points_idx, dtype=np.int64)
+
+
+@pytest.mark.parametrize("density_threshold_radius", [None, 0.5, 0.3, 1.0])
+@pytest.mark.parametrize("use_pyramid", [False, True])
+def test_density_threshold_matches_loop(
+    density_threshold_radius: float | None, use_pyramid: bool
+) -> None:
+    points = np.random.default_rng(0).random((20000, 3)) * 10
+    np.testing.assert_array_equal(
+        select_keypoints_with_density_threshold(
+            points,
+            0.5,
+            1,
+            density_threshold_radius,
+            pyramid=VoxelPyramid(points) if use_pyramid else None,
+        ),
+        select_keypoints_with_density_threshold_loop(
+            points, 0.5, 1, density_threshold_radius
+        ),
+    )
+
+
+@pytest.mark.parametrize("batch_size", [2**14, 100])
+@pytest.mark.parametrize("radius", [0.05, 0.2])
+def test_iterative_selection_spacing_and_coverage(
+    radius: float, batch_size: int
+) -> None:
+    points = np.random.default_rng(1).random((20000, 3))
+    points[:, 2] *= 0.2
+    keypoints = select_keypoints_iteratively(points, radius, batch_size=batch_size)
+    assert np.unique(keypoints).shape == keypoints.shape
+
+    # no two keypoints are within radius of each other
+    kdtree = KDTree(points[keypoints])
+    assert (kdtree.query_radius(points[keypoints], radius, count_only=True) == 1).all()
+    # every point is within radius of a keypoint
+    assert (kdtree.query(points)[0][:, 0] <= radius).all()
+
+
+def test_iterative_selection_with_duplicated_points() -> None:
+    points = np.repeat(np.random.default_rng(2).random((500, 3)), 3, axis=0)
+    keypoints = select_keypoints_iteratively(points, 0.1)
+    kdtree = KDTree(points[keypoints])
+    assert (kdtree.query_radius(points[keypoints], 0.1, count_only=True) == 1).all()
+    assert (kdtree.query(points)[0][:, 0] <= 0.1).all()
+    assert select_keypoints_iteratively(np.zeros((0, 3)), 0.1).shape == (0,)
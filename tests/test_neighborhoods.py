@@ -0,0 +1,125 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from sklearn.neighbors import KDTree
+
+from shot_fpfh.base_computation import (
+    MultiRadiusNeighborhoods,
+    NeighborhoodGraph,
+    as_neighborhood_graph,
+)
+
+
+@pytest.fixture
+def point_cloud() -> np.ndarray[np.float64]:
+    return np.random.default_rng(0).random((2000, 3))
+
+
+@pytest.fixture
+def query_points(point_cloud: np.ndarray[np.float64]) -> np.ndarray[np.float64]:
+    # the last query point is far from the point cloud and has an empty neighborhood
+    return np.vstack((point_cloud[::10], [[5, 5, 5]]))
+
+
+def get_neighborhoods(graph: NeighborhoodGraph) -> list[np.ndarray[np.int32]]:
+    return [
+        graph.indices[graph.offsets[i] : graph.offsets[i + 1]]
+        for i in range(graph.n_neighborhoods)
+    ]
+
+
+def assert_same_neighborhoods(
+    graph: NeighborhoodGraph, neighborhoods: list[np.ndarray[np.int64]]
+) -> None:
+    assert graph.n_neighborhoods == len(neighborhoods)
+    for neighborhood, expected_neighborhood in zip(
+        get_neighborhoods(graph), neighborhoods
+    ):
+        np.testing.assert_array_equal(
+            np.sort(neighborhood), np.sort(expected_neighborhood)
+        )
+
+
+def test_from_query_radius(
+    point_cloud: np.ndarray[np.float64], query_points: np.ndarray[np.float64]
+) -> None:
+    neighborhoods, distances = KDTree(point_cloud).query_radius(
+        query_points, 0.1, return_distance=True
+    )
+    graph = NeighborhoodGraph.from_query_radius(neighborhoods, distances)
+    assert graph.indices.dtype == np.int32 and graph.distances.dtype == np.float32
+    np.testing.assert_array_equal(graph.sizes, list(map(len, neighborhoods)))
+    assert_same_neighborhoods(graph, neighborhoods)
+    assert_same_neighborhoods(as_neighborhood_graph(neighborhoods), neighborhoods)
+    assert_same_neighborhoods(
+        as_neighborhood_graph((graph.indices, graph.offsets)), neighborhoods
+    )
+
+
+def test_slice_and_select(
+    point_cloud: np.ndarray[np.float64], query_points: np.ndarray[np.float64]
+) -> None:
+    neighborhoods = KDTree(point_cloud).query_radius(query_points, 0.1)
+    graph = NeighborhoodGraph.from_query_radius(neighborhoods)
+    assert_same_neighborhoods(graph.slice(50, 201), neighborhoods[50:201])
+    assert graph.slice(10, 10).n_neighborhoods == 0
+
+    rows = np.array([200, 3, 3, 0, 150, 42])
+    assert_same_neighborhoods(graph.select(rows), neighborhoods[rows])
+    assert graph.select(np.zeros(0, dtype=np.int64)).n_neighborhoods == 0
+
+
+@pytest.mark.parametrize("block_size", [1, 50, 1000, 10**9])
+def test_split_in_blocks(
+    point_cloud: np.ndarray[np.float64],
+    query_points: np.ndarray[np.float64],
+    block_size: int,
+) -> None:
+    graph = NeighborhoodGraph.search(KDTree(point_cloud), query_points, 0.1)
+    blocks = graph.split_in_blocks(block_size)
+    # contiguous blocks covering all the query points
+    assert blocks[0][0] == 0 and blocks[-1][1] == graph.n_neighborhoods
+    assert all(stop == start for (_, stop), (start, _) in zip(blocks[:-1], blocks[1:]))
+    for start, stop in blocks:
+        n_neighbors = graph.offsets[stop] - graph.offsets[start]
+        assert stop > start
+        assert n_neighbors <= block_size or stop == start + 1
+    assert (
+        NeighborhoodGraph(
+            np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64)
+        ).split_in_blocks(block_size)
+        == []
+    )
+
+
+def test_restrict(
+    point_cloud: np.ndarray[np.float64], query_points: np.ndarray[np.float64]
+) -> None:
+    kdtree = KDTree(point_cloud)
+    multi_radius_neighborhoods = MultiRadiusNeighborhoods(
+        point_cloud, query_points, [0.05, 0.1], kdtree
+    )
+    for radius in [0.03, 0.05, 0.1]:
+        graph = multi_radius_neighborhoods.restrict(radius)
+        assert_same_neighborhoods(graph, kdtree.query_radius(query_points, radius))
+        # the neighbors stay sorted by distance
+        for i in range(graph.n_neighborhoods):
+            assert (
+                np.diff(graph.distances[graph.offsets[i] : graph.offsets[i + 1]]) >= 0
+            ).all()
+
+
+def test_save_and_load(
+    point_cloud: np.ndarray[np.float64],
+    query_points: np.ndarray[np.float64],
+    tmp_path: Path,
+) -> None:
+    graph = NeighborhoodGraph.search(
+        KDTree(point_cloud), query_points, 0.1, return_distance=True
+    )
+    graph.save(tmp_path / "graph")
+    loaded_graph = NeighborhoodGraph.load(tmp_path / "graph")
+    np.testing.assert_array_equal(loaded_graph.indices, graph.indices)
+    np.testing.assert_array_equal(loaded_graph.offsets, graph.offsets)
+    np.testing.assert_array_equal(loaded_graph.distances, graph.distances)
@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import KDTree
+
+from shot_fpfh.base_computation import (
+    SklearnSpatialIndex,
+    VoxelHashSpatialIndex,
+    create_spatial_index,
+    query_radius_csr,
+)
+
+backends = ["sklearn", "scipy", "brute_force", "voxel_hash"]
+
+
+def get_point_cloud(offset: float, seed: int = 0) -> np.ndarray[np.float64]:
+    """
+    Random point cloud with duplicated points, shifted by an offset like georeferenced coordinates.
+    """
+    points = np.random.default_rng(seed).random((3000, 3)) * 10
+    return np.vstack((points, points[:200])) + offset
+
+
+@pytest.mark.parametrize("offset", [0, 1e5])
+@pytest.mark.parametrize("r", [0, 0.3, 1.0])
+@pytest.mark.parametrize("backend", backends)
+def test_radius_queries_match_sklearn(backend: str, r: float, offset: float) -> None:
+    points = get_point_cloud(offset)
+    query_points = np.vstack(
+        (points[::7], np.random.default_rng(1).random((300, 3)) * 10 + offset)
+    )
+    reference = SklearnSpatialIndex(points)
+    spatial_index = create_spatial_index(points, backend)
+
+    np.testing.assert_array_equal(
+        spatial_index.count_radius(query_points, r),
+        reference.count_radius(query_points, r),
+    )
+    neighborhoods, distances = spatial_index.query_radius(
+        query_points, r, return_distance=True, sort_results=True
+    )
+    reference_neighborhoods, reference_distances = reference.query_radius(
+        query_points, r, return_distance=True, sort_results=True
+    )
+    for neighborhood, neighborhood_distances, ref_neighborhood, ref_distances in zip(
+        neighborhoods, distances, reference_neighborhoods, reference_distances
+    ):
+        # neighbors at the same distance can come in any order
+        np.testing.assert_allclose(neighborhood_distances, ref_distances, atol=1e-12)
+        np.testing.assert_array_equal(np.sort(neighborhood), np.sort(ref_neighborhood))
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_null_radius_finds_query_points(backend: str) -> None:
+    points = get_point_cloud(1e5)
+    assert (create_spatial_index(points, backend).count_radius(points, 0) >= 1).all()
+
+
+@pytest.mark.parametrize("offset", [0, 1e5])
+@pytest.mark.parametrize("backend", backends)
+def test_knn_queries_match_sklearn(backend: str, offset: float) -> None:
+    points = np.random.default_rng(2).random((3000, 3)) * 10 + offset
+    query_points = np.random.default_rng(3).random((500, 3)) * 10 + offset
+    distances, indices = create_spatial_index(points, backend).query(query_points, k=5)
+    reference_distances, reference_indices = SklearnSpatialIndex(points).query(
+        query_points, k=5
+    )
+    np.testing.assert_array_equal(indices, reference_indices)
+    np.testing.assert_allclose(distances, reference_distances, atol=1e-12)
+
+
+# sklearn.neighbors.KDTree rejects empty queries
+@pytest.mark.parametrize("backend", ["scipy", "brute_force", "voxel_hash"])
+def test_empty_queries(backend: str) -> None:
+    spatial_index = create_spatial_index(get_point_cloud(0), backend)
+    assert spatial_index.count_radius(np.zeros((0, 3)), 0.5).shape == (0,)
+    assert spatial_index.query_radius(np.zeros((0, 3)), 0.5).shape == (0,)
+
+
+@pytest.mark.parametrize("sort_results", [False, True])
+@pytest.mark.parametrize("r", [-1.0, 0, 0.2, 0.7])
+@pytest.mark.parametrize("block_size", [2**22, 500])
+def test_voxel_hash_csr_matches_kdtree(
+    block_size: int, r: float, sort_results: bool
+) -> None:
+    points = get_point_cloud(1e5, seed=4)
+    # query points inside the grid, on its border and far away from it
+    query_points = np.vstack(
+        (
+            points[::11],
+            np.random.default_rng(5).random((200, 3)) * 12 - 1 + 1e5,
+            [[-50, -50, -50]],
+        )
+    )
+    indices, offsets, distances = VoxelHashSpatialIndex(
+        points, block_size=block_size
+    ).query_radius_csr(query_points, r, return_distance=True, sort_results=sort_results)
+    reference_neighborhoods, reference_distances = KDTree(points).query_radius(
+        query_points, r, return_distance=True, sort_results=sort_results
+    )
+
+    assert offsets.shape == (query_points.shape[0] + 1,)
+    assert offsets[-1] == indices.shape[0] == distances.shape[0]
+    for i, (ref_neighborhood, ref_distances) in enumerate(
+        zip(reference_neighborhoods, reference_distances)
+    ):
+        neighborhood = indices[offsets[i] : offsets[i + 1]]
+        neighborhood_distances = distances[offsets[i] : offsets[i + 1]]
+        np.testing.assert_array_equal(np.sort(neighborhood), np.sort(ref_neighborhood))
+        np.testing.assert_allclose(
+            np.linalg.norm(points[neighborhood] - query_points[i], axis=1),
+            neighborhood_distances,
+        )
+        if sort_results:
+            # neighbors at the same distance can come in any order
+            np.testing.assert_allclose(
+                neighborhood_distances, ref_distances, atol=1e-12
+            )
+            assert (np.diff(neighborhood_distances) >= 0).all()
+
+
+def test_voxel_hash_csr_empty_queries() -> None:
+    indices, offsets, distances = VoxelHashSpatialIndex(
+        get_point_cloud(0)
+    ).query_radius_csr(np.zeros((0, 3)), 0.5, return_distance=True)
+    assert indices.shape == distances.shape == (0,)
+    np.testing.assert_array_equal(offsets, [0])
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_query_radius_csr_matches_query_radius(backend: str) -> None:
+    points = get_point_cloud(0, seed=6)
+    spatial_index = create_spatial_index(points, backend)
+    indices, offsets = query_radius_csr(spatial_index, points[::13], 0.4)
+    for i, neighborhood in enumerate(spatial_index.query_radius(points[::13], 0.4)):
+        np.testing.assert_array_equal(
+            np.sort(indices[offsets[i] : offsets[i + 1]]), np.sort(neighborhood)
+        )
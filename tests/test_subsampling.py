@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from shot_fpfh.base_computation import VoxelPyramid, grid_subsampling
+
+
+def grid_subsampling_loop(
+    points: np.ndarray[np.float64], voxel_size: float
+) -> np.ndarray[np.int64]:
+    """
+    Reference per-voxel implementation of grid_subsampling.
+    """
+    non_empty_voxel_keys, inverse, nb_pts_per_voxel = np.unique(
+        ((points - np.min(points, axis=0)) // voxel_size).astype(int),
+        axis=0,
+        return_inverse=True,
+        return_counts=True,
+    )
+
+    idx_pts_vox_sorted = np.argsort(inverse.reshape(-1))
+    sub_sampled_points_idx = []
+
+    last_seen = 0
+    for idx in range(len(non_empty_voxel_keys)):
+        indexes_in_voxel = idx_pts_vox_sorted[
+            last_seen : last_seen + nb_pts_per_voxel[idx]
+        ]
+        sub_sampled_points_idx.append(
+            indexes_in_voxel[
+                np.linalg.norm(
+                    points[indexes_in_voxel] - points[indexes_in_voxel].mean(axis=0),
+                    axis=1,
+                ).argmin()
+            ]
+        )
+
+        last_seen += nb_pts_per_voxel[idx]
+
+    return np.array(sub_sampled_points_idx)
+
+
+@pytest.mark.parametrize("voxel_size", [0.02, 0.1, 0.3])
+@pytest.mark.parametrize("seed", [0, 1])
+def test_grid_subsampling_matches_loop(seed: int, voxel_size: float) -> None:
+    points = np.random.default_rng(seed).random((50000, 3))
+    np.testing.assert_array_equal(
+        grid_subsampling(points, voxel_size), grid_subsampling_loop(points, voxel_size)
+    )
+
+
+def test_grid_subsampling_matches_loop_with_duplicates() -> None:
+    points = np.repeat(np.random.default_rng(2).random((2000, 3)) * 10, 3, axis=0)
+    np.testing.assert_array_equal(
+        grid_subsampling(points, 0.5), grid_subsampling_loop(points, 0.5)
+    )
+
+
+def test_voxel_pyramid_caches_grid_subsampling() -> None:
+    points = np.random.default_rng(3).random((10000, 3))
+    pyramid = VoxelPyramid(points, max_levels=2)
+    np.testing.assert_array_equal(
+        pyramid.subsample(0.1), grid_subsampling_loop(points, 0.1)
+    )
+    assert pyramid.subsample(0.1) is pyramid.subsample(0.1)
+    pyramid.subsample(0.2)
+    pyramid.subsample(0.3)
+    assert list(pyramid.levels) == [0.2, 0.3]